@@ -3,11 +3,10 @@
 import os
 import pickle
 import numpy as np
-from theano import function
-from theano import tensor as T
 
 from pylearn2.utils import serial
 import BlackBox.black_box_dataset as black_box_dataset
+from utils import inference
 import pylearn2.datasets.preprocessing as preprocessing
 from pylearn2.datasets.transformer_dataset import TransformerDataset
 
@@ -168,35 +167,8 @@ def get_finetuner(model, cost, trainset, validset=None, batch_size=100, iters=10
 
 def get_output(model, data, batch_size):
 	model.set_batch_size(batch_size)
-	# dataset must be multiple of batch size of some batches will have
-	# different sizes. theano convolution requires a hard-coded batch size
-	m = data.X.shape[0]
-	extra = batch_size - m % batch_size
-	assert (m + extra) % batch_size == 0
-	if extra > 0:
-		data.X = np.concatenate((data.X, np.zeros((extra, data.X.shape[1]), dtype=data.X.dtype)), axis=0)
-	assert data.X.shape[0] % batch_size == 0
-	
-	Xb = model.get_input_space().make_theano_batch()
-	Yb = model.fprop(Xb)
-	y = T.argmax(Yb, axis=1)
-	f = function([Xb], y)
-	
-	y = []
-	for ii in xrange(data.X.shape[0] // batch_size):
-		x_arg = data.X[ii*batch_size:(ii+1)*batch_size,:]
-		if Xb.ndim > 2:
-			x_arg = data.get_topological_view(x_arg)
-		y.append(f(x_arg.astype(Xb.dtype)))
-	
-	y = np.concatenate(y)
-	assert y.ndim == 1
-	assert y.shape[0] == data.X.shape[0]
-	# discard any zero-padding that was used to give the batches uniform size
-	y = y[:m]
-	data.X = data.X[:m]
-	
-	return y
+	# predicted classes; the ragged last batch is zero-padded by inference
+	return np.argmax(inference.get_output(model, data, -1, batch_size), axis=1)
 
 if __name__ == '__main__':
 	
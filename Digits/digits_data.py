@@ -4,11 +4,12 @@ import os
 import numpy as np
 
 from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
-from pylearn2.datasets import preprocessing
 import pylearn2.utils.serial as serial
 
 from PIL import Image
 
+from utils import streamprep
+
 rng = np.random.RandomState(42)
 
 DATA_DIR = '/home/nico/datasets/Kaggle/Digits/'
@@ -98,19 +99,28 @@ def get_dataset(tot=False, preprocessor='normal'):
         testset = Digits(which_set='test')
         
         print 'preprocessing data...'
-        pipeline = preprocessing.Pipeline()
-        pipeline.items.append(preprocessing.GlobalContrastNormalization(sqrt_bias=10., use_std=True))
-        
-        if preprocessor != 'nozca':
-            # ZCA = zero-phase component analysis
-            # very similar to PCA, but preserves the look of the original image better
-            pipeline.items.append(preprocessing.ZCA())
-        
-        # note the can_fit=False's: no sharing between train and valid data
-        trainset.apply_preprocessor(preprocessor=pipeline, can_fit=True)
-        validset.apply_preprocessor(preprocessor=pipeline, can_fit=False)
-        tottrainset.apply_preprocessor(preprocessor=pipeline, can_fit=True)
-        testset.apply_preprocessor(preprocessor=pipeline, can_fit=False)
+        # same as pylearn2's GlobalContrastNormalization(sqrt_bias=10., use_std=True)
+        pipeline = {'gcn': {'sqrt_bias': 10., 'use_std': True}, 'standardize': False}
+        # ZCA = zero-phase component analysis
+        # very similar to PCA, but preserves the look of the original image better
+        pipeline['zca'] = preprocessor != 'nozca'
+        
+        # fitted blockwise from the stored arrays; tottrain = train + valid reuses their statistics
+        # note: no sharing between train and valid data
+        cache_dir = DATA_DIR+'prepcache'
+        train_path = DATA_DIR+'train.npy'
+        test_path = DATA_DIR+'test.npy'
+        X = np.load(train_path, mmap_mode='r')
+        train_key, train_params = streamprep.cached_fit(X, train_path, [(0, 34000)], cache_dir, **pipeline)
+        tot_key, tot_params = streamprep.cached_fit(X, train_path, [(0, 34000), (34000, 42000)], cache_dir,
+                                                    **pipeline)
+        design = np.load(streamprep.cached_transform(X, train_path, train_key, train_params, cache_dir, 'train'))
+        trainset.X = design[0:34000]
+        validset.X = design[34000:42000]
+        tottrainset.X = np.load(streamprep.cached_transform(X, train_path, tot_key, tot_params, cache_dir,
+                                                            'tottrain'))
+        testset.X = np.load(streamprep.cached_transform(np.load(test_path, mmap_mode='r'), test_path, tot_key,
+                                                        tot_params, cache_dir, 'test'))
         
         if preprocessor not in ('normal','nozca'):
             for data in (trainset, validset, tottrainset, testset):
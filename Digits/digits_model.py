@@ -3,8 +3,8 @@
 import os
 import numpy as np
 import pandas as pd
-from theano import function
 import Digits.digits_data
+from utils import inference
 
 from pylearn2.utils import serial
 from pylearn2.train import Train
@@ -53,33 +53,6 @@ def get_trainer(model, trainset, validset, epochs=20, batch_size=100):
     return Train(model=model, algorithm=train_algo, dataset=trainset, save_freq=0, save_path='epoch', \
             extensions=[MomentumAdjustor(final_momentum=0.7, start=0, saturate=int(0.8*epochs))])
 
-def get_output(model, tdata, layerindex, batch_size=100):
-    # get output submodel classifiers
-    Xb = model.get_input_space().make_theano_batch()
-    Yb = model.fprop(Xb, return_all=True)
-    
-    data = tdata.get_topological_view() #.transpose((3,1,2,0))
-    # fill up with zeros to keep dividible by batch number
-    extralength = batch_size - data.shape[3]%batch_size
-    
-    if extralength < batch_size:
-        data = np.append(data,np.zeros([extralength, data.shape[0],data.shape[1],data.shape[2]]), axis=3)
-        data = data.astype('float32')
-    
-    propagate = function([Xb], Yb, allow_input_downcast=True)
-    
-    output = []
-    for ii in xrange(int(data.shape[3]/batch_size)):
-        seldata = data[:,:,:,ii*batch_size:(ii+1)*batch_size]
-        output.append(propagate(seldata)[layerindex])
-    
-    output = np.reshape(output,[data.shape[3],-1])
-    
-    if extralength < batch_size:
-        # remove the filler
-        output = output[:-extralength,:]
-    
-    return output
 
 def get_comb_models(traindata, targets, crossval=True):
     # traindata: list with NumExamples * NumOutputs(=10) array with length 'no. preprocessors'
@@ -137,14 +110,14 @@ if __name__ == '__main__':
 #        else:
 #            models[ii] = serial.load(DATA_DIR+preprocessor+'_model.pkl')
 #        
-#        outtrainset[ii] = get_output(models[ii],trainset,-1)
+#        outtrainset[ii] = inference.get_output(models[ii],trainset,-1)
 #        
 #        if not submission:
 #            # validset is used to evaluate maxout network performance
-#            outvalidset[ii] = get_output(models[ii],validset,-1)
+#            outvalidset[ii] = inference.get_output(models[ii],validset,-1)
 #            accuracies[ii] = accuracy_score(np.argmax(validset.get_targets(),axis=1),np.argmax(outvalidset[ii],axis=1))
 #        else:
-#            outtestset[ii] = get_output(models[ii],testset,-1)
+#            outtestset[ii] = inference.get_output(models[ii],testset,-1)
 #            serial.save(DATA_DIR+preprocessor+'_model.pkl', models[ii])
 #    
 #    if not submission:
@@ -187,7 +160,7 @@ if __name__ == '__main__':
     model = get_maxout([28,28,1], batch_size=batch_size)
     get_trainer(model, trainset, validset, epochs=200, batch_size=batch_size).main_loop()
     
-    output = get_output(model,testset,-1)
+    output = inference.get_output(model,testset,-1,batch_size=100)
     
     pdsubm = pd.DataFrame({'ImageId': range(1,28001), 'Label': np.argmax(output, axis=1)})
     pdsubm.to_csv(DATA_DIR+'submission.csv', header=True, index=False, fmt='%1.0f')
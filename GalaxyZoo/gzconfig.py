@@ -0,0 +1,123 @@
+#!/usr/bin/python2
+
+"""
+Run configurations of the Galaxy Zoo deep models
+
+A GZConfig holds every parameter that affects the data a model is trained
+on: the submodel and its target set, the image size, grayscale or RGB, and
+the preprocessing pipeline, plus the batch size. Cache keys are derived
+from these: preprocessed data only depend on the image and preprocessing
+parameters, so variants that differ in targets share them, and so do
+unsupervised models trained on them (keyed on the preprocessing and their
+own parameters), while supervised models and their outputs depend on all
+parameters. Switching variants therefore
+never reuses or rebuilds another variant's files by accident.
+
+With stream, the RGB models train on randomly augmented minibatches that
+are preprocessed on the fly (gzdeepdata.get_stream) instead of on the
+preprocessed training design, and their outputs are computed block by block
+from the image store, so no float32 copy of the images is kept.
+
+The models and the scripts that use their outputs share the configurations
+defined at the bottom.
+"""
+
+import json
+import hashlib
+
+from GalaxyZoo import gztargets
+
+DATA_DIR = '/home/nico/Data/GalaxyZoo/'
+
+# default target set per submodel: 159 decision tree leaves and the 8 odd feature answers
+SUBMODEL_TARGETS = {1: 'full', 2: 'odd'}
+
+
+def _key(params):
+    return hashlib.md5(json.dumps(params, sort_keys=True)).hexdigest()[:16]
+
+
+class GZConfig(object):
+
+    def __init__(self, submodel=1, target_set=None, size=64, flatgrey=False, gcn={'use_std': True}, zca=True,
+                 zca_components=None, batch_size=100, stream=False):
+        assert submodel in SUBMODEL_TARGETS
+        self.submodel = submodel
+        self.target_set = target_set or SUBMODEL_TARGETS[submodel]
+        assert self.target_set in gztargets.TARGET_SETS
+        self.size = size
+        self.flatgrey = flatgrey
+        self.gcn = dict(gcn) if gcn is not None else None
+        self.zca = zca
+        # a partial ZCA needs fewer components than pixel values, see utils.streamprep.fit_params
+        dim = size * size * (1 if flatgrey else 3)
+        if zca_components is not None and not 0 < zca_components < dim:
+            raise ValueError('zca_components must be between 1 and %d for %d pixel values, got %s'
+                             % (dim - 1, dim, zca_components))
+        self.zca_components = zca_components
+        self.batch_size = batch_size
+        assert not (stream and flatgrey)
+        self.stream = stream
+
+    def params(self):
+        return dict(self.__dict__)
+
+    def replace(self, **changes):
+        """Copy of the configuration with some parameters changed
+        """
+        params = self.params()
+        if 'submodel' in changes and 'target_set' not in changes:
+            params['target_set'] = None
+        params.update(changes)
+        return GZConfig(**params)
+
+    @property
+    def nclass(self):
+        return gztargets.n_targets(self.target_set)
+
+    @property
+    def pipeline(self):
+        """Preprocessing as utils.streamprep parameters
+        """
+        pipeline = {'gcn': self.gcn, 'standardize': False, 'zca': self.zca}
+        if self.zca_components:
+            pipeline['zca_components'] = self.zca_components
+        return pipeline
+
+    def prep_key(self):
+        """Key of the preprocessed images, independent of submodel and targets
+        """
+        return _key({'size': self.size, 'flatgrey': self.flatgrey, 'pipeline': self.pipeline})
+
+    def key(self, name):
+        """Key of a model (or its outputs) with the given name
+        """
+        return _key({'name': name, 'params': self.params()})
+
+    def model_path(self, name):
+        return DATA_DIR + 'model_%s_%s.pkl' % (name, self.key(name))
+
+    def output_path(self, name, which_set):
+        return DATA_DIR + '%s_%s_%s.npy' % (name, which_set, self.key(name))
+
+    def shared_key(self, name, **params):
+        """Key of an unsupervised model (or its outputs) with the given name and
+        parameters, independent of submodel and targets
+        """
+        return _key({'name': name, 'prep': self.prep_key(), 'params': params})
+
+    def shared_model_path(self, name, **params):
+        return DATA_DIR + 'model_%s_%s.pkl' % (name, self.shared_key(name, **params))
+
+    def shared_output_path(self, name, which_set, **params):
+        return DATA_DIR + '%s_%s_%s.npy' % (name, which_set, self.shared_key(name, **params))
+
+    def __repr__(self):
+        return 'GZConfig(%s)' % ', '.join('%s=%r' % item for item in sorted(self.params().items()))
+
+
+# conv net on RGB images; submodel 1 predicts the small target set
+CONV = GZConfig(submodel=1, target_set='small', batch_size=100)
+MAXOUT = GZConfig(submodel=1, batch_size=50)
+# stacked denoising autoencoders on grayscale images
+DAEX = GZConfig(submodel=1, flatgrey=True, batch_size=120)
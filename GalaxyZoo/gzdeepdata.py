@@ -1,285 +1,264 @@
 #!/usr/bin/python2
 
-import os
-from pylearn2.datasets import preprocessing
-from pylearn2.utils import serial
-from collections import OrderedDict
 import numpy as np
 from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix, DefaultViewConverter
-from PIL import Image
+from pylearn2.space import Conv2DSpace, VectorSpace
 
 import GalaxyZoo.gzdeepdata
-
-DATA_DIR = '/home/nico/Data/GalaxyZoo/'
-
-SUBMODEL = 1
+from GalaxyZoo import gzconfig, gzstore, gztargets
+from GalaxyZoo.gzconfig import DATA_DIR
+from utils import inference, streamprep
+from utils.prefetch import PrefetchIterator, check_random_mode, iterator_specs
 
 
 class GZData(DenseDesignMatrix):
-
-    def __init__(self, which_set, start=None, stop=None, axes=('c', 0, 1, 'b'), flatgrey=False):
+    """
+    Galaxy images of a set, two rows (raw and proc image) per galaxy, as
+    float32. With raw, X of the RGB images is the uint8 view of the image
+    store instead, which costs no memory; that is only meant for
+    preprocessing, which replaces X by the float32 result (see get_data).
+    """
+    def __init__(self, which_set, start=None, stop=None, axes=('c', 0, 1, 'b'), flatgrey=False, target_set='full',
+                 size=64, raw=False):
         assert which_set in ['training', 'test']
 
-        filenames = np.load(os.path.join(DATA_DIR, 'filenumbers.npy'))
-        if which_set == 'training':
-            filenames = filenames[0]
-        elif which_set == 'test':
-            filenames = filenames[1]
-
-        self.patch_size = (128, 128)
+        self.patch_size = (gzstore.FULL_SIZE, gzstore.FULL_SIZE)
 
         # downsample data?
-        self.scale_factor = 2
+        self.scale_factor = gzstore.FULL_SIZE // size
+
+        # packed (galaxies, raw/proc, h, w, RGB) uint8 memmap, see gzprep
+        images = gzstore.load_images(which_set, size=size)
 
         if start is not None:
             assert start >= 0
             assert start < stop
             assert stop <= 61577
-            filenames = filenames[start:stop + 1]
+            images = images[start:stop + 1]
 
         if flatgrey:
-            trainx = np.zeros((2 * len(filenames), int(self.patch_size[0] / self.scale_factor),
-                               int(self.patch_size[1] / self.scale_factor)))
-            for ii, fn in enumerate(filenames):
-                for jj, itype in enumerate(('raw', 'proc')):
-                    im = Image.open(DATA_DIR + 'images_' + which_set + '_proc/' + str(fn) + '_' + itype + '.png').convert('L')
-
-                    # resize
-                    if self.scale_factor not in (None, 1, 1.):
-                        # why are these floats?
-                        w, h = [int(x) for x in im.size]
-                        im = im.resize((int(w / self.scale_factor), int(h / self.scale_factor)), Image.ANTIALIAS)
-
-                    # from here on, work with 2D numpy array
-                    im = np.squeeze(np.array(im, dtype=np.uint8))
-
-                    trainx[2 * ii + jj, :, :] = im
-
+            # same weights as PIL's convert('L')
+            trainx = np.empty((2 * images.shape[0],) + images.shape[2:4], dtype='float32')
+            for ii in range(0, images.shape[0], 5000):
+                block = np.asarray(images[ii:ii + 5000], dtype='float32')
+                trainx[2 * ii:2 * ii + 2 * block.shape[0]] = np.reshape(
+                    np.round(np.dot(block, [0.299, 0.587, 0.114])), (-1,) + images.shape[2:4])
             trainx = np.reshape(trainx, (trainx.shape[0], np.prod(trainx.shape[1:])))
         else:
-            trainx = np.zeros((2 * len(filenames), int(self.patch_size[0] / self.scale_factor),
-                               int(self.patch_size[1] / self.scale_factor), 3))
-            for ii, fn in enumerate(filenames):
-                for jj, itype in enumerate(('raw', 'proc')):
-                    im = Image.open(DATA_DIR + 'images_' + which_set + '_proc/' + str(fn) + '_' + itype + '.png')
-
-                    # resize
-                    if self.scale_factor not in (None, 1, 1.):
-                        # why are these floats?
-                        w, h = [int(x) for x in im.size]
-                        im = im.resize((int(w / self.scale_factor), int(h / self.scale_factor)), Image.ANTIALIAS)
-
-                    # from here on, work with 2D numpy array
-                    im = np.squeeze(np.array(im, dtype=np.uint8))
-
-                    trainx[2 * ii + jj, :, :, :] = im
-
-            trainx = np.reshape(trainx, (trainx.shape[0], np.prod(trainx.shape[1:])))
-
-        trainx = trainx.astype('float32')
-
-        if SUBMODEL == 2:
-            if which_set == 'test':
-                y = np.zeros((trainx.shape[0], 8)).astype('float32')
-            else:
-                y = np.load(DATA_DIR+'targets.npy').astype('float32')
-                if start is None:
-                    start = 0
-                    stop = trainx.shape[0] - 1
-                # 14:15 is zodat de array 1 dimensie houdt in die richting
-                y = np.hstack((y[start:stop + 1, 14:15], y[start:stop + 1, 18:25]))
-                y = np.repeat(y, 2, axis=0)
-        elif SUBMODEL == 1:
-            if which_set == 'test':
-                y = np.zeros((trainx.shape[0], 159)).astype('float32')
-            else:
-                y = np.load(DATA_DIR+'targets.npy').astype('float32')
-                if start is None:
-                    start = 0
-                    stop = trainx.shape[0] - 1
-                y = np.hstack((
-                    # SMALL VERSION, 15 outputs
-                    # # 1.1 + 7.1/.2/.3
-                    # y[start:stop + 1, 15:18],
-                    # # 1.2 + 2.1 + 9.1/.2/.3
-                    # y[start:stop + 1, 25:28],
-                    # # 1.2 + 2.2 + 3.1 + 4.1 + 10.1/.2/.3
-                    # y[start:stop + 1, 5:6] *
-                    # (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) *
-                    # (y[start:stop + 1, 28:31] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)),
-                    # # 1.2 + 2.2 + 3.1 + 4.2
-                    # y[start:stop + 1, 5:6] *
-                    # (y[start:stop + 1, 8:9] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)),
-                    # # 1.2 + 2.2 + 3.2 + 4.1 + 10.1/.2/.3
-                    # y[start:stop + 1, 6:7] *
-                    # (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) *
-                    # (y[start:stop + 1, 28:31] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)),
-                    # # 1.2 + 2.2 + 3.2 + 4.2
-                    # y[start:stop + 1, 6:7] *
-                    # (y[start:stop + 1, 8:9] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)),
-                    # # 1.3
-                    # y[start:stop + 1, 2:3]
-
-                    # BIGGER VERSION, 159 outputs
-                    # 1.1 + 7.1/.2/.3
-                    y[start:stop + 1, 15:18],
-                    # 1.2 + 2.1 + 9.1/.2/.3
-                    y[start:stop + 1, 25:28],
-                    # 1.2 + 2.2 + 3.1 + 4.1 + 10.1 + 11.1 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 5:6] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 28:29] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 31:32] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.1 + 4.1 + 10.1 + 11.2 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 5:6] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 28:29] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 32:33] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.1 + 4.1 + 10.1 + 11.3 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 5:6] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 28:29] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 33:34] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.1 + 4.1 + 10.1 + 11.4 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 5:6] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 28:29] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 34:35] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.1 + 4.1 + 10.1 + 11.5 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 5:6] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 28:29] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 35:36] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.1 + 4.1 + 10.1 + 11.6 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 5:6] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 28:29] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 36:37] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.1 + 4.1 + 10.2 + 11.1 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 5:6] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 29:30] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 31:32] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.1 + 4.1 + 10.2 + 11.2 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 5:6] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 29:30] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 32:33] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.1 + 4.1 + 10.2 + 11.3 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 5:6] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 29:30] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 33:34] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.1 + 4.1 + 10.2 + 11.4 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 5:6] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 29:30] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 34:35] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.1 + 4.1 + 10.2 + 11.5 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 5:6] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 29:30] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 35:36] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.1 + 4.1 + 10.2 + 11.6 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 5:6] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 29:30] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 36:37] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.1 + 4.1 + 10.3 + 11.1 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 5:6] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 30:31] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 31:32] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.1 + 4.1 + 10.3 + 11.2 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 5:6] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 30:31] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 32:33] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.1 + 4.1 + 10.3 + 11.3 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 5:6] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 30:31] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 33:34] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.1 + 4.1 + 10.3 + 11.4 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 5:6] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 30:31] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 34:35] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.1 + 4.1 + 10.3 + 11.5 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 5:6] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 30:31] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 35:36] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.1 + 4.1 + 10.3 + 11.6 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 5:6] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 30:31] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 36:37] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.1 + 4.2 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 5:6] * (y[start:stop + 1, 8:9] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.2 + 4.1 + 10.1 + 11.1 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 6:7] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 28:29] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 31:32] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.2 + 4.1 + 10.1 + 11.2 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 6:7] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 28:29] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 32:33] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.2 + 4.1 + 10.1 + 11.3 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 6:7] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 28:29] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 33:34] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.2 + 4.1 + 10.1 + 11.4 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 6:7] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 28:29] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 34:35] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.2 + 4.1 + 10.1 + 11.5 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 6:7] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 28:29] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 35:36] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.2 + 4.1 + 10.1 + 11.6 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 6:7] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 28:29] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 36:37] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.2 + 4.1 + 10.2 + 11.1 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 6:7] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 29:30] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 31:32] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.2 + 4.1 + 10.2 + 11.2 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 6:7] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 29:30] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 32:33] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.2 + 4.1 + 10.2 + 11.3 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 6:7] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 29:30] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 33:34] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.2 + 4.1 + 10.2 + 11.4 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 6:7] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 29:30] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 34:35] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.2 + 4.1 + 10.2 + 11.5 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 6:7] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 29:30] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 35:36] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.2 + 4.1 + 10.2 + 11.6 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 6:7] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 29:30] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 36:37] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.2 + 4.1 + 10.3 + 11.1 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 6:7] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 30:31] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 31:32] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.2 + 4.1 + 10.3 + 11.2 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 6:7] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 30:31] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 32:33] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.2 + 4.1 + 10.3 + 11.3 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 6:7] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 30:31] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 33:34] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.2 + 4.1 + 10.3 + 11.4 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 6:7] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 30:31] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 34:35] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.2 + 4.1 + 10.3 + 11.5 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 6:7] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 30:31] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 35:36] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.2 + 4.1 + 10.3 + 11.6 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 6:7] * (y[start:stop + 1, 7:8] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 30:31] / np.sum(y[start:stop + 1, 28:31], axis=1, keepdims=True)) * (y[start:stop + 1, 36:37] / np.sum(y[start:stop + 1, 31:37], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.2 + 2.2 + 3.2 + 4.2 + 5.1/.2/.3/.4
-                    y[start:stop + 1, 6:7] * (y[start:stop + 1, 8:9] / np.sum(y[start:stop + 1, 7:9], axis=1, keepdims=True)) * (y[start:stop + 1, 9:13] / np.sum(y[start:stop + 1, 9:13], axis=1, keepdims=True)),
-                    # 1.3
-                    y[start:stop + 1, 2:3]
-                ))
-                y[np.isnan(y)] = 0
-                y = np.repeat(y, 2, axis=0)
+            # raw and proc image of a galaxy are consecutive rows; this reshape is a view
+            trainx = np.reshape(images, (2 * images.shape[0], np.prod(images.shape[2:])))
+            if not raw:
+                design = np.empty(trainx.shape, dtype='float32')
+                for ii in range(0, trainx.shape[0], 10000):
+                    design[ii:ii + 10000] = trainx[ii:ii + 10000]
+                trainx = design
+
+        # targets follow the decision tree, see gztargets
+        if which_set == 'test':
+            y = np.zeros((trainx.shape[0], gztargets.n_targets(target_set)), dtype='float32')
+        else:
+            y = np.load(DATA_DIR+'targets.npy', mmap_mode='r')
+            if start is not None:
+                y = y[start:stop + 1]
+            y = gztargets.build_targets(y, target_set)
+            # one row each for the raw and the proc image
+            y = np.repeat(y, 2, axis=0)
 
         if flatgrey:
             super(GZData, self).__init__(X=trainx, y=y)
         else:
-            view = [int(x / self.scale_factor) for x in self.patch_size]
-            view.append(3)
-            view_converter = DefaultViewConverter(view, axes)
+            view_converter = DefaultViewConverter([size, size, 3], axes)
 
             super(GZData, self).__init__(X=trainx, y=y, view_converter=view_converter)
 
-        assert not np.any(np.isnan(self.X))
-
-
-def get_data(tot=True, flatgrey=False):
-    tottrain_path = DATA_DIR+'gz_preprocessed_tottrain' + str(SUBMODEL) + '_64x.pkl'
-    test_path = DATA_DIR+'gz_preprocessed_test' + str(SUBMODEL) + '_64x.pkl'
 
-    if os.path.exists(test_path):
+class AugmentedGalaxyIterator(PrefetchIterator):
+    """
+    Iterates over minibatches of randomly rotated, flipped and shifted galaxies,
+    read as uint8 from the packed (galaxies, raw/proc, h, w, RGB) image store.
+    Galaxies look the same at any orientation, so every minibatch shows new
+    versions of them at no extra memory. For every example, one of the views
+    is picked at random. Fitted preprocessing parameters (GCN + ZCA, see
+    utils.streamprep) are applied to each minibatch. Minibatches are prepared in background threads.
+    """
+    def __init__(self, images, y, batch_size, num_batches, views=(0, 1), max_shift=4, params=None,
+                 rng=None, spaces=None, sources=('features', 'targets'), return_tuple=False,
+                 max_prefetch=4, num_threads=2):
+        self._images = images
+        self._y = y
+        self._views = views
+        self._max_shift = max_shift
+        self._params = params
+        if not hasattr(rng, 'randint'):
+            rng = np.random.RandomState(rng if rng is not None else [2014, 3, 11])
+        # one generator per thread
+        self._seeds = rng.randint(0, 2 ** 31, num_threads)
+        self._num_threads = num_threads
+        space = Conv2DSpace(shape=images.shape[2:4], num_channels=images.shape[4], axes=('b', 0, 1, 'c'))
+        super(AugmentedGalaxyIterator, self).__init__(batch_size, num_batches, space, spaces=spaces, sources=sources,
+                                                      return_tuple=return_tuple, max_prefetch=max_prefetch,
+                                                      num_threads=num_threads)
+
+    def _sample(self, thread):
+        rng = np.random.RandomState(self._seeds[thread])
+        nexamples, size = self._images.shape[0], self._images.shape[2]
+        # output pixel coordinates relative to the image center
+        center = (size - 1) / 2.
+        u = np.arange(size) - center
+        for ii in xrange(thread, self.num_batches, self._num_threads):
+            # sorted indices keep reads from the memmap mostly sequential
+            idx = np.sort(rng.randint(0, nexamples, self.batch_size))
+            full = np.asarray(self._images[idx, rng.choice(self._views, self.batch_size)])
+
+            # random rotation, flip and shift per example, all taken with a single fancy index
+            angle = rng.uniform(0, 2 * np.pi, self.batch_size)[:, None, None]
+            flip = rng.choice([-1, 1], self.batch_size)[:, None, None]
+            shift = rng.randint(-self._max_shift, self._max_shift + 1, (2, self.batch_size))[:, :, None, None]
+            uu = u[None, :, None]
+            vv = u[None, None, :] * flip
+            rows = np.round(center + shift[0] + np.cos(angle) * uu - np.sin(angle) * vv)
+            cols = np.round(center + shift[1] + np.sin(angle) * uu + np.cos(angle) * vv)
+            # pixels from outside the image repeat the border, which is dark background
+            rows = np.clip(rows, 0, size - 1).astype(int)
+            cols = np.clip(cols, 0, size - 1).astype(int)
+            batch = full[np.arange(self.batch_size)[:, None, None], rows, cols]
+
+            X = np.reshape(batch, (self.batch_size, -1)).astype('float32')
+            if self._params is not None:
+                streamprep.apply_params(X, self._params)
+            yield np.reshape(X, batch.shape), np.asarray(self._y[idx], dtype='float32')
+
+
+class GZStream(DenseDesignMatrix):
+    """
+    Galaxy Zoo training set that is iterated over as randomly augmented galaxies
+    (see AugmentedGalaxyIterator), streamed from the image store. Models trained
+    on it take single (size, size, 3) images, like with GZData, and its view
+    converter describes those.
+
+    X is only the raw backing store: the uint8 view of the raw image of every
+    galaxy in the image store, unaugmented and not preprocessed. The iterator
+    samples galaxies, either view, so an epoch has as many examples as there
+    are galaxies, with one row of targets each. Sampling is random with
+    replacement, so only the 'random_uniform' iteration mode is supported
+    (set SGD's train_iteration_mode, and monitor on another data set).
+    """
+    def __init__(self, start=None, stop=None, axes=('c', 0, 1, 'b'), target_set='full', size=64, params=None,
+                 views=(0, 1), max_shift=4):
+        self.patch_size = (gzstore.FULL_SIZE, gzstore.FULL_SIZE)
+        self.scale_factor = gzstore.FULL_SIZE // size
+
+        images = gzstore.load_images('training', size=size)
+        y = np.load(DATA_DIR+'targets.npy', mmap_mode='r')
+        if start is not None:
+            assert start >= 0
+            assert start < stop
+            assert stop <= 61577
+            images = images[start:stop + 1]
+            y = y[start:stop + 1]
+        y = gztargets.build_targets(y, target_set)
+
+        self.images = images
+        self.params = params
+        self.views = views
+        self.max_shift = max_shift
+
+        # one row per galaxy; this reshape is a view
+        X = np.reshape(images[:, 0], (images.shape[0], np.prod(images.shape[2:])))
+        view_converter = DefaultViewConverter([size, size, 3], axes)
+        super(GZStream, self).__init__(X=X, y=y, view_converter=view_converter)
+
+    def iterator(self, mode=None, batch_size=None, num_batches=None, topo=None, targets=None,
+                 rng=None, data_specs=None, return_tuple=False):
+        check_random_mode(mode)
+        flat_space = VectorSpace(int(np.prod(self.images.shape[2:])))
+        spaces, sources = iterator_specs(data_specs, topo, targets, flat_space)
+        if num_batches is None:
+            num_batches = self.images.shape[0] // batch_size
+        return AugmentedGalaxyIterator(self.images, self.y, batch_size, num_batches, views=self.views,
+                                       max_shift=self.max_shift, params=self.params, rng=rng,
+                                       spaces=spaces, sources=sources, return_tuple=return_tuple)
+
+
+def _fit(trainset, config):
+    # GCN + ZCA, by default the same as pylearn2's GlobalContrastNormalization(use_std=True) followed by ZCA()
+    path = gzstore.images_path('training', config.size)
+    return streamprep.cached_fit(trainset.X, path, [(0, trainset.X.shape[0])], DATA_DIR + 'prepcache',
+                                 tag=config.prep_key(), **config.pipeline)
+
+
+def _transform(data, which_set, fit_key, params, config):
+    # memory-maps the preprocessed design, which is written once
+    path = gzstore.images_path(which_set, config.size)
+    design = streamprep.cached_transform(data.X, path, fit_key, params, DATA_DIR + 'prepcache',
+                                         which_set + '_' + config.prep_key())
+    data.X = np.load(design, mmap_mode='r')
+    assert data.X.dtype == np.float32
+    return data
+
+
+def get_stream(config=None, monitor_galaxies=500):
+    """Streaming, augmented training set of an RGB configuration (see
+    gzconfig), and a small preprocessed set of the first monitor_galaxies
+    training galaxies (both images) to monitor training on. GCN + ZCA are
+    fitted on the unaugmented training images, like in get_data, and applied
+    to every training minibatch; they are the trainset's params.
+    """
+    config = config or gzconfig.GZConfig()
+    assert not config.flatgrey
+    print 'fitting preprocessor...'
+    params = _fit(GZData(which_set='training', target_set=config.target_set, size=config.size, raw=True), config)[1]
+    trainset = GZStream(target_set=config.target_set, size=config.size, params=params)
+    monitorset = GZData(which_set='training', start=0, stop=monitor_galaxies - 1, target_set=config.target_set,
+                        size=config.size)
+    streamprep.apply_params(monitorset.X, params)
+    return trainset, monitorset
+
+
+def stream_output(model, params, config, which_set, path, batch_size, block_size=10000):
+    """Output of model for all images of a set (as in GZData), which are
+    read from the image store and preprocessed with params one block at a
+    time, into a float32 .npy memmap at path. Used by streaming
+    configurations, which keep no preprocessed copy of the images.
+    """
+    data = GZData(which_set=which_set, target_set=config.target_set, size=config.size, raw=True)
+    out = None
+    for start in xrange(0, data.X.shape[0], block_size):
+        X = np.asarray(data.X[start:start + block_size], dtype='float32')
+        streamprep.apply_params(X, params)
+        output = inference.get_output(model, DenseDesignMatrix(X=X, view_converter=data.view_converter),
+                                      batch_size=batch_size)
+        if out is None:
+            out = np.lib.format.open_memmap(path, mode='w+', dtype='float32',
+                                            shape=(data.X.shape[0], output.shape[1]))
+        out[start:start + X.shape[0]] = output
+    out.flush()
+    return out
+
+
+def get_data(config=None):
+    """Training and test set of a configuration (see gzconfig), preprocessed
+    with GCN + ZCA fitted on the training set. Fitting streams over the image
+    store in blocks; the parameters and the preprocessed designs are cached
+    (see utils.streamprep) under the configuration's preprocessing key, so
+    later calls only memory-map them, also for configurations that differ in
+    submodel or targets.
+
+    With zca_components, the ZCA is computed from that many leading
+    eigenvectors (randomized), which is much faster for 12288 dimensions.
+    """
+    config = config or gzconfig.GZConfig()
+    print 'preprocessing data...'
+    datasets = []
+    fit_key = params = None
+    for which_set in ('training', 'test'):
+        data = GZData(which_set=which_set, flatgrey=config.flatgrey, target_set=config.target_set, size=config.size,
+                      raw=True)
+        if which_set == 'training':
+            fit_key, params = _fit(data, config)
+        datasets.append(_transform(data, which_set, fit_key, params, config))
+    return datasets[0], datasets[1]
 
-        print 'loading preprocessed data'
-        datasets = OrderedDict()
-        # datasets['train'] = serial.load(train_path)
-        # datasets['valid'] = serial.load(valid_path)
-        if tot:
-            datasets['tottrain'] = serial.load(tottrain_path)
-        datasets['test'] = serial.load(test_path)
-        if tot:
-            return datasets['tottrain'], datasets['test']
-        else:
-            return datasets['train'], datasets['test']
-    else:
-        print 'preprocessing data...'
-        pipeline = preprocessing.Pipeline()
-        pipeline.items.append(preprocessing.GlobalContrastNormalization(use_std=True))
-        pipeline.items.append(preprocessing.ZCA())
-
-        # print 'traindata'
-        # data = GalaxyZoo.gzdeepdata.GZData(which_set='training', start=0, stop=39999)
-        # data.apply_preprocessor(preprocessor=pipeline, can_fit=True)
-        # # this path can be used for visualizing weights after training is done
-        # data.yaml_src = '!pkl: "%s"' % data
-        # # save
-        # data.use_design_loc(DATA_DIR+'train_design' + str(SUBMODEL) + '.npy')
-        # serial.save(DATA_DIR+'gz_preprocessed_train'+str(SUBMODEL) + '.pkl', data)
-
-        # print 'validdata'
-        # data = GalaxyZoo.gzdeepdata.GZData(which_set='training', start=40000, stop=61577)
-        # data.apply_preprocessor(preprocessor=pipeline, can_fit=False)
-        # # this path can be used for visualizing weights after training is done
-        # data.yaml_src = '!pkl: "%s"' % data
-        # # save
-        # data.use_design_loc(DATA_DIR+'valid_design' + str(SUBMODEL) + '.npy')
-        # serial.save(DATA_DIR+'gz_preprocessed_valid'+str(SUBMODEL) + '.pkl', data)
-
-        print 'tottraindata'
-        data = GalaxyZoo.gzdeepdata.GZData(which_set='training', flatgrey=flatgrey)
-        data.apply_preprocessor(preprocessor=pipeline, can_fit=True)
-        # this path can be used for visualizing weights after training is done
-        data.yaml_src = '!pkl: "%s"' % data
-        # save
-        data.use_design_loc(DATA_DIR + 'tottrain_design' + str(SUBMODEL) + '_64x.npy')
-        serial.save(DATA_DIR + 'gz_preprocessed_tottrain' + str(SUBMODEL) + '_64x.pkl', data)
-
-        print 'testdata'
-        data = GalaxyZoo.gzdeepdata.GZData(which_set='test', flatgrey=flatgrey)
-        data.apply_preprocessor(preprocessor=pipeline, can_fit=False)
-        # this path can be used for visualizing weights after training is done
-        data.yaml_src = '!pkl: "%s"' % data
-        # save
-        data.use_design_loc(DATA_DIR + 'test_design' + str(SUBMODEL) + '_64x.npy')
-        serial.save(DATA_DIR + 'gz_preprocessed_test' + str(SUBMODEL) + '_64x.pkl', data)
-
-        print 'Finished, now re-run for running model on GPU'
-        return None, None
 
 if __name__ == '__main__':
     pass
@@ -4,7 +4,7 @@ import os
 import numpy as np
 from theano import function
 from pylearn2.train import Train
-from pylearn2.datasets.transformer_dataset import TransformerDataset
+from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix
 from pylearn2.base import StackedBlocks
 from pylearn2.models.mlp import MLP, Layer, ConvRectifiedLinear, Softmax, Linear, Sigmoid, RectifiedLinear
 import pylearn2.models.autoencoder as autoencoder
@@ -19,17 +19,11 @@ from pylearn2.monitor import Monitor
 from pylearn2.utils import serial
 
 import GalaxyZoo.gzdeepdata
+from GalaxyZoo import gzconfig
+from utils import inference
 
-DATA_DIR = '/home/nico/Data/GalaxyZoo/'
-
-SUBMODEL = 1
-
-if SUBMODEL == 1:
-    nclass = 159
-elif SUBMODEL == 2:
-    nclass = 8
-
-bsize = 120
+# submodel, targets, data and batch size, see gzconfig
+CONFIG = gzconfig.DAEX
 
 
 def construct_ae(structure):
@@ -79,6 +73,44 @@ def get_ae_pretrainer(layer, data, batch_size, epochs=30):
                              LinearDecayOverEpoch(start=1, saturate=25, decay_factor=.02)])
 
 
+def encode_dataset(layer, data, path, batch_size=1000):
+    """Encodes data through a trained autoencoder layer once, in batches, into
+    a float32 .npy memmap at path. Returns it as a data set.
+    """
+    Xb = layer.get_input_space().make_theano_batch()
+    encode = function([Xb], layer.encode(Xb), allow_input_downcast=True)
+    out = np.lib.format.open_memmap(path, mode='w+', dtype='float32', shape=(data.X.shape[0], layer.nhid))
+    for start in xrange(0, data.X.shape[0], batch_size):
+        out[start:start + batch_size] = encode(np.asarray(data.X[start:start + batch_size], dtype='float32'))
+    out.flush()
+    del out
+    return DenseDesignMatrix(X=np.load(path, mmap_mode='r'))
+
+
+def pretrain(stack, trainset, batch_size, codes_path, epochs=30):
+    """Greedy layer-wise pretraining. Once a layer is trained, the data are
+    encoded through it once and cached as a memory-mapped array (at codes_path
+    % layer index), on which the next layer is trained, instead of re-encoding
+    every minibatch through all lower layers. Only the codes of the current
+    layer are kept on disk.
+    """
+    data = trainset
+    prevpath = None
+    for ii, layer in enumerate(stack.layers()):
+        pretrainer = get_ae_pretrainer(layer, data, batch_size, epochs=epochs)
+        pretrainer.main_loop()
+        if ii < len(stack.layers()) - 1:
+            path = codes_path % ii
+            data = encode_dataset(layer, data, path)
+            if prevpath is not None:
+                os.remove(prevpath)
+            prevpath = path
+    if prevpath is not None:
+        del data
+        os.remove(prevpath)
+    return stack
+
+
 def construct_dbn_from_stack(stack):
     # some settings
     irange = 0.05
@@ -91,10 +123,9 @@ def construct_dbn_from_stack(stack):
             irange=irange,
             max_col_norm=2.
         ))
-    nc = 159 if SUBMODEL == 1 else 8
     # softmax layer at then end for classification
     layers.append(Softmax(
-        n_classes=nc,
+        n_classes=CONFIG.nclass,
         layer_name='y',
         irange=irange
     ))
@@ -116,61 +147,34 @@ def get_finetuner(model, trainset, batch_size=100, epochs=100):
         cost=Dropout(input_include_probs={'h0': .5}, input_scales={'h0': 2.}),
         termination_criterion=EpochCounter(epochs)
     )
-    path = DATA_DIR+'model' + str(SUBMODEL) + 'saved_daex.pkl'
+    path = CONFIG.model_path('daex')
     return Train(model=model, algorithm=train_algo, dataset=trainset, save_path=path, save_freq=10,
                  extensions=[MomentumAdjustor(final_momentum=0.9, start=0, saturate=int(epochs*0.8)),
                              LinearDecayOverEpoch(start=1, saturate=int(epochs*0.7), decay_factor=.02)])
 
 
-def get_output(model, tdata, batch_size=bsize / 2):
-    # get output submodel classifiers
-    Xb = model.get_input_space().make_theano_batch()
-    Yb = model.fprop(Xb)
-
-    propagate = function([Xb], Yb)
-
-    data = tdata.X
-    # fill up with zeroes for dividible by batch number
-    extralength = batch_size - data.shape[0] % batch_size
-
-    output = []
-    for ii in range(int(data.shape[0] / batch_size) + 1):
-        seldata = data[ii * batch_size:min((ii+1) * batch_size, data.shape[0]), :]
-        if ii == int(data.shape[0] / batch_size) and extralength < batch_size:
-            seldata = np.concatenate((seldata, np.zeros([extralength, data.shape[1]],
-                                                        dtype='float32')), axis=0)
-        output.append(propagate(seldata))
-
-    output = np.reshape(output, (len(output) * output[0].shape[0], -1))
-
-    if extralength < batch_size:
-        # remove the filler
-        output = output[:-extralength, :]
-
-    return output
-
-
 if __name__ == '__main__':
 
-    trainset, testset = GalaxyZoo.gzdeepdata.get_data(flatgrey=True)
+    trainset, testset = GalaxyZoo.gzdeepdata.get_data(CONFIG)
 
     structure = [4096, 3000, 2000, 2000, 2000, 2000]
 
-    # pre-train model
-    # stack = construct_ae(structure)
-    # for ii, layer in enumerate(stack.layers()):
-    #     utraindata = trainset if ii == 0 else TransformerDataset(raw=trainset,
-    #                                                              transformer=StackedBlocks(stack.layers()[:ii]))
-    #     pretrainer = get_ae_pretrainer(layer, utraindata, bsize, epochs=30)
-    #     pretrainer.main_loop()
-    # serial.save(DATA_DIR+'daex_pretrained.pkl', stack)
-    stack = serial.load(DATA_DIR + 'daex_pretrained.pkl')
+    # pre-train model, unless it was pretrained before; it does not depend on submodel and targets
+    pretraining = {'structure': structure, 'batch_size': CONFIG.batch_size, 'epochs': 30}
+    path = CONFIG.shared_model_path('daex_pretrained', **pretraining)
+    if os.path.exists(path):
+        stack = serial.load(path)
+    else:
+        stack = pretrain(construct_ae(structure), trainset, CONFIG.batch_size,
+                         CONFIG.shared_output_path('daex_codes%d', 'train', **pretraining),
+                         epochs=pretraining['epochs'])
+        serial.save(path, stack)
 
     # construct DBN
     dbn = construct_dbn_from_stack(stack)
 
     # finetune softmax layer a bit
-    finetuner = get_finetuner(dbn, trainset, bsize, epochs=15)
+    finetuner = get_finetuner(dbn, trainset, CONFIG.batch_size, epochs=15)
     finetuner.main_loop()
 
     # now finetune layer-by-layer, boost earlier layers
@@ -180,20 +184,20 @@ if __name__ == '__main__':
         # set lr to boosted value for current layer
         dbn.layers[ii].W_lr_scale = lr
 
-        finetuner = get_finetuner(dbn, trainset, bsize, epochs=30)
+        finetuner = get_finetuner(dbn, trainset, CONFIG.batch_size, epochs=30)
         finetuner.main_loop()
 
         # return to original lr
         dbn.layers[ii].W_lr_scale = 1.
 
     # total finetuner
-    # dbn = serial.load(DATA_DIR + 'model' + str(SUBMODEL) + 'saved_daex.pkl')
+    # dbn = serial.load(CONFIG.model_path('daex'))
     dbn.monitor = Monitor(dbn)
-    finetuner = get_finetuner(dbn, trainset, bsize, epochs=150)
+    finetuner = get_finetuner(dbn, trainset, CONFIG.batch_size, epochs=150)
     finetuner.main_loop()
 
-    outtrainset = get_output(dbn, trainset)
-    np.save(DATA_DIR+'feats_daex_train' + str(SUBMODEL) + '.npy', outtrainset)
+    outtrainset = inference.get_output(dbn, trainset, batch_size=CONFIG.batch_size / 2)
+    np.save(CONFIG.output_path('feats_daex', 'train'), outtrainset)
 
-    outtestset = get_output(dbn, testset)
-    np.save(DATA_DIR+'feats_daex_test' + str(SUBMODEL) + '.npy', outtestset)
+    outtestset = inference.get_output(dbn, testset, batch_size=CONFIG.batch_size / 2)
+    np.save(CONFIG.output_path('feats_daex', 'test'), outtestset)
@@ -3,7 +3,6 @@
 import os
 import math
 import numpy as np
-from theano import function
 from pylearn2.train import Train
 from pylearn2.models.mlp import MLP, Layer, ConvRectifiedLinear, Softmax, RectifiedLinear
 from pylearn2.space import Conv2DSpace
@@ -15,17 +14,11 @@ from pylearn2.monitor import Monitor
 from pylearn2.utils import serial
 
 import GalaxyZoo.gzdeepdata
+from GalaxyZoo import gzconfig
+from utils import inference
 
-DATA_DIR = '/home/nico/Data/GalaxyZoo/'
-
-SUBMODEL = 1
-
-if SUBMODEL == 1:
-    nclass = 15
-elif SUBMODEL == 2:
-    nclass = 8
-
-bsize = 100
+# submodel, targets, data and batch size, see gzconfig
+CONFIG = gzconfig.CONV
 
 import theano.tensor as T
 from pylearn2.utils import wraps
@@ -41,7 +34,7 @@ class SoftmaxRMSE(Softmax):
 
 def get_conv1(dim_input):
     config = {
-        'batch_size': bsize,
+        'batch_size': CONFIG.batch_size,
         'input_space': Conv2DSpace(shape=dim_input[:2], num_channels=dim_input[2], axes=['c', 0, 1, 'b']),
         'layers': [
         ConvRectifiedLinear(layer_name='h0', output_channels=20, irange=.005, max_kernel_norm=.9,
@@ -51,7 +44,7 @@ def get_conv1(dim_input):
         ConvRectifiedLinear(layer_name='h2', output_channels=80, irange=.005, max_kernel_norm=0.9,
                             kernel_shape=[5, 5], pool_shape=[2, 2], pool_stride=[2, 2], W_lr_scale=.1, b_lr_scale=.1),
         RectifiedLinear(layer_name='h3', irange=.005, dim=500, max_col_norm=1.9),
-        Softmax(layer_name='y', n_classes=nclass, irange=.005, max_col_norm=1.9)
+        Softmax(layer_name='y', n_classes=CONFIG.nclass, irange=.005, max_col_norm=1.9)
         ]
     }
     return MLP(**config)
@@ -59,7 +52,7 @@ def get_conv1(dim_input):
 
 def get_conv2(dim_input):
     config = {
-        'batch_size': bsize,
+        'batch_size': CONFIG.batch_size,
         'input_space': Conv2DSpace(shape=dim_input[:2], num_channels=dim_input[2], axes=['c', 0, 1, 'b']),
         'layers': [
         ConvRectifiedLinear(layer_name='h0', output_channels=20, irange=.005, max_kernel_norm=.9,
@@ -69,100 +62,86 @@ def get_conv2(dim_input):
         ConvRectifiedLinear(layer_name='h2', output_channels=80, irange=.005, max_kernel_norm=0.9,
                             kernel_shape=[5, 5], pool_shape=[2, 2], pool_stride=[2, 2], W_lr_scale=.1, b_lr_scale=.1),
         RectifiedLinear(layer_name='h3', irange=.005, dim=500, max_col_norm=1.9),
-        Softmax(layer_name='y', n_classes=nclass, irange=.005, max_col_norm=1.9)
+        Softmax(layer_name='y', n_classes=CONFIG.nclass, irange=.005, max_col_norm=1.9)
         ]
     }
     return MLP(**config)
 
 
-def get_trainer1(model, trainset, epochs=50):
+def get_trainer1(model, trainset, monitorset, epochs=50):
     train_algo = SGD(
-        batch_size=bsize,
+        batch_size=CONFIG.batch_size,
         learning_rate=0.5,
         learning_rule=Momentum(init_momentum=0.5),
-        monitoring_batches=bsize,
-        monitoring_dataset=trainset,
+        # a streamed training set is sampled randomly and monitored on a small set of its own
+        train_iteration_mode='random_uniform' if CONFIG.stream else None,
+        monitoring_batches=None if CONFIG.stream else CONFIG.batch_size,
+        monitoring_dataset=monitorset,
         cost=Dropout(input_include_probs={'h0': .8}, input_scales={'h0': 1.}),
         termination_criterion=EpochCounter(epochs),
     )
-    path = DATA_DIR + 'model1saved_conv.pkl'
+    path = CONFIG.model_path('conv')
     return Train(model=model, algorithm=train_algo, dataset=trainset, save_path=path, save_freq=1,
                  extensions=[MomentumAdjustor(final_momentum=0.7, start=0, saturate=int(epochs*0.4)),
                              LinearDecayOverEpoch(start=1, saturate=int(epochs*0.7), decay_factor=.01)])
 
 
-def get_trainer2(model, trainset, epochs=50):
+def get_trainer2(model, trainset, monitorset, epochs=50):
     train_algo = SGD(
-        batch_size=bsize,
+        batch_size=CONFIG.batch_size,
         learning_rate=0.5,
         learning_rule=Momentum(init_momentum=0.5),
-        monitoring_batches=bsize,
-        monitoring_dataset=trainset,
+        # a streamed training set is sampled randomly and monitored on a small set of its own
+        train_iteration_mode='random_uniform' if CONFIG.stream else None,
+        monitoring_batches=None if CONFIG.stream else CONFIG.batch_size,
+        monitoring_dataset=monitorset,
         cost=Dropout(input_include_probs={'h0': .8}, input_scales={'h0': 1.}),
         termination_criterion=EpochCounter(epochs),
     )
-    path = DATA_DIR + 'model2saved_conv.pkl'
+    path = CONFIG.model_path('conv')
     return Train(model=model, algorithm=train_algo, dataset=trainset, save_path=path, save_freq=1,
                  extensions=[MomentumAdjustor(final_momentum=0.7, start=0, saturate=int(epochs*0.5)),
                              LinearDecayOverEpoch(start=1, saturate=int(epochs*0.8), decay_factor=.01)])
 
 
-def get_output(model, tdata, batch_size=bsize / 2):
-    # get output submodel classifiers
-    Xb = model.get_input_space().make_theano_batch()
-    Yb = model.fprop(Xb)
-
-    propagate = function([Xb], Yb)
-
-    data = tdata.get_topological_view()
-    # fill up with zeroes for dividible by batch number
-    extralength = batch_size - data.shape[3] % batch_size
-
-    output = []
-    for ii in range(int(data.shape[3] / batch_size) + 1):
-        seldata = data[:, :, :, ii * batch_size:min((ii+1) * batch_size, data.shape[3])]
-        if ii == int(data.shape[3] / batch_size) and extralength < batch_size:
-            seldata = np.concatenate((seldata, np.zeros([data.shape[0], data.shape[1], data.shape[2], extralength],
-                                                        dtype='float32')), axis=3)
-        output.append(propagate(seldata))
-
-    output = np.reshape(output, (len(output) * output[0].shape[0], -1))
-
-    if extralength < batch_size:
-        # remove the filler
-        output = output[:-extralength, :]
-
-    return output
-
-
 if __name__ == '__main__':
 
-    trainset, testset = GalaxyZoo.gzdeepdata.get_data()
+    if CONFIG.stream:
+        trainset, monitorset = GalaxyZoo.gzdeepdata.get_stream(CONFIG)
+    else:
+        trainset, testset = GalaxyZoo.gzdeepdata.get_data(CONFIG)
+        monitorset = trainset
+    dim_input = [CONFIG.size, CONFIG.size, 3]
 
     # build and train classifiers for submodels
-    if SUBMODEL == 1:
+    if CONFIG.submodel == 1:
         iters = 100
-        if os.path.exists(DATA_DIR + 'model1saved_conv.pkl'):
-            model = serial.load(DATA_DIR + 'model1saved_conv.pkl')
+        if os.path.exists(CONFIG.model_path('conv')):
+            model = serial.load(CONFIG.model_path('conv'))
             iters = 1
             # reset monitor, can't be re-used
             model.monitor = Monitor(model)
         else:
-            model = get_conv2([64, 64, 3])
-        get_trainer1(model, trainset, iters).main_loop()
-    elif SUBMODEL == 2:
+            model = get_conv2(dim_input)
+        get_trainer1(model, trainset, monitorset, iters).main_loop()
+    elif CONFIG.submodel == 2:
         iters = 50
-        if os.path.exists(DATA_DIR + 'model2saved_conv.pkl'):
-            model = serial.load(DATA_DIR + 'model2saved_conv.pkl')
+        if os.path.exists(CONFIG.model_path('conv')):
+            model = serial.load(CONFIG.model_path('conv'))
             iters = 1
             # reset monitor, can't be re-used
             model.monitor = Monitor(model)
         else:
-            model = get_conv2([64, 64, 3])
-        get_trainer2(model, trainset, iters).main_loop()
-
-    outtrainset = get_output(model, trainset)
-    np.save(DATA_DIR+'feats_conv_train' + str(SUBMODEL) + '.npy', outtrainset)
-
-    outtestset = get_output(model, testset)
-    np.save(DATA_DIR+'feats_conv_test' + str(SUBMODEL) + '.npy', outtestset)
+            model = get_conv2(dim_input)
+        get_trainer2(model, trainset, monitorset, iters).main_loop()
+
+    if CONFIG.stream:
+        for which_set, name in (('training', 'train'), ('test', 'test')):
+            GalaxyZoo.gzdeepdata.stream_output(model, trainset.params, CONFIG, which_set,
+                                               CONFIG.output_path('feats_conv', name), CONFIG.batch_size / 2)
+    else:
+        outtrainset = inference.get_output(model, trainset, batch_size=CONFIG.batch_size / 2)
+        np.save(CONFIG.output_path('feats_conv', 'train'), outtrainset)
+
+        outtestset = inference.get_output(model, testset, batch_size=CONFIG.batch_size / 2)
+        np.save(CONFIG.output_path('feats_conv', 'test'), outtestset)
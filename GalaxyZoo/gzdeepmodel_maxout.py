@@ -2,7 +2,6 @@
 
 import os
 import numpy as np
-from theano import function
 from pylearn2.train import Train
 from pylearn2.models.maxout import MaxoutConvC01B, Maxout
 from pylearn2.models.mlp import MLP, Layer, Softmax
@@ -15,17 +14,11 @@ from pylearn2.monitor import Monitor
 from pylearn2.utils import serial
 
 import GalaxyZoo.gzdeepdata
+from GalaxyZoo import gzconfig
+from utils import inference
 
-DATA_DIR = '/home/nico/Data/GalaxyZoo/'
-
-SUBMODEL = 1
-
-if SUBMODEL == 1:
-    nclass = 159
-elif SUBMODEL == 2:
-    nclass = 8
-
-bsize = 50
+# submodel, targets, data and batch size, see gzconfig
+CONFIG = gzconfig.MAXOUT
 
 import theano.tensor as T
 from pylearn2.utils import wraps
@@ -41,7 +34,7 @@ class SoftmaxRMSE(Softmax):
 
 def get_maxout(dim_input):
     config = {
-        'batch_size': bsize,
+        'batch_size': CONFIG.batch_size,
         'input_space': Conv2DSpace(shape=dim_input[:2], num_channels=dim_input[2], axes=['c', 0, 1, 'b']),
         'layers': [
         MaxoutConvC01B(layer_name='h0', num_channels=96, num_pieces=2, irange=.005, tied_b=1, max_kernel_norm=.9,
@@ -53,7 +46,7 @@ def get_maxout(dim_input):
         MaxoutConvC01B(layer_name='h3', num_channels=192, num_pieces=4, irange=.005, tied_b=1, max_kernel_norm=0.9,
                        kernel_shape=[5, 5], pad=1, pool_shape=[2, 2], pool_stride=[2, 2], W_lr_scale=.05, b_lr_scale=.05),
         Maxout(layer_name='h4', irange=.005, num_units=500, num_pieces=5, max_col_norm=1.9),
-        Softmax(layer_name='y', n_classes=nclass, irange=.005, max_col_norm=1.9)
+        Softmax(layer_name='y', n_classes=CONFIG.nclass, irange=.005, max_col_norm=1.9)
         ]
     }
     return MLP(**config)
@@ -61,65 +54,47 @@ def get_maxout(dim_input):
 
 def get_trainer(model, trainset, epochs=50):
     train_algo = SGD(
-        batch_size=bsize,
+        batch_size=CONFIG.batch_size,
         learning_rate=0.15,
         learning_rule=Momentum(init_momentum=0.5),
+        # a streamed training set is sampled randomly
+        train_iteration_mode='random_uniform' if CONFIG.stream else None,
         # monitoring_batches=100,
         # monitoring_dataset=trainset,
         cost=Dropout(input_include_probs={'h0': .8}, input_scales={'h0': 1.}),
         termination_criterion=EpochCounter(epochs),
     )
-    path = DATA_DIR + 'model' + str(SUBMODEL) + 'saved_maxoutx.pkl'
+    path = CONFIG.model_path('maxoutx')
     return Train(model=model, algorithm=train_algo, dataset=trainset, save_path=path, save_freq=1,
                  extensions=[MomentumAdjustor(final_momentum=0.7, start=0, saturate=int(epochs*0.4)),
                              LinearDecayOverEpoch(start=1, saturate=int(epochs*0.7), decay_factor=.01)])
 
 
-def get_output(model, tdata, batch_size=bsize / 2):
-    # get output submodel classifiers
-    Xb = model.get_input_space().make_theano_batch()
-    Yb = model.fprop(Xb)
-
-    propagate = function([Xb], Yb)
-
-    data = tdata.get_topological_view()
-    # fill up with zeroes for dividible by batch number
-    extralength = batch_size - data.shape[3] % batch_size
-
-    output = []
-    for ii in range(int(data.shape[3] / batch_size) + 1):
-        seldata = data[:, :, :, ii * batch_size:min((ii+1) * batch_size, data.shape[3])]
-        if ii == int(data.shape[3] / batch_size) and extralength < batch_size:
-            seldata = np.concatenate((seldata, np.zeros([data.shape[0], data.shape[1], data.shape[2], extralength],
-                                                        dtype='float32')), axis=3)
-        output.append(propagate(seldata))
-
-    output = np.reshape(output, (len(output) * output[0].shape[0], -1))
-
-    if extralength < batch_size:
-        # remove the filler
-        output = output[:-extralength, :]
-
-    return output
-
-
 if __name__ == '__main__':
 
-    trainset, testset = GalaxyZoo.gzdeepdata.get_data()
+    if CONFIG.stream:
+        trainset = GalaxyZoo.gzdeepdata.get_stream(CONFIG)[0]
+    else:
+        trainset, testset = GalaxyZoo.gzdeepdata.get_data(CONFIG)
 
     # build and train classifiers for submodels
-    iters = 100 if SUBMODEL == 1 else 50
-    if os.path.exists(DATA_DIR + 'model' + str(SUBMODEL) + 'saved_maxoutx.pkl'):
-        model = serial.load(DATA_DIR + 'model' + str(SUBMODEL) + 'saved_maxoutx.pkl')
+    iters = 100 if CONFIG.submodel == 1 else 50
+    if os.path.exists(CONFIG.model_path('maxoutx')):
+        model = serial.load(CONFIG.model_path('maxoutx'))
         iters = 1
         # reset monitor, can't be re-used
         model.monitor = Monitor(model)
     else:
-        model = get_maxout([64, 64, 3])
+        model = get_maxout([CONFIG.size, CONFIG.size, 3])
     get_trainer(model, trainset, iters).main_loop()
 
-    outtrainset = get_output(model, trainset)
-    np.save(DATA_DIR+'feats_maxoutx_train' + str(SUBMODEL) + '.npy', outtrainset)
+    if CONFIG.stream:
+        for which_set, name in (('training', 'train'), ('test', 'test')):
+            GalaxyZoo.gzdeepdata.stream_output(model, trainset.params, CONFIG, which_set,
+                                               CONFIG.output_path('feats_maxoutx', name), CONFIG.batch_size / 2)
+    else:
+        outtrainset = inference.get_output(model, trainset, batch_size=CONFIG.batch_size / 2)
+        np.save(CONFIG.output_path('feats_maxoutx', 'train'), outtrainset)
 
-    outtestset = get_output(model, testset)
-    np.save(DATA_DIR+'feats_maxoutx_test' + str(SUBMODEL) + '.npy', outtestset)
+        outtestset = inference.get_output(model, testset, batch_size=CONFIG.batch_size / 2)
+        np.save(CONFIG.output_path('feats_maxoutx', 'test'), outtestset)
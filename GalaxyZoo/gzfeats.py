@@ -0,0 +1,145 @@
+#!/usr/bin/python2
+
+"""
+Hand-crafted image features for the hybrid model, computed for batches
+
+Images are stacked into (images, h, w) arrays, so that every feature is one
+reduction over the whole batch: the moments of all cross-sections and
+squares come from utils.moments. The spiral arm counts are those of the
+original counter (see count_arms).
+
+The circles are the same for every image of a size, so their flat pixel
+indices are computed once (see polar_index); all circles of a batch are then
+sampled by a single take on the flattened images, and their moments are
+segmented reductions over the samples.
+"""
+
+import cv2
+import numpy as np
+
+from utils import moments
+
+MOMENTS = ('mean', 'std', 'skew', 'kurtosis')
+# radii of the circles used for the radial profiles and spiral arm counts
+RADII = (5, 10, 15, 20, 30, 40, 50)
+# colors, cross-sections and mean intensity, square ratios, circle moments and arm counts
+N_FEATURES = 3 + 11 * len(MOMENTS) + len(MOMENTS) + (len(MOMENTS) + 1) * len(RADII)
+
+
+def _moments(X):
+    # (images, samples, k) -> (images, len(MOMENTS), k)
+    return np.reshape(moments.summary_stats(X, MOMENTS), (X.shape[0], len(MOMENTS), X.shape[2]))
+
+
+# cached polar_index results, per image size and radii
+_polar_indices = {}
+
+
+def polar_index(w, h, radii=RADII):
+    """Flat pixel indices into (w, h) images of the circles at radii, and the
+    offsets at which each circle starts. Every circle is the left half
+    circle around the center, sampled at 5 * r angles in order; like the
+    original per-image code, coordinates are truncated and wrap around.
+    """
+    key = (w, h, tuple(radii))
+    if key not in _polar_indices:
+        index = []
+        for r in radii:
+            theta = np.linspace(0.5 * np.pi, 1.5 * np.pi, 5 * r)
+            x = np.fix(r * np.cos(theta) - int(w / 2)).astype(int) % w
+            y = np.fix(r * np.sin(theta) - int(h / 2)).astype(int) % h
+            index.append(x * h + y)
+        offsets = np.cumsum([0] + [len(ind) for ind in index[:-1]])
+        index = np.concatenate(index)
+        # shared by all callers
+        index.flags.writeable = False
+        offsets.flags.writeable = False
+        _polar_indices[key] = index, offsets
+    return _polar_indices[key]
+
+
+def _segment_moments(X, offsets):
+    # moments of the segments of the rows of X that start at offsets, same
+    # conventions as utils.moments -> (images, len(MOMENTS), segments)
+    X = np.asarray(X, dtype='float64')
+    lengths = np.diff(np.append(offsets, X.shape[1]))
+    mean = np.add.reduceat(X, offsets, axis=1) / lengths
+    dev = X - np.repeat(mean, lengths, axis=1)
+    dev2 = dev ** 2
+    m2 = np.add.reduceat(dev2, offsets, axis=1) / lengths
+    m3 = np.add.reduceat(dev2 * dev, offsets, axis=1) / lengths
+    m4 = np.add.reduceat(dev2 ** 2, offsets, axis=1) / lengths
+    zero = m2 == 0
+    m2nz = np.where(zero, 1., m2)
+    skew = np.where(zero, 0., m3 / m2nz ** 1.5)
+    kurtosis = np.where(zero, -3., m4 / m2nz ** 2 - 3.)
+    return np.concatenate([stat[:, None, :] for stat in (mean, np.sqrt(m2), skew, kurtosis)], axis=1)
+
+
+def grey_images(images):
+    """(images, h, w, 3) RGB uint8 -> (images, h, w) uint8, slightly blurred
+    to decrease noise
+    """
+    grey = np.empty(images.shape[:3], dtype=np.uint8)
+    for ii in range(images.shape[0]):
+        grey[ii] = cv2.GaussianBlur(cv2.cvtColor(np.ascontiguousarray(images[ii]), cv2.COLOR_RGB2GRAY), (3, 3), 0)
+    return grey
+
+
+def color_features(images):
+    """Mean of every color channel relative to the mean intensity, in BGR order
+    """
+    images = np.asarray(images, dtype='float64')
+    channels = images.reshape((images.shape[0], -1, 3)).mean(axis=1)
+    return channels[:, ::-1] - channels.mean(axis=1, keepdims=True)
+
+
+def count_arms(circles):
+    """Number of spiral arms for every row of circles, as the original
+    per-image counter computed it. Its peak/trough state machine starts in a
+    state from which no peak or trough is ever counted, so the count is
+    always 0. It is kept that way, so that the features stay the same as
+    those the models were trained on.
+    """
+    return np.zeros(np.shape(circles)[0], dtype=int)
+
+
+def grey_features(grey):
+    """Features of a (images, h, w) stack of grayscale images, one row per image
+    """
+    grey = np.asarray(grey)
+    nimages, w, h = grey.shape
+    feats = []
+
+    # 4 moments at various vertical and horizontal cross-sections, each preceded by the mean intensity
+    pos = [int(w * 1/3), int(w * 2/5), int(w * 1/2), int(w * 3/5), int(w * 2/3)]
+    sections = np.concatenate((grey[:, :, pos], np.transpose(grey[:, pos, :], (0, 2, 1))), axis=2)
+    meanint = np.reshape(np.mean(grey, axis=(1, 2)), (-1, 1, 1))
+    stats = np.concatenate((np.repeat(meanint, len(MOMENTS), axis=1), _moments(sections)), axis=2)
+    feats.append(np.reshape(stats, (nimages, -1)))
+
+    # intensity ratio = ratio between 4 moments of intensity in small center square divided by
+    # 4 moments of intensity in bigger center square
+    small = grey[:, int(w * 2/5):int(w * 3/5), int(w * 2/5):int(w * 3/5)].reshape((nimages, -1, 1))
+    big = grey[:, int(w * 1/4):int(w * 3/4), int(w * 1/4):int(w * 3/4)].reshape((nimages, -1, 1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = np.clip(_moments(small)[:, :, 0] / _moments(big)[:, :, 0], 0., 10.)
+    ratio[np.isnan(ratio)] = 10.
+    feats.append(ratio)
+
+    # circles of pixels at various radii, 4 moments per circle
+    index, offsets = polar_index(w, h)
+    samples = np.take(np.reshape(grey, (nimages, -1)), index, axis=1)
+    feats.append(np.reshape(np.transpose(_segment_moments(samples, offsets), (0, 2, 1)), (nimages, -1)))
+
+    # number of peaks and troughs on every circle
+    circles = np.split(samples, offsets[1:], axis=1)
+    feats.append(np.column_stack([count_arms(c) for c in circles]))
+
+    return np.hstack(feats)
+
+
+def extra_features(images):
+    """Features of a (images, h, w, 3) stack of RGB images
+    """
+    return np.hstack((color_features(images), grey_features(grey_images(images))))
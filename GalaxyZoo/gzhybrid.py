@@ -2,8 +2,8 @@
 
 import os
 import math
-import cv2
-import scipy.stats
+import time
+import multiprocessing
 import tqdm
 import numpy as np
 import pandas as pd
@@ -11,111 +11,83 @@ import matplotlib.pyplot as plt
 from sklearn import cross_validation, ensemble, metrics, decomposition, preprocessing, linear_model, naive_bayes
 from sklearn.pipeline import Pipeline
 
-DATA_DIR = '/home/nico/Data/GalaxyZoo/'
-
-
-def extra_feats():
-    filenumbers = np.load(os.path.join(DATA_DIR, 'filenumbers.npy'))
-
-    for id, dr in enumerate(['images_training_proc', 'images_test_proc']):
-        xfeats = []
-        for ii, fn in tqdm.tqdm(enumerate(filenumbers[id])):
-            for itype in ('raw', 'proc'):
-                # only for training do we actually use the raw data
-                if not (itype == 'raw' and id == 1):
-                    curfeats = []
-                    im = cv2.imread(os.path.join(DATA_DIR, dr, str(fn) + '_' + itype + '.png'))
-
-                    # RGB
-                    meanint = np.mean(im)
-                    for cid in range(3):
-                        curfeats.append(np.mean(im[:, :, cid]) - meanint)
-
-                    # do rest on grayscale
-                    im = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
-                    # blur a bit to decrease noise
-                    im = cv2.GaussianBlur(im, (3, 3), 0)
-                    w, h = im.shape
-
-                    # 4 moments at various horizontal and vertical cross-sections
-                    for func in (np.mean, np.std, scipy.stats.skew, scipy.stats.kurtosis):
-                        curfeats.append(np.mean(np.ravel(im)))
-                        curfeats.append(func(im[:, int(w * 1/3)]))
-                        curfeats.append(func(im[:, int(w * 2/5)]))
-                        curfeats.append(func(im[:, int(w * 1/2)]))
-                        curfeats.append(func(im[:, int(w * 3/5)]))
-                        curfeats.append(func(im[:, int(w * 2/3)]))
-                        curfeats.append(func(im[int(w * 1/3), :]))
-                        curfeats.append(func(im[int(w * 2/5), :]))
-                        curfeats.append(func(im[int(w * 1/2), :]))
-                        curfeats.append(func(im[int(w * 3/5), :]))
-                        curfeats.append(func(im[int(w * 2/3), :]))
-
-                    # intensity ratio = ratio between 4 moments of intensity in small center square divided by
-                    # 4 moments of intensity in bigger center square
-                    for func in (np.mean, np.std, scipy.stats.skew, scipy.stats.kurtosis):
-                        ratio = func(np.ravel(im[int(w * 2/5):int(w * 3/5), int(w * 2/5):int(w * 3/5)])) / \
-                                func(np.ravel(im[int(w * 1/4):int(w * 3/4), int(w * 1/4):int(w * 3/4)]))
-                        ratio = np.clip(ratio, 0., 10.)
-                        if np.isnan(ratio):
-                            ratio = 10.
-                        curfeats.append(ratio)
-
-                    # circle of pixels at various radii
-                    circles = []
-                    for r in (5, 10, 15, 20, 30, 40, 50):
-                        theta = np.linspace(0.5 * np.pi, 1.5 * np.pi, 5 * r)
-                        xy = list(set([xy for xy in zip((r * np.cos(theta) - int(w/2)),
-                                                        (r * np.sin(theta) - int(h/2)))]))
-                        circles.append([im[int(x), int(y)] for (x, y) in xy])
-                        for func in (np.mean, np.std, scipy.stats.skew, scipy.stats.kurtosis):
-                            curfeats.append(func(circles[-1]))
-
-                    # now count how many peaks and throughs we see in that matrix
-                    # this is useful for determining no. of spiral arms and tightness of spiral
-                    for c in circles:
-                        # smooth out a bit
-                        for ii, el in enumerate(c):
-                            if ii == 0:
-                                c[ii] = np.mean(c[:2] + [c[-1]])
-                            elif ii == len(c) - 1:
-                                c[ii] = np.mean(c[ii-1:] + [c[0]])
-                            else:
-                                c[ii] = np.mean(c[ii-1:ii+2])
-
-                        nc = (c - np.mean(c)) / np.std(c)
-
-                        inpeak = False
-                        peakcntr = 0
-                        intrough = True
-                        troughcntr = 0
-                        lastx = 0
-                        for el in nc:
-                            if el < -1.5:
-                                intrough = True
-                            else:
-                                if intrough and lastx == 2:
-                                    troughcntr += 1
-                                    lastx = 1
-                                intrough = False
-                            if el > 1.5:
-                                inpeak = True
-                            else:
-                                if inpeak and lastx == 1:
-                                    peakcntr += 1
-                                    lastx = 2
-                                inpeak = False
-
-                        curfeats.append(min(troughcntr, peakcntr))
-
-                    xfeats.append(curfeats)
-
-        if id == 0:
-            np.save(os.path.join(DATA_DIR, 'xfeats_train.npy'), np.array(xfeats))
-        elif id == 1:
-            np.save(os.path.join(DATA_DIR, 'xfeats_test.npy'), np.array(xfeats))
-    print("Extra features generated")
-    return
+from GalaxyZoo import gzconfig, gzstore, gzfeats, gzprep
+from GalaxyZoo.gzconfig import DATA_DIR
+
+
+# image stores and feature memmaps of this worker process, which_set -> (images, xfeats)
+_outputs = {}
+
+
+def _xfeats_paths(which_set):
+    base = os.path.join(DATA_DIR, {'training': 'xfeats_train', 'test': 'xfeats_test'}[which_set])
+    return base + '.npy', base + '_done.npy'
+
+
+def _xfeats_shard(args):
+    which_set, shard, start, stop = args
+    if which_set not in _outputs:
+        _outputs[which_set] = gzstore.load_images(which_set), np.load(_xfeats_paths(which_set)[0], mmap_mode='r+')
+    images, xfeats = _outputs[which_set]
+    if which_set == 'training':
+        # raw and proc image of a galaxy are consecutive rows
+        xfeats[2 * start:2 * stop] = gzfeats.extra_features(np.reshape(images[start:stop], (-1,) + images.shape[2:]))
+    else:
+        xfeats[start:stop] = gzfeats.extra_features(images[start:stop, 1])
+    xfeats.flush()
+    return which_set, shard, stop - start
+
+
+def extra_feats(n_jobs=None, shard_size=500):
+    """Computes the extra features of the image stores in a process pool. Every
+    shard of shard_size galaxies is written to its rows of the xfeats memmaps
+    and then marked as done, so an interrupted run resumes where it stopped.
+    """
+    jobs = []
+    done = {}
+    # rows per galaxy; only for training do we actually use the raw data
+    per_galaxy = {'training': 2, 'test': 1}
+    nleft = 0
+    for which_set in ('training', 'test'):
+        ngalaxies = gzstore.load_images(which_set).shape[0]
+        nrows = per_galaxy[which_set] * ngalaxies
+        xfeats_path, done_path = _xfeats_paths(which_set)
+        nshards = (ngalaxies + shard_size - 1) // shard_size
+        if not (os.path.exists(xfeats_path) and os.path.exists(done_path) and
+                np.load(xfeats_path, mmap_mode='r').shape == (nrows, gzfeats.N_FEATURES) and
+                np.load(done_path, mmap_mode='r').shape == (nshards,)):
+            np.lib.format.open_memmap(xfeats_path, mode='w+', dtype='float64', shape=(nrows, gzfeats.N_FEATURES))
+            # a new file is zero-filled, so no shard is done
+            np.lib.format.open_memmap(done_path, mode='w+', dtype='uint8', shape=(nshards,))
+        done[which_set] = np.load(done_path, mmap_mode='r+')
+        for shard in np.where(done[which_set] == 0)[0]:
+            start = shard * shard_size
+            stop = min(start + shard_size, ngalaxies)
+            jobs.append((which_set, shard, start, stop))
+            nleft += per_galaxy[which_set] * (stop - start)
+
+    print '%d shards left to process' % len(jobs)
+    pool = multiprocessing.Pool(n_jobs or multiprocessing.cpu_count(), initializer=gzprep.init_cv_worker)
+    starttime = time.time()
+    try:
+        progress = tqdm.tqdm(total=nleft, unit='img')
+        for which_set, shard, ngalaxies in pool.imap_unordered(_xfeats_shard, jobs):
+            # the worker has flushed the shard's rows
+            done[which_set][shard] = 1
+            done[which_set].flush()
+            progress.update(per_galaxy[which_set] * ngalaxies)
+        progress.close()
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = max(time.time() - starttime, 1e-6)
+    print 'Extra features of %d images generated in %.0f s (%.1f images/s)' % (nleft, elapsed, nleft / elapsed)
+
+
+def load_xfeats(which_set):
+    xfeats_path, done_path = _xfeats_paths(which_set)
+    assert np.all(np.load(done_path)), 'extra features for %s are incomplete, run extra_feats first' % which_set
+    return np.load(xfeats_path)
 
 
 def load_data():
@@ -123,17 +95,15 @@ def load_data():
     print("Loading data")
 
     tr, te = [], []
-    for trd, ted in zip(('feats_daex_train1.npy',
-                        ),
-                        ('feats_daex_test1.npy',
-                        )):
-        tr.append(np.load(DATA_DIR+trd))
-        te.append(np.load(DATA_DIR+ted))
+    for config, name in ((gzconfig.DAEX, 'feats_daex'),
+                         ):
+        tr.append(np.load(config.output_path(name, 'train')))
+        te.append(np.load(config.output_path(name, 'test')))
         # delete the raw-features-based items of the test set (not actually going to use them)
         te[-1] = te[-1][1::2, :]
 
-    tr.append(np.load(DATA_DIR+'xfeats_train.npy'))
-    te.append(np.load(DATA_DIR+'xfeats_test.npy'))
+    tr.append(load_xfeats('training'))
+    te.append(load_xfeats('test'))
 
     traindata = np.concatenate(tr, axis=1)
     testdata = np.concatenate(te, axis=1)
@@ -4,11 +4,13 @@ import sys
 import os
 from tqdm import tqdm
 import math
+import multiprocessing
 import numpy as np
 import matplotlib.pyplot as plt
 import cv2
 
-DATA_DIR = '/home/nico/Data/GalaxyZoo/'
+from GalaxyZoo import gzstore
+from GalaxyZoo.gzconfig import DATA_DIR
 
 
 def process_targets(redo=False):
@@ -18,76 +20,142 @@ def process_targets(redo=False):
         np.save(os.path.join(DATA_DIR, 'targets.npy'), targets[:, 1:])
 
 
-def main():
+# CLAHE and SURF objects, created once per worker process
+_clahe = None
+_surf = None
+
+
+def init_cv_worker():
+    """Initializer of process pools that run OpenCV, with one process per
+    core: OpenCV must not start threads of its own in them.
+    """
+    cv2.setNumThreads(0)
+
+
+def _init_worker():
+    global _clahe, _surf
+    init_cv_worker()
+    _clahe = cv2.createCLAHE(clipLimit=10., tileGridSize=(8, 8))
+    _surf = cv2.SURF(hessianThreshold=2000, nOctaves=10)
+
+
+def process_image(im, clahe, surf, finalSize=128):
+    """Returns the raw center crop and the centered, rotated and scaled crop of a galaxy image.
+    """
+    # IMAGE 1: the middle square of the original image
+    # Note: I treat this as a noisy version of the image; presented only
+    # during training to help generalization
+    imraw = im[212 - finalSize / 2:212 + finalSize / 2, 212 - finalSize / 2:212 + finalSize/2]
+
+    # IMAGE 2: a heavily preprocessed version of the original image
+    # convert to grayscale
+    imgray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
+    # threshold so that dark noise is removed
+    _, imp = cv2.threshold(imgray, 31, 255, cv2.THRESH_TOZERO)
+    # blur the image
+    imp = cv2.medianBlur(imp, 5)
+    imp = cv2.GaussianBlur(imp, (5, 5), 0)
+    # adaptive histogram equalization
+    imc = clahe.apply(imp)
+
+    # Perform SURF, find keypoints and descriptors
+    keyPoints, des = surf.detectAndCompute(imc, None)
+
+    scores = []
+    for kp in keyPoints:
+        dist = math.hypot(kp.pt[0] - 211, kp.pt[1] - 211)
+        if dist > 25:
+            scores.append(np.Inf)
+        else:
+            scores.append(dist - 0.1 * kp.size)
+
+    if len(scores) == 0 or np.all(np.isinf(scores)):
+        # no keypoint found in center, just cut out a centered box, unrotated
+        cntr = (211, 211)
+        rot = 0
+        diam = 256
+    else:
+        cntr = keyPoints[np.argmin(scores)].pt
+        rot = keyPoints[np.argmin(scores)].angle
+        diam = max(64, keyPoints[np.argmin(scores)].size)
+
+    # rotate, scale and crop the original (not grayscale) image
+    rot_mat = cv2.getRotationMatrix2D(cntr, rot + 90, (finalSize * 0.75) / diam)
+    imr = cv2.warpAffine(im, rot_mat, list(im.shape).append(1), flags=cv2.INTER_CUBIC)
+    newimg = imr[212 - finalSize / 2:212 + finalSize / 2, 212 - finalSize / 2:212 + finalSize/2, :]
+
+    # plot
+    # im2 = cv2.drawKeypoints(im, keyPoints, None, (255, 0, 0), 4)
+    # res = np.hstack((im, cv2.cvtColor(imc, cv2.COLOR_GRAY2BGR), im2))
+    # plt.imshow(res), plt.show()
+    # plt.imshow(newimg), plt.show()
+
+    return imraw, newimg
+
+
+# images of the stores written to by this worker process, which_set -> images
+_stores = {}
+
+
+def _get_store(which_set):
+    if which_set not in _stores:
+        _stores[which_set] = gzstore.open_store(which_set, mode='r+')[0]
+    return _stores[which_set]
+
+
+def _process_files(args):
+    which_set, chunk, paths, rows = args
+    images = _get_store(which_set)
+    for srcpath, row in zip(paths, rows):
+        im = cv2.imread(srcpath)
+        imraw, newimg = process_image(im, _clahe, _surf)
+        # OpenCV images are BGR, the store is RGB
+        images[row, 0] = imraw[:, :, ::-1]
+        images[row, 1] = newimg[:, :, ::-1]
+    # the images must be on disk before they are marked as done
+    images.flush()
+    return which_set, chunk
+
+
+def main(n_jobs=None, chunk_size=64):
+    """Preprocesses all images into the image stores (see gzstore) in a process
+    pool. Every chunk of chunk_size images is written to its rows of the store
+    and flushed, and only then marked as done, so an interrupted run resumes
+    where it stopped.
+    """
     process_targets()
 
-    finalSize = 128
-
     filenumbers = [[], []]
-    for ii, dr in enumerate(['images_training_rev1', 'images_test_rev1']):
-        for cnt, name in tqdm(enumerate(os.listdir(os.path.join(DATA_DIR, dr)))):
-            number, ext = os.path.splitext(name)
-            if os.path.isfile(os.path.join(DATA_DIR, dr, name)) and ext == '.jpg':
-                filenumbers[ii].append(number)
-
-                im = cv2.imread(os.path.join(DATA_DIR, dr, name))
-
-                # IMAGE 1: the middle square of the original image
-                # Note: I treat this as a noisy version of the image; presented only
-                # during training to help generalization
-                imraw = im[212 - finalSize / 2:212 + finalSize / 2, 212 - finalSize / 2:212 + finalSize/2]
-                cv2.imwrite(os.path.join(DATA_DIR, dr[:-5] + '_proc', number + '_raw.png'), imraw)
-
-                # IMAGE 2: a heavily preprocessed version of the original image
-                # convert to grayscale
-                imgray = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
-                # threshold so that dark noise is removed
-                _, imp = cv2.threshold(imgray, 31, 255, cv2.THRESH_TOZERO)
-                # blur the image
-                imp = cv2.medianBlur(imp, 5)
-                imp = cv2.GaussianBlur(imp, (5, 5), 0)
-                # adaptive histogram equalization
-                clahe = cv2.createCLAHE(clipLimit=10., tileGridSize=(8, 8))
-                imc = clahe.apply(imp)
-
-                # Perform SURF, find keypoints and descriptors
-                surf = cv2.SURF(hessianThreshold=2000, nOctaves=10)
-                keyPoints, des = surf.detectAndCompute(imc, None)
-
-                scores = []
-                for kp in keyPoints:
-                    dist = math.hypot(kp.pt[0] - 211, kp.pt[1] - 211)
-                    if dist > 25:
-                        scores.append(np.Inf)
-                    else:
-                        scores.append(dist - 0.1 * kp.size)
-
-                if len(scores) == 0 or np.all(np.isinf(scores)):
-                    # no keypoint found in center, just cut out a centered box, unrotated
-                    cntr = (211, 211)
-                    rot = 0
-                    diam = 256
-                else:
-                    cntr = keyPoints[np.argmin(scores)].pt
-                    rot = keyPoints[np.argmin(scores)].angle
-                    diam = max(64, keyPoints[np.argmin(scores)].size)
-
-                # rotate, scale and crop the original (not grayscale) image
-                rot_mat = cv2.getRotationMatrix2D(cntr, rot + 90, (finalSize * 0.75) / diam)
-                imr = cv2.warpAffine(im, rot_mat, list(im.shape).append(1), flags=cv2.INTER_CUBIC)
-                newimg = imr[212 - finalSize / 2:212 + finalSize / 2, 212 - finalSize / 2:212 + finalSize/2, :]
-
-                # plot
-                # im2 = cv2.drawKeypoints(im, keyPoints, None, (255, 0, 0), 4)
-                # if cnt < 20:
-                #     res = np.hstack((im, cv2.cvtColor(imc, cv2.COLOR_GRAY2BGR), im2))
-                #     plt.imshow(res), plt.show()
-                #     plt.imshow(newimg), plt.show()
-
-                cv2.imwrite(os.path.join(DATA_DIR, dr[:-5] + '_proc', number + '_proc.png'), newimg)
-
-    # sort, so that targets/outputs and filenumbers are aligned
-    [x.sort() for x in filenumbers]
+    jobs = []
+    done = {}
+    for ii, (dr, which_set) in enumerate(zip(['images_training_rev1', 'images_test_rev1'], ['training', 'test'])):
+        # sort, so that targets/outputs, filenumbers and store rows are aligned
+        filenumbers[ii] = sorted(os.path.splitext(name)[0] for name in os.listdir(os.path.join(DATA_DIR, dr))
+                                 if os.path.isfile(os.path.join(DATA_DIR, dr, name)) and name.endswith('.jpg'))
+        # resume: images already in the store are done
+        done[which_set] = gzstore.create_store(which_set, filenumbers[ii], size=gzstore.FULL_SIZE)
+        rows = np.where(done[which_set] == 0)[0]
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            jobs.append((which_set, len(jobs), [os.path.join(DATA_DIR, dr, filenumbers[ii][row] + '.jpg')
+                                                for row in chunk], chunk))
+
+    nleft = sum(len(job[3]) for job in jobs)
+    print '%d of %d images left to process' % (nleft, sum(len(x) for x in filenumbers))
+    pool = multiprocessing.Pool(n_jobs or multiprocessing.cpu_count(), initializer=_init_worker)
+    try:
+        progress = tqdm(total=nleft)
+        for which_set, chunk in pool.imap_unordered(_process_files, jobs):
+            # the worker has flushed the chunk's images
+            rows = jobs[chunk][3]
+            done[which_set][rows] = 1
+            done[which_set].flush()
+            progress.update(len(rows))
+        progress.close()
+    finally:
+        pool.close()
+        pool.join()
+
     np.save(os.path.join(DATA_DIR, 'filenumbers.npy'), filenumbers)
 
 
@@ -0,0 +1,88 @@
+#!/usr/bin/python2
+
+"""
+Packed image store for the preprocessed Galaxy Zoo images
+
+All images of a set live in one memory-mapped uint8 array of shape
+(galaxies, 2, size, size, 3), RGB, where [:, 0] is the raw center crop and
+[:, 1] the centered and rotated crop made by gzprep. Rows follow the sorted
+file numbers, which are stored in an index file next to it. A flag per row
+marks galaxies whose images are complete, so writing can be resumed.
+
+Downscaled versions are derived from the full-size store once and stored
+the same way.
+"""
+
+import os
+import numpy as np
+from PIL import Image
+
+from GalaxyZoo.gzconfig import DATA_DIR
+
+FULL_SIZE = 128
+
+
+def _paths(which_set, size):
+    base = os.path.join(DATA_DIR, 'images_%s_%d' % (which_set, size))
+    return base + '.npy', base + '_index.npy', base + '_done.npy'
+
+
+def create_store(which_set, filenumbers, size=FULL_SIZE):
+    """Creates an empty store for the given (sorted) file numbers, or reopens
+    an existing one with the same index. Returns the writable done flags.
+    An existing store with a different index is never overwritten; remove
+    its files to rebuild it.
+    """
+    images_path, index_path, done_path = _paths(which_set, size)
+    if os.path.exists(index_path):
+        if not np.array_equal(np.load(index_path), np.asarray(filenumbers)):
+            raise ValueError('image store %s exists with different file numbers, remove it to rebuild'
+                             % images_path)
+        if os.path.exists(images_path) and os.path.exists(done_path):
+            return np.load(done_path, mmap_mode='r+')
+
+    np.lib.format.open_memmap(images_path, mode='w+', dtype='uint8', shape=(len(filenumbers), 2, size, size, 3))
+    np.save(index_path, np.asarray(filenumbers))
+    # a new file is zero-filled, so no image is done
+    return np.lib.format.open_memmap(done_path, mode='w+', dtype='uint8', shape=(len(filenumbers),))
+
+
+def open_store(which_set, size=FULL_SIZE, mode='r'):
+    """Memory-maps the images and done flags of a store.
+    """
+    images_path, index_path, done_path = _paths(which_set, size)
+    return np.load(images_path, mmap_mode=mode), np.load(done_path, mmap_mode=mode)
+
+
+def images_path(which_set, size=FULL_SIZE):
+    return _paths(which_set, size)[0]
+
+
+def load_index(which_set, size=FULL_SIZE):
+    return np.load(_paths(which_set, size)[1])
+
+
+def _downscale(which_set, size):
+    src = load_images(which_set)
+    done = create_store(which_set, load_index(which_set), size)
+    images = open_store(which_set, size, mode='r+')[0]
+    for row in np.where(done == 0)[0]:
+        for jj in range(2):
+            im = Image.fromarray(np.asarray(src[row, jj]))
+            images[row, jj] = np.array(im.resize((size, size), Image.ANTIALIAS), dtype=np.uint8)
+        done[row] = 1
+    images.flush()
+    done.flush()
+
+
+def load_images(which_set, size=FULL_SIZE):
+    """Memory-mapped images of a complete store. Sizes other than FULL_SIZE are
+    derived from the full-size store the first time they are asked for, with
+    PIL's ANTIALIAS filter.
+    """
+    images_path, index_path, done_path = _paths(which_set, size)
+    if size != FULL_SIZE and (not os.path.exists(done_path) or not np.all(np.load(done_path, mmap_mode='r'))):
+        _downscale(which_set, size)
+    images, done = open_store(which_set, size)
+    assert np.all(done), 'image store for %s is incomplete, run gzprep first' % which_set
+    return images
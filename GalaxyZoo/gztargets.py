@@ -0,0 +1,131 @@
+#!/usr/bin/python2
+
+"""
+Targets derived from the Galaxy Zoo decision tree
+
+The 37 solution columns are cumulative probabilities: the probability of an
+answer includes the probabilities of all answers that lead to its question.
+A target set describes leaves of the tree as terms (anchor, factors): the
+anchor answers are taken as they are, and every factor (question, answers)
+multiplies them by the conditional probabilities of those answers, given
+that the question was reached. Each term yields the outer product of its
+anchors and factors, so the leaves of a term are ordered with the last
+factor varying fastest.
+
+Conditional probabilities are computed once per question and the leaves of
+a term are one broadcasted product. Since the leaves of a target set
+partition the probability of every answer on their paths, predicted leaves
+can be summed back up to the 37 classes.
+"""
+
+from collections import OrderedDict
+import numpy as np
+
+# answers per question, in the order of the solution columns
+QUESTIONS = OrderedDict([('1', 3), ('2', 2), ('3', 2), ('4', 2), ('5', 4), ('6', 2), ('7', 3), ('8', 7),
+                         ('9', 3), ('10', 3), ('11', 6)])
+CLASSES = ['%s.%d' % (q, a + 1) for q, n in QUESTIONS.items() for a in range(n)]
+# the answer every path to a question passes through
+PARENT = {'2': '1.2', '3': '2.2', '4': '2.2', '5': '2.2', '7': '1.1', '8': '6.1', '9': '2.1',
+          '10': '4.1', '11': '4.1'}
+
+
+def _answers(question):
+    return [c for c in CLASSES if c.split('.')[0] == question]
+
+
+def _columns(answers):
+    return [CLASSES.index(a) for a in answers]
+
+
+def _disk_paths(anchor):
+    # featured disk, not edge-on: spiral arms (10, 11) and bulge (5), or only the bulge
+    return [(anchor, [('4', ['4.1']), ('10', None), ('11', None), ('5', None)]),
+            (anchor, [('4', ['4.2']), ('5', None)])]
+
+
+TARGET_SETS = {
+    # SUBMODEL 1: 159 outputs
+    'full': [(_answers('7'), []),
+             (_answers('9'), [])] +
+            _disk_paths(['3.1']) +
+            _disk_paths(['3.2']) +
+            [(['1.3'], [])],
+    # SUBMODEL 2: 8 outputs
+    'odd': [(['6.2'], []),
+            (_answers('8'), [])],
+    # small version of SUBMODEL 1: 15 outputs
+    'small': [(_answers('7'), []),
+              (_answers('9'), []),
+              (['3.1'], [('4', ['4.1']), ('10', None)]),
+              (['3.1'], [('4', ['4.2'])]),
+              (['3.2'], [('4', ['4.1']), ('10', None)]),
+              (['3.2'], [('4', ['4.2'])]),
+              (['1.3'], [])],
+}
+
+
+def _leaves(target_set):
+    # answer paths of all leaves, in output order
+    leaves = []
+    for anchor, factors in TARGET_SETS[target_set]:
+        paths = [[a] for a in anchor]
+        for question, answers in factors:
+            paths = [path + [a] for path in paths for a in (answers or _answers(question))]
+        leaves.extend(paths)
+    return leaves
+
+
+def n_targets(target_set):
+    return len(_leaves(target_set))
+
+
+def build_targets(solutions, target_set):
+    """Leaf probabilities of target_set from (galaxies, 37) solutions. Leaves
+    below answers with zero probability are 0.
+    """
+    solutions = np.asarray(solutions, dtype='float64')
+    conditional = {}
+    terms = []
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for anchor, factors in TARGET_SETS[target_set]:
+            term = solutions[:, _columns(anchor)]
+            for question, answers in factors:
+                if question not in conditional:
+                    cols = solutions[:, _columns(_answers(question))]
+                    conditional[question] = cols / np.sum(cols, axis=1, keepdims=True)
+                cond = conditional[question][:, [int(a.split('.')[1]) - 1 for a in (answers or _answers(question))]]
+                # outer product per galaxy
+                term = np.reshape(term[:, :, None] * cond[:, None, :], (term.shape[0], -1))
+            terms.append(term)
+    targets = np.hstack(terms)
+    targets[np.isnan(targets)] = 0
+    return targets.astype('float32')
+
+
+def class_matrix(target_set):
+    """(leaves, 37) 0/1 matrix that sums leaves up to the classes on their paths
+    """
+    M = np.zeros((n_targets(target_set), len(CLASSES)), dtype='float32')
+    for ii, path in enumerate(_leaves(target_set)):
+        answers = set(path)
+        for answer in path:
+            question = answer.split('.')[0]
+            while question in PARENT:
+                answers.add(PARENT[question])
+                question = PARENT[question].split('.')[0]
+        M[ii, _columns(answers)] = 1
+    return M
+
+
+def covered(target_set):
+    """Boolean mask of the classes that to_classes determines for target_set
+    """
+    return class_matrix(target_set).any(axis=0)
+
+
+def to_classes(predictions, target_set):
+    """Sums predicted leaf probabilities up to the 37 classes. Classes not
+    covered by the target set are 0; combine target sets with covered().
+    """
+    return np.dot(predictions, class_matrix(target_set))
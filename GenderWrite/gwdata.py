@@ -1,6 +1,5 @@
 #!/usr/bin/python
 
-from pylearn2.datasets import preprocessing
 from pylearn2.utils import serial
 from collections import OrderedDict
 import numpy as np
@@ -9,6 +8,7 @@ from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix, DefaultView
 from PIL import Image
 from sklearn import decomposition
 import GenderWrite.gwdata
+from utils import streamprep
 
 DATA_DIR = '/home/nico/datasets/Kaggle/GenderWrite/'
 
@@ -122,15 +122,16 @@ def generate_patches():
     datasets['test'] = GenderWrite.gwdata.GWData(which_set = 'test')
     datasets['tottrain'] = GenderWrite.gwdata.GWData(which_set = 'train')
     
-    # preprocess patches
-    pipeline = preprocessing.Pipeline()
-    pipeline.items.append(preprocessing.GlobalContrastNormalization())
-    pipeline.items.append(preprocessing.ZCA())
+    # preprocess patches, same as pylearn2's GlobalContrastNormalization() followed by ZCA()
+    pipeline = {'gcn': {}, 'standardize': False, 'zca': True}
     for dstr, dset in datasets.iteritems():
         print dstr
         # only fit on train data
-        trainbool = dstr == 'train' or dstr == 'tottrain'
-        dset.apply_preprocessor(preprocessor=pipeline, can_fit=trainbool)
+        if dstr == 'train' or dstr == 'tottrain':
+            moments = streamprep.block_moments(dset.X, gram=True, gcn=pipeline['gcn'])
+            params = streamprep.fit_params(moments, **pipeline)
+        # blockwise, in place
+        streamprep.apply_params(dset.X, params)
         # save
         dset.use_design_loc(DATA_DIR+dstr+'_design.npy')
         serial.save(DATA_DIR+'gw_preprocessed_'+dstr+'.pkl', dset)
@@ -1,6 +1,7 @@
 import numpy as np
 from pylearn2.utils import serial
-from theano import function
+
+from utils import inference
 
 CODE_DIR = '/home/nico/Code/kaggle/GenderWrite/'
 DATA_DIR = '/home/nico/datasets/Kaggle/GenderWrite/'
@@ -21,36 +22,19 @@ train_obj.main_loop()
 #    train_obj.model.layers.insert(1+ii,layers[1+ii])
 #    train_obj.main_loop()
 
-# generate model output
-def get_output(model, tdata, layerindex=-1, batch_size=100):
-    Xb = model.get_input_space().make_batch_theano()
-    ymf = model.fprop(Xb, return_all=True)
-    
-    data = tdata.get_topological_view()
-    
-    propagate = function([Xb],ymf)
-    
-    output = []
-    for ii in xrange(int(data.shape[0]/batch_size)):
-        seldata = data[ii*batch_size:(ii+1)*batch_size,:]
-        output.append(propagate(seldata)[layerindex])
-    
-    output = np.reshape(output,[data.shape[0],-1])
-    
-    return output
-
 trainset = serial.load(DATA_DIR+'gw_preprocessed_tottrain.pkl')
 testset = serial.load(DATA_DIR+'gw_preprocessed_test.pkl')
 
 model = train_obj.model
-outtrainset = get_output(model,trainset,-1)
-outtestset = get_output(model,testset,-1)
+# generate model output: final layer and the layer below it in one pass
+outtrainset, feattrainset = inference.get_outputs(model,trainset,(-1,-2),batch_size=100)
+outtestset, feattestset = inference.get_outputs(model,testset,(-1,-2),batch_size=100)
 # save test output as submission
 np.savetxt(DATA_DIR+'model_comb.csv', outtestset[:,0], delimiter=",")
 
 # construct data sets with model output
-outtrainset = get_output(model,trainset,-2)
-outtestset = get_output(model,testset,-2)
+outtrainset = feattrainset
+outtestset = feattestset
         
 # reshape model output so that shape[0] = no. of pages
 
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+
+'''
+Content-addressed cache of per-clip results (features, model outputs)
+
+A stage (e.g. feature extraction with a given feature plan, or a trained
+model) gets its own directory, named after a hash of its parameters. In it,
+every clip has one .npz file named after the hash of the clip's input, so
+only clips whose input or stage parameters changed are recomputed, and new
+clips are scored incrementally.
+'''
+
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+
+
+def file_hash(path):
+    '''md5 of the contents of a (clip) file
+    '''
+    with open(path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+def array_hash(*arrays):
+    '''md5 of the shapes, dtypes and contents of arrays
+    '''
+    md5 = hashlib.md5()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        md5.update(str((a.shape, a.dtype.str)))
+        md5.update(a)
+    return md5.hexdigest()
+
+def params_hash(**params):
+    return hashlib.md5(json.dumps(params, sort_keys=True)).hexdigest()[:16]
+
+def _makedirs(path):
+    if not os.path.exists(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # created by another process in the meantime
+            if not os.path.isdir(path):
+                raise
+
+def _write(path, write, suffix=''):
+    # write to a temporary file and rename, so that files are never partial
+    fd, tmp = tempfile.mkstemp(suffix=suffix, dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+
+class ClipCache(object):
+
+    def __init__(self, cache_dir, stage, **params):
+        self.dir = os.path.join(cache_dir, stage + '_' + params_hash(**params))
+        params_path = os.path.join(self.dir, 'params.json')
+        if not os.path.exists(params_path):
+            # several stages or processes may create the same cache at once
+            _makedirs(self.dir)
+            _write(params_path, lambda f: json.dump(params, f, indent=1, sort_keys=True), suffix='.json')
+
+    def _path(self, key):
+        # sharded, so that directories stay small
+        return os.path.join(self.dir, key[:2], key + '.npz')
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def get(self, key):
+        '''dict of arrays stored for key, None if there is no entry
+        '''
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as entry:
+            return dict(entry)
+
+    def put(self, key, **arrays):
+        path = self._path(key)
+        _makedirs(os.path.dirname(path))
+        _write(path, lambda f: np.savez(f, **arrays), suffix='.npz')
+
+    def fetch(self, keys, compute):
+        '''Entries for all keys. compute(indices) is called once, for the
+        indices into keys that are not cached yet, and returns a list with a
+        dict of arrays for each of them; those are stored.
+        '''
+        entries = [self.get(key) for key in keys]
+        missing = [ii for ii, entry in enumerate(entries) if entry is None]
+        if missing:
+            print 'computing %d of %d clips...' % (len(missing), len(keys))
+            for ii, entry in zip(missing, compute(missing)):
+                self.put(keys[ii], **entry)
+                entries[ii] = entry
+        return entries
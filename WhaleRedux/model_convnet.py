@@ -3,8 +3,9 @@
 import os
 import numpy as np
 import pandas as pd
-from theano import function
 import WhaleRedux.whaledata
+from WhaleRedux import clipcache
+from utils import inference
 
 from pylearn2.train import Train
 from pylearn2.models.mlp import MLP, ConvRectifiedLinear, Softmax
@@ -65,102 +66,98 @@ def get_trainer(model, trainset, validset, epochs=20, batch_size=200):
                         input_scales={'h0': 1./0.8, 'h1': 1./0.8, 'h2': 1./0.8, 'h3': 1./0.8, 'y': 1./0.5},
                         default_input_include_prob=0.5, default_input_scale=1./0.5),
         termination_criterion = EpochCounter(epochs),
-        update_callbacks = ExponentialDecay(decay_factor=1.0001, min_lr=0.001)
+        update_callbacks = ExponentialDecay(decay_factor=1.0001, min_lr=0.001),
+        # patch sets sample with replacement
+        train_iteration_mode = 'random_uniform' if isinstance(trainset, WhaleRedux.whaledata.WhaleReduxPatches) \
+                else 'shuffled_sequential'
     )
     return Train(model=model, algorithm=train_algo, dataset=trainset, save_freq=0, save_path='epoch', \
             extensions=[MomentumAdjustor(final_momentum=0.9, start=0, saturate=int(epochs*0.8)), ])
 
-def get_output(model, tdata, layerindex, batch_size=100):
-    # get output submodel classifiers
-    Xb = model.get_input_space().make_theano_batch()
-    Yb = model.fprop(Xb, return_all=True)
-    
-    data = tdata.get_topological_view()
-    # fill up with zeroes for dividible by batch number
-    extralength = batch_size - data.shape[0]%batch_size
-    
-    if extralength < batch_size:
-        data = np.append(data,np.zeros([extralength, data.shape[1],data.shape[2],data.shape[3]]), axis=0)
-        data = data.astype('float32')
-    
-    propagate = function([Xb], Yb, allow_input_downcast=True)
-    
-    output = []
-    for ii in xrange(int(data.shape[0]/batch_size)):
-        seldata = data[ii*batch_size:(ii+1)*batch_size,:]
-        output.append(propagate(seldata)[layerindex])
-    
-    output = np.reshape(output,[data.shape[0],-1])
-    
-    if extralength < batch_size:
-        # remove the filler
-        output = output[:-extralength]
-    
-    return output
+def model_version(model):
+    # changes whenever the architecture or any weight changes
+    return clipcache.array_hash(*[param.get_value() for param in model.get_params()])
+
+def clip_cache(model, name, cache_dir=DATA_DIR+'clipcache', **params):
+    '''Per-clip cache of the model's outputs for inference.export_activations,
+    keyed by model version and by the hash of the clip's preprocessed input
+    (which covers the clip's content, the feature plan and the preprocessing),
+    and by params that change the outputs otherwise (e.g. the patch grid)
+    '''
+    return clipcache.ClipCache(cache_dir, name, model=model_version(model), **params)
+
+def patch_params(dataset):
+    # grid the outputs of patch data sets are averaged over
+    if isinstance(dataset, WhaleRedux.whaledata.WhaleReduxPatches):
+        return {'patch_shape': dataset.patch_shape, 'patch_stride': dataset.patch_stride}
+    return {}
 
 
 if __name__ == '__main__':
     
     submission = True
     batch_size = 50
+    # e.g. 60: train on random crops of that many frames, and evaluate on a grid of
+    # crops every 2 frames, averaged per clip; None uses whole clips (67 frames)
+    patch_frames = None
     
     ####################
     #   MEL SPECTRUM   #
     ####################
-    trainset,validset,testset = WhaleRedux.whaledata.get_dataset('melspectrum', tot=submission)
+    patch_shape = None if patch_frames is None else (patch_frames, 40)
+    trainset,validset,testset = WhaleRedux.whaledata.get_dataset('melspectrum', tot=submission,
+            patch_shape=patch_shape, patch_stride=(2, 1))
     
     # build and train classifiers for submodels
-    model = get_conv2D([67,40,1], batch_size=batch_size)
+    model = get_conv2D([patch_frames or 67,40,1], batch_size=batch_size)
     get_trainer(model, trainset, validset, epochs=50, batch_size=batch_size).main_loop()
     
     # validate model
     if not submission:
-        output = get_output(model, validset, -1)
+        output = inference.per_example(inference.get_output(model,validset,-1,batch_size=100), validset)
         # calculate AUC using sklearn
         AUC = auc_score(validset.get_targets()[:,0],output[:,0])
         print AUC
     else:
         fn = np.load(os.path.join(DATA_DIR,'filenames.npy'))
-        outtestset = get_output(model,testset,-1)[:,0]
+        # one pass per data set gives both the output and the data sets with model output
+        outtestset = inference.export_activations(model, testset, DATA_DIR+'conv2', 'test', 100,
+                cache=clip_cache(model, 'conv2', **patch_params(testset)), key=clipcache.array_hash)[0][:,0]
         
         # save test output as submission
         output = pd.DataFrame({'clip': fn, 'probability': outtestset})
         output.to_csv(DATA_DIR+'model_conv2net.csv', header=True, index=False)
         
-        # construct data sets with model output
-        outtrainset = get_output(model,trainset,-2)
-        outtestset = get_output(model,testset,-2)
-        
-        np.save(DATA_DIR+'conv2out_train', outtrainset)
-        np.save(DATA_DIR+'conv2out_test', outtestset)
+        inference.export_activations(model, trainset, DATA_DIR+'conv2', 'train', 100,
+                cache=clip_cache(model, 'conv2', **patch_params(trainset)), key=clipcache.array_hash)
     
     
     #########################
     #   SPECTRAL FEATURES   #
     #########################
-    trainset2,validset2,testset2 = WhaleRedux.whaledata.get_dataset('specfeat', tot=submission)
+    patch_shape = None if patch_frames is None else (patch_frames, 1)
+    trainset2,validset2,testset2 = WhaleRedux.whaledata.get_dataset('specfeat', tot=submission,
+            patch_shape=patch_shape, patch_stride=(2, 1))
     
     # build and train classifiers for submodels
-    model2 = get_conv1D([67,1,24], batch_size=batch_size)
+    model2 = get_conv1D([patch_frames or 67,1,24], batch_size=batch_size)
     get_trainer(model2, trainset2, validset2, epochs=50, batch_size=batch_size).main_loop()
     
     # validate model
     if not submission:
-        output = get_output(model2,validset2)
+        output = inference.per_example(inference.get_output(model2,validset2,batch_size=100), validset2)
         # calculate AUC using sklearn
         AUC = auc_score(validset2.get_targets()[:,0],output[:,0])
         print AUC
     else:
         fn = np.load(os.path.join(DATA_DIR,'filenames.npy'))
-        outtestset2 = get_output(model2,testset2,-1)[:,0]
+        outtestset2 = inference.export_activations(model2, testset2, DATA_DIR+'conv1', 'test', 100,
+                cache=clip_cache(model2, 'conv1', **patch_params(testset2)), key=clipcache.array_hash)[0][:,0]
         
         output2 = pd.DataFrame({'clip': fn, 'probability': outtestset2})
         # save test output as submission
         output2.to_csv(DATA_DIR+'model_conv1net.csv', header=True, index=False)
         
-        outtrainset2 = get_output(model2,trainset2,-2)
-        outtestset2 = get_output(model2,testset2,-2)
-        
-        np.save(DATA_DIR+'conv1out_train', outtrainset2)
-        np.save(DATA_DIR+'conv1out_test', outtestset2)
+        inference.export_activations(model2, trainset2, DATA_DIR+'conv1', 'train', 100,
+                cache=clip_cache(model2, 'conv1', **patch_params(trainset2)), key=clipcache.array_hash)
     
@@ -2,42 +2,125 @@
 
 import os
 import numpy as np
-import mdp
-import Oger
 import pandas as pd
-from sklearn import cross_validation, ensemble, decomposition
+from scipy import linalg
+from sklearn import cross_validation, ensemble, metrics
+
+from utils import crossval, streamprep
+from WhaleRedux import reservoir
 
 DATA_DIR = '/home/nico/datasets/Kaggle/WhaleRedux/'
 
+def assemble_features(sources, out_path, block_size=streamprep.BLOCK_SIZE):
+    '''Writes the column-wise concatenation of the (memory-mapped) feature
+    arrays in sources (arrays or paths of .npy files) to a single float32
+    .npy memmap, block by block
+    '''
+    parts = [np.load(src, mmap_mode='r') if isinstance(src, basestring) else src for src in sources]
+    nexamples = parts[0].shape[0]
+    out = np.lib.format.open_memmap(out_path, mode='w+', dtype='float32', \
+            shape=(nexamples, sum(part.shape[1] for part in parts)))
+    col = 0
+    for part in parts:
+        assert part.shape[0] == nexamples
+        for ii in range(0, nexamples, block_size):
+            out[ii:ii+block_size, col:col+part.shape[1]] = part[ii:ii+block_size]
+        col += part.shape[1]
+    out.flush()
+    return out
+
+def get_scaling(data):
+    # same as StandardScaler: zero mean, unit variance, constant features only centered
+    moments = streamprep.block_moments(data)
+    n = float(moments['n'])
+    mean = moments['sum'] / n
+    std = np.sqrt(np.maximum(moments['sumsq'] / n - mean ** 2, 0.))
+    std[std == 0] = 1.
+    return {'shift': mean, 'W': 1. / std}
+
 def load_data():
     targets = np.load(DATA_DIR+'targets.npy')[:,0]
     
-    c2train = np.load(DATA_DIR+'conv2out_train.npy')
-    c2test = np.load(DATA_DIR+'conv2out_test.npy')
-    c1train = np.load(DATA_DIR+'conv1out_train.npy')
-    c1test = np.load(DATA_DIR+'conv1out_test.npy')
+    traindata = assemble_features([DATA_DIR+'conv2out_train.npy', DATA_DIR+'conv1out_train.npy'], \
+                DATA_DIR+'convout_train.npy')
+    testdata = assemble_features([DATA_DIR+'conv2out_test.npy', DATA_DIR+'conv1out_test.npy'], \
+                DATA_DIR+'convout_test.npy')
     
-    traindata = np.concatenate((c2train, c1train), axis=1)
-    testdata = np.concatenate((c2test, c1test), axis=1)
-    
-    norm = mdp.nodes.StandardScalerScikitsLearnNode()
-    norm.train(traindata)
-    traindata = norm.execute(traindata)
-    testdata = norm.execute(testdata)
+    # scale in place
+    params = get_scaling(traindata)
+    streamprep.apply_params(traindata, params, traindata)
+    streamprep.apply_params(testdata, params, testdata)
     
     return traindata, testdata, targets
 
-def run_reservoir(data):
-    reservoir = Oger.nodes.LeakyReservoirNode(leak_rate=0.4, input_dim=480, output_dim=2000, \
+def get_reservoir(input_dim=480):
+    # one seeded reservoir, so that train and test data see the same weights
+    return reservoir.LeakyReservoir(leak_rate=0.4, input_dim=input_dim, output_dim=2000, \
         spectral_radius=0.9, bias_scaling=0, input_scaling=0.2)
-    return reservoir.execute(data)
 
-def get_preprocessor(data):
-    preprocessor = decomposition.PCA(n_components=500)
-    preprocessor.fit(data)
+def run_reservoir(res, data, out_path, sequence_length=None):
+    # states are written straight to a float32 memmap
+    out = np.lib.format.open_memmap(out_path, mode='w+', dtype='float32', shape=(data.shape[0], res.output_dim))
+    res.execute(data, sequence_length=sequence_length, out=out)
+    out.flush()
+    return out
+
+class BlockPCA(object):
+    '''PCA (without whitening, like decomposition.PCA) for data that does not
+    fit in memory as a dense float64 matrix. The covariance matrix is
+    accumulated over float32 row blocks of a (memory-mapped) array in a single
+    pass; with a few thousand features its eigendecomposition is cheap and
+    exact. Transforms are applied blockwise as well.
+    '''
+    def __init__(self, n_components=500, block_size=5000):
+        self.n_components = n_components
+        self.block_size = block_size
+    
+    def fit(self, data):
+        moments = streamprep.block_moments(data, gram=True, block_size=self.block_size)
+        n = float(moments['n'])
+        self.mean_ = moments['sum'] / n
+        cov = moments['gram'] / n - np.outer(self.mean_, self.mean_)
+        eigs, eigv = linalg.eigh(cov)
+        # largest first
+        self.explained_variance_ = eigs[::-1][:self.n_components]
+        self.components_ = eigv[:, ::-1][:, :self.n_components].T
+        return self
+    
+    def transform(self, data, out=None):
+        if out is None:
+            out = np.empty((data.shape[0], self.n_components), dtype='float32')
+        mean = self.mean_.astype('float32')
+        componentsT = self.components_.T.astype('float32')
+        for ii in xrange(0, data.shape[0], self.block_size):
+            out[ii:ii+self.block_size] = np.dot(np.asarray(data[ii:ii+self.block_size], dtype='float32') - mean,
+                                                componentsT)
+        return out
+    
+    def save(self, path):
+        np.savez(path, mean=self.mean_, components=self.components_, explained_variance=self.explained_variance_)
+    
+    @classmethod
+    def load(cls, path):
+        basis = np.load(path)
+        pca = cls(n_components=basis['components'].shape[0])
+        pca.mean_ = basis['mean']
+        pca.components_ = basis['components']
+        pca.explained_variance_ = basis['explained_variance']
+        return pca
+
+def get_preprocessor(data_path, n_components=500, refit=False):
+    # the fitted basis is stored under the hash of the .npy file it was fitted on,
+    # so transforming (test) data later does not refit, and changed data never reuse it
+    path = DATA_DIR+'pca_basis_%d_%s.npz' % (n_components, streamprep.data_hash(data_path)[:16])
+    if os.path.exists(path) and not refit:
+        return BlockPCA.load(path)
+    preprocessor = BlockPCA(n_components=n_components)
+    preprocessor.fit(np.load(data_path, mmap_mode='r'))
+    preprocessor.save(path)
     return preprocessor
 
-def get_classifier(traindata, targets):
+def get_classifier(traindata, targets, testdata=None):
     
     models = [ensemble.GradientBoostingClassifier(n_estimators=400, learning_rate=0.05, \
                 max_depth=60, subsample=0.5, max_features=120, min_samples_leaf=20)]
@@ -45,17 +128,16 @@ def get_classifier(traindata, targets):
     # use StratifiedKFold, because survived 0/1 is not evenly distributed
     cv = cross_validation.StratifiedKFold(targets, n_folds=5)
     
-    scores = [0]*len(models)
+    results = [0]*len(models)
     for i in range(len(models)):
-        # get scores
-        scores[i] = cross_validation.cross_val_score(models[i], traindata, targets, \
-                    cv=cv, n_jobs=-1, scoring='roc_auc')
+        # fold models are trained in parallel, their average is the final model
+        results[i] = crossval.cross_val_ensemble(models[i], traindata, targets, cv, \
+                    testdata=testdata, score_func=metrics.roc_auc_score, n_jobs=-1)
+        scores = results[i]['scores']
         print "Cross-validation accuracy on the training set for model %d:" % i
-        print "%0.3f (+/-%0.03f)" % (scores[i].mean(), scores[i].std() / 2)
-        
-        models[i].fit(traindata, targets)
+        print "%0.3f (+/-%0.03f)" % (scores.mean(), scores.std() / 2)
     
-    return models
+    return results
 
 if __name__ == '__main__':
     
@@ -63,22 +145,24 @@ if __name__ == '__main__':
     fn = np.load(os.path.join(DATA_DIR,'filenames.npy'))
     
     # run reservoir
-    res_train = run_reservoir(traindata)
-    res_test = run_reservoir(testdata)
+    res = get_reservoir(traindata.shape[1])
+    res_train = run_reservoir(res, traindata, DATA_DIR+'reservoir_train.npy')
+    res_test = run_reservoir(res, testdata, DATA_DIR+'reservoir_test.npy')
     
-    # combine data
-    tottraindata = np.concatenate((traindata, res_train), axis=1)
-    tottestdata = np.concatenate((testdata, res_test), axis=1)
+    # combine data, memory-mapped like its parts
+    tottraindata = assemble_features([traindata, res_train], DATA_DIR+'tottrain_features.npy')
+    tottestdata = assemble_features([testdata, res_test], DATA_DIR+'tottest_features.npy')
     
-    # preprocess data
-    preproc = get_preprocessor(tottraindata)
+    # preprocess data, blockwise
+    preproc = get_preprocessor(DATA_DIR+'tottrain_features.npy')
     proc_train = preproc.transform(tottraindata)
     proc_test = preproc.transform(tottestdata)
     
     # now define and train model
-    models = get_classifier(proc_train, targets)
+    results = get_classifier(proc_train, targets, proc_test)
     
-    output = models[0].predict_proba(proc_test)
+    np.save(DATA_DIR+'model_hybrid_oof.npy', results[0]['oof'])
+    output = results[0]['test']
     
     # save test output as submission
     subm = pd.DataFrame({'clip': fn, 'probability': output[:,0]})
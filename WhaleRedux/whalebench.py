@@ -0,0 +1,179 @@
+#!/usr/bin/python
+
+'''
+Benchmarks of the whale pipeline stages on synthetic 2 kHz clips
+
+Every stage runs in a fresh process on inputs that are prepared beforehand,
+and reports clips/sec and the peak RSS of that process, so the stages can be
+compared in isolation. Works for the Whales and the WhaleRedux code; stages
+whose dependencies (YAAFE, pylearn2/theano) cannot be imported are skipped.
+Shared stages run the same utils code for every project, so they are only
+measured once.
+'''
+
+import os
+import aifc
+import time
+import shutil
+import resource
+import tempfile
+import importlib
+import multiprocessing
+import numpy as np
+
+from utils import streamprep
+
+SAMPLE_RATE = 2000
+SAMPLE_LENGTH = 2
+MELSHAPE = (67, 40)
+
+NCLIPS = 2000
+PROJECTS = ('Whales', 'WhaleRedux')
+
+
+def synth_clips(n, seed=0):
+    '''int16 clips of gaussian noise; half of them contain a frequency-modulated
+    upsweep, roughly like a right whale up-call
+    '''
+    rng = np.random.RandomState(seed)
+    nsamples = SAMPLE_LENGTH * SAMPLE_RATE
+    t = np.arange(nsamples) / float(SAMPLE_RATE)
+    clips = rng.normal(0, 1000, (n, nsamples))
+    for ii in np.where(rng.rand(n) < 0.5)[0]:
+        onset = rng.uniform(0.2, SAMPLE_LENGTH - 1.2)
+        envelope = np.exp(-((t - onset - 0.5) / 0.25) ** 2)
+        clips[ii] += 3000 * envelope * np.sin(2 * np.pi * (rng.uniform(60, 120) * t + 50 * t ** 2))
+    return np.clip(clips, -32768, 32767).astype('int16')
+
+def write_clips(clips, dir):
+    for ii, clip in enumerate(clips):
+        sample = aifc.open(os.path.join(dir, 'synth%06d_0.aiff' % ii), 'w')
+        sample.setnchannels(1)
+        sample.setsampwidth(2)
+        sample.setframerate(SAMPLE_RATE)
+        # AIFF is big-endian
+        sample.writeframes(clip.astype('>i2').tostring())
+        sample.close()
+
+def prepare(workdir, n):
+    '''Writes the inputs of all stages to workdir
+    '''
+    clips = synth_clips(n)
+    os.makedirs(os.path.join(workdir, 'clips'))
+    write_clips(clips, os.path.join(workdir, 'clips'))
+    sigs = streamprep.standardize_rows(clips)
+    np.save(os.path.join(workdir, 'sigs.npy'), sigs)
+    # positive, spectrum-like values, stored as float32 like the extracted features
+    mel = np.random.RandomState(1).gamma(2., 1., (n,) + MELSHAPE).astype('float32')
+    np.save(os.path.join(workdir, 'melspectrum.npy'), mel)
+
+
+# every stage does its (untimed) setup and returns the work to be timed
+
+def stage_decode(project, workdir):
+    features = importlib.import_module(project + '.whalefeatures')
+    return lambda: features.read_samples(os.path.join(workdir, 'clips'))
+
+def stage_features(project, workdir):
+    features = importlib.import_module(project + '.whalefeatures')
+    # imported lazily by extract_audio_features, check here so the stage is skipped without it
+    importlib.import_module('yaafelib')
+    sigs = np.load(os.path.join(workdir, 'sigs.npy'))
+    return lambda: features.extract_audio_features(sigs)
+
+def stage_dataset(project, workdir):
+    data = importlib.import_module(project + '.whaledata')
+    dataclass = getattr(data, project)
+    return lambda: dataclass(which_set='test', which_data='melspectrum',
+                             design_path=os.path.join(workdir, 'melspectrum.npy'))
+
+def stage_preprocess(project, workdir):
+    # utils.streamprep, the same for both projects
+    path = os.path.join(workdir, 'melspectrum.npy')
+    cache_dir = os.path.join(workdir, 'prepcache')
+    X = np.load(path, mmap_mode='r')
+    def run():
+        # global standardization + ZCA, as for the mel spectra
+        key, params = streamprep.cached_fit(X, path, [(0, X.shape[0])], cache_dir, global_std=True, zca=True)
+        streamprep.cached_transform(X, path, key, params, cache_dir, 'melspectrum')
+    return run
+
+def stage_inference(project, workdir):
+    from utils import inference
+    data = importlib.import_module(project + '.whaledata')
+    convnet = importlib.import_module(project + '.model_convnet')
+    dataset = getattr(data, project)(which_set='test', which_data='melspectrum',
+                                     design_path=os.path.join(workdir, 'melspectrum.npy'))
+    model = convnet.get_conv2D([MELSHAPE[0], MELSHAPE[1], 1])
+    # compile outside of the timed part
+    inference.get_propagator(model, (-1, -2))
+    return lambda: inference.get_outputs(model, dataset, (-1, -2))
+
+# (name, stage, shared by all projects)
+STAGES = [('decode', stage_decode, False),
+          ('features', stage_features, False),
+          ('dataset', stage_dataset, False),
+          ('preprocess', stage_preprocess, True),
+          ('inference', stage_inference, False)]
+
+
+def _peak_rss():
+    # in MB, ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def _run_stage(stage, project, workdir, queue):
+    try:
+        run = stage(project, workdir)
+    except ImportError as e:
+        queue.put({'skipped': str(e)})
+        return
+    start_rss = _peak_rss()
+    start = time.time()
+    run()
+    queue.put({'seconds': time.time() - start, 'start_rss': start_rss, 'peak_rss': _peak_rss()})
+
+def run_benchmarks(project='WhaleRedux', n=NCLIPS, workdir=None, shared=True):
+    '''Runs all stages on n synthetic clips and prints a table. Returns a
+    dict with the measurements per stage. Without shared, stages that do not
+    depend on the project are left out.
+    '''
+    assert project in PROJECTS
+    cleanup = workdir is None
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix='whalebench')
+    try:
+        prepare(workdir, n)
+        results = {}
+        print '%s, %d clips' % (project, n)
+        print '%-12s %10s %10s %14s %14s' % ('stage', 'seconds', 'clips/sec', 'setup RSS MB', 'peak RSS MB')
+        for name, stage, is_shared in STAGES:
+            if is_shared and not shared:
+                print '%-12s not repeated (shared by all projects)' % name
+                continue
+            # fresh process per stage, so peak RSS is that of the stage
+            queue = multiprocessing.Queue()
+            proc = multiprocessing.Process(target=_run_stage, args=(stage, project, workdir, queue))
+            proc.start()
+            proc.join()
+            if proc.exitcode != 0:
+                results[name] = {'failed': proc.exitcode}
+                print '%-12s failed with exit code %d' % (name, proc.exitcode)
+                continue
+            res = results[name] = queue.get()
+            if 'skipped' in res:
+                print '%-12s skipped (%s)' % (name, res['skipped'])
+            else:
+                res['clips_per_sec'] = n / res['seconds']
+                print '%-12s %10.2f %10.0f %14.0f %14.0f%s' % (name, res['seconds'], res['clips_per_sec'],
+                                                             res['start_rss'], res['peak_rss'],
+                                                             ' (shared)' if is_shared else '')
+        return results
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+
+    for ii, project in enumerate(PROJECTS):
+        run_benchmarks(project, shared=(ii == 0))
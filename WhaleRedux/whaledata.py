@@ -9,7 +9,10 @@ import numpy as np
 
 from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix, DefaultViewConverter
 from pylearn2.datasets import preprocessing
-import pylearn2.utils.serial as serial
+from pylearn2.space import Conv2DSpace, VectorSpace
+
+from utils import streamprep
+from utils.prefetch import PrefetchIterator, iterator_specs
 
 DATA_DIR = '/home/nico/datasets/Kaggle/WhaleRedux/'
 
@@ -34,8 +37,8 @@ class ExtractGridPatchesWithY(preprocessing.ExtractGridPatches):
                              + " topological dimensions called on"
                              + " dataset with " +
                              str(num_topological_dimensions) + ".")
-        num_patches = X.shape[0]
-        max_strides = [X.shape[0] - 1]
+        # number of grid positions per topological dimension
+        grid_shape = []
         for i in xrange(num_topological_dimensions):
             patch_width = self.patch_shape[i]
             data_width = X.shape[i + 1]
@@ -50,66 +53,135 @@ class ExtractGridPatchesWithY(preprocessing.ExtractGridPatches):
                 max_stride_this_axis = 0
             else:
                 max_stride_this_axis = last_valid_coord / stride
-            num_strides_this_axis = max_stride_this_axis + 1
-            max_strides.append(max_stride_this_axis)
-            num_patches *= num_strides_this_axis
-        # batch size
-        output_shape = [num_patches]
-        # topological dimensions
-        for dim in self.patch_shape:
-            output_shape.append(dim)
-        # number of channels
-        output_shape.append(X.shape[-1])
-        output = np.zeros(output_shape, dtype=X.dtype)
-        channel_slice = slice(0, X.shape[-1])
-        coords = [0] * (num_topological_dimensions + 1)
-        keep_going = True
-        i = 0
-        while keep_going:
-            args = [coords[0]]
-            for j in xrange(num_topological_dimensions):
-                coord = coords[j + 1] * self.patch_stride[j]
-                args.append(slice(coord, coord + self.patch_shape[j]))
-            args.append(channel_slice)
-            patch = X[args]
-            output[i, :] = patch
-            i += 1
-            # increment coordinates
-            j = 0
-            keep_going = False
-            while not keep_going:
-                if coords[-(j + 1)] < max_strides[-(j + 1)]:
-                    coords[-(j + 1)] += 1
-                    keep_going = True
-                else:
-                    coords[-(j + 1)] = 0
-                    if j == num_topological_dimensions:
-                        break
-                    j = j + 1
+            grid_shape.append(max_stride_this_axis + 1)
+        patches_per_example = int(np.prod(grid_shape))
+        
+        # zero-copy view of all patches of all examples, with shape
+        # (examples, grid positions..., patch shape..., channels)
+        X = np.asarray(X)
+        grid_strides = [X.strides[i + 1] * self.patch_stride[i] for i in xrange(num_topological_dimensions)]
+        patches = np.lib.stride_tricks.as_strided(X,
+                    shape=[X.shape[0]] + grid_shape + list(self.patch_shape) + [X.shape[-1]],
+                    strides=[X.strides[0]] + grid_strides + list(X.strides[1:]))
+        # same ordering as iterating over examples and then over the grid, last axis fastest;
+        # this reshape is the only copy
+        output = np.reshape(patches, [X.shape[0] * patches_per_example] + list(self.patch_shape) + [X.shape[-1]])
         dataset.set_topological_view(output)
-        dataset.y = np.repeat(y,num_patches/len(y),axis=0)
+        dataset.y = np.repeat(y,patches_per_example,axis=0)
+        dataset.patches_per_example = patches_per_example
+
+
+class RandomPatchIterator(PrefetchIterator):
+    """
+    Iterates over minibatches of random crops (time/frequency patches) of a
+    topological (examples, time, frequency, channels) array, which may be
+    memory-mapped. Patches are sampled per minibatch in a background thread,
+    so patch-based training needs no extra disk space or memory.
+    """
+    def __init__(self, images, y, patch_shape, batch_size, num_batches, rng=None,
+                 spaces=None, sources=('features', 'targets'), return_tuple=False, max_prefetch=2):
+        self._images = images
+        self._y = y
+        self._patch_shape = patch_shape
+        if not hasattr(rng, 'randint'):
+            rng = np.random.RandomState(rng if rng is not None else [2014, 3, 11])
+        self._rng = rng
+        space = Conv2DSpace(shape=patch_shape, num_channels=images.shape[-1], axes=('b', 0, 1, 'c'))
+        super(RandomPatchIterator, self).__init__(batch_size, num_batches, space, spaces=spaces, sources=sources,
+                                                  return_tuple=return_tuple, max_prefetch=max_prefetch)
+    
+    def _sample(self, thread):
+        nexamples, height, width = self._images.shape[:3]
+        pheight, pwidth = self._patch_shape
+        for ii in xrange(self.num_batches):
+            # sorted indices keep reads from the memmap mostly sequential
+            idx = np.sort(self._rng.randint(0, nexamples, self.batch_size))
+            full = np.asarray(self._images[idx])
+            # one random offset per example, crops are taken with a single fancy index
+            rows = self._rng.randint(0, height - pheight + 1, self.batch_size)[:, None] + np.arange(pheight)
+            cols = self._rng.randint(0, width - pwidth + 1, self.batch_size)[:, None] + np.arange(pwidth)
+            patches = full[np.arange(self.batch_size)[:, None, None], rows[:, :, None], cols[:, None, :]]
+            yield patches.astype('float32'), np.asarray(self._y[idx], dtype='float32')
+
+
+def _grid_offsets(shape, patch_shape, patch_stride):
+    # corners of the patches on a regular grid over an image of the given shape,
+    # in the order of ExtractGridPatches (last axis fastest)
+    corners = []
+    for size, psize, stride in zip(shape, patch_shape, patch_stride):
+        if psize > size:
+            raise ValueError('the data has width ' + str(size) + ' but the requested patch width is ' + str(psize))
+        corners.append(np.arange(0, size - psize + 1, stride) if stride else np.zeros(1, dtype=int))
+    rows, cols = np.meshgrid(corners[0], corners[1], indexing='ij')
+    return rows.ravel(), cols.ravel()
+
+def _grid_patches(images, offsets, patch_shape, start, stop):
+    # grid patches start:stop of all examples (examples first, then grid positions),
+    # read from the contiguous examples they belong to
+    index = np.arange(start, stop)
+    examples, positions = index // len(offsets[0]), index % len(offsets[0])
+    full = np.asarray(images[examples[0]:examples[-1] + 1])
+    rows = offsets[0][positions][:, None] + np.arange(patch_shape[0])
+    cols = offsets[1][positions][:, None] + np.arange(patch_shape[1])
+    return full[(examples - examples[0])[:, None, None], rows[:, :, None], cols[:, None, :]]
+
+
+class GridPatchIterator(PrefetchIterator):
+    """
+    Iterates over minibatches of the patches on a regular grid (given by the
+    patch offsets) of every example of a topological array, in order:
+    examples first, then grid positions. Deterministic variant of
+    RandomPatchIterator for evaluation; the last minibatch may be smaller.
+    """
+    stochastic = False
+    uneven = True
+    
+    def __init__(self, images, y, patch_shape, offsets, batch_size, num_batches,
+                 spaces=None, sources=('features', 'targets'), return_tuple=False, max_prefetch=2):
+        self._images = images
+        self._y = y
+        self._patch_shape = patch_shape
+        self._offsets = offsets
+        num_examples = min(batch_size * num_batches, images.shape[0] * len(offsets[0]))
+        space = Conv2DSpace(shape=patch_shape, num_channels=images.shape[-1], axes=('b', 0, 1, 'c'))
+        super(GridPatchIterator, self).__init__(batch_size, num_batches, space, spaces=spaces, sources=sources,
+                                                return_tuple=return_tuple, max_prefetch=max_prefetch,
+                                                num_examples=num_examples)
+    
+    def _sample(self, thread):
+        for start in xrange(0, self.num_examples, self.batch_size):
+            stop = min(start + self.batch_size, self.num_examples)
+            patches = _grid_patches(self._images, self._offsets, self._patch_shape, start, stop)
+            examples = np.arange(start, stop) // len(self._offsets[0])
+            yield patches.astype('float32'), np.asarray(self._y[examples], dtype='float32')
+
 
 class WhaleRedux(DenseDesignMatrix):
     
-    def __init__(self, which_set, which_data, start=None, stop=None, preprocessor=None):
+    def __init__(self, which_set, which_data, start=None, stop=None, preprocessor=None, design_path=None):
         assert which_set in ['train','test']
         assert which_data in ['melspectrum','specfeat']
         
-        X = np.load(os.path.join(DATA_DIR,which_set+'_'+which_data+'.npy'))
-        X = np.cast['float32'](X)
-        # X needs to be 1D, shape info is stored in view_converter
+        if design_path is None:
+            design_path = os.path.join(DATA_DIR,which_set+'_'+which_data+'.npy')
+        
+        # memory-mapped float32 array, so building several splits costs no RAM;
+        # designs are checked for NaNs when they are written (see utils.streamprep)
+        X = streamprep.load_float32(design_path)
+        # X needs to be 1D, shape info is stored in view_converter (reshape is a view)
         X = np.reshape(X,(X.shape[0], np.prod(X.shape[1:])))
         
         if which_set == 'test':
             # dummy targets
             y = np.zeros((X.shape[0],2))
         else:
-            y = np.load(os.path.join(DATA_DIR,'targets.npy'))
+            y = np.load(os.path.join(DATA_DIR,'targets.npy'), mmap_mode='r')
             
         if start is not None:
             assert start >= 0
             assert stop > start
             assert stop <= X.shape[0]
+            # slicing a memmap gives a zero-copy view
             X = X[start:stop, :]
             y = y[start:stop]
             assert X.shape[0] == y.shape[0]
@@ -125,73 +197,106 @@ class WhaleRedux(DenseDesignMatrix):
             
         super(WhaleRedux,self).__init__(X=X, y=y, view_converter=view_converter)
         
-        assert not np.any(np.isnan(self.X))
-        
         if preprocessor:
             preprocessor.apply(self)
 
 
-def get_dataset(which_data, tot=False):
-    train_path = DATA_DIR+'train_'+which_data+'_preprocessed.pkl'
-    valid_path = DATA_DIR+'valid_'+which_data+'_preprocessed.pkl'
-    tottrain_path = DATA_DIR+'tottrain_'+which_data+'_preprocessed.pkl'
-    test_path = DATA_DIR+'test_'+which_data+'_preprocessed.pkl'
+class WhaleReduxPatches(WhaleRedux):
+    """
+    WhaleRedux data set whose examples are patches of shape patch_shape of the
+    (memory-mapped) spectrograms, cut out per minibatch instead of being
+    materialized. Models trained on it take patch_shape inputs. X holds the
+    whole clips and is only the backing store.
     
-    if os.path.exists(train_path) and os.path.exists(valid_path) and os.path.exists(test_path):
-        
-        print 'loading preprocessed data'
-        trainset = serial.load(train_path)
-        validset = serial.load(valid_path)
-        if tot:
-            tottrainset = serial.load(tottrain_path)
-        testset = serial.load(test_path)
+    For training (pylearn2's 'random_uniform' iteration mode, set SGD's
+    train_iteration_mode), patches are random crops sampled with replacement,
+    and an epoch has as many patches as there are clips. Evaluation
+    (sequential iteration, which the monitor uses, and utils.inference) goes
+    over the patches on a grid with patch_stride (by default half a patch)
+    of every clip, in order, so its scores are stable; average the outputs
+    per clip with utils.inference.per_example.
+    """
+    def __init__(self, which_set, which_data, patch_shape, patch_stride=None, start=None, stop=None,
+                 design_path=None):
+        super(WhaleReduxPatches,self).__init__(which_set=which_set, which_data=which_data,
+                                               start=start, stop=stop, design_path=design_path)
+        self.patch_shape = tuple(patch_shape)
+        if patch_stride is None:
+            patch_stride = tuple(max(1, p // 2) for p in patch_shape)
+        self.patch_stride = tuple(patch_stride)
+        self.patch_offsets = _grid_offsets(self.view_converter.shape[:2], self.patch_shape, self.patch_stride)
+        self.patches_per_example = len(self.patch_offsets[0])
+    
+    def _images(self):
+        # DefaultViewConverter with ('b', 0, 1, 'c') axes, so this is a view
+        return np.reshape(self.X, (self.X.shape[0],) + tuple(self.view_converter.shape))
+    
+    def get_num_examples(self):
+        return self.X.shape[0] * self.patches_per_example
+    
+    def get_topological_batch(self, start, stop):
+        """Grid patches start:stop, as a ('b', 0, 1, 'c') array
+        """
+        return _grid_patches(self._images(), self.patch_offsets, self.patch_shape, start, stop)
+    
+    def iterator(self, mode=None, batch_size=None, num_batches=None, topo=None, targets=None,
+                 rng=None, data_specs=None, return_tuple=False):
+        # topological batches, or flattened ones without topo
+        flat_space = VectorSpace(int(np.prod(self.patch_shape)) * self.view_converter.shape[-1])
+        spaces, sources = iterator_specs(data_specs, topo, targets, flat_space)
+        if mode == 'random_uniform':
+            if num_batches is None:
+                num_batches = self.X.shape[0] // batch_size
+            return RandomPatchIterator(self._images(), self.y, self.patch_shape, batch_size, num_batches, rng=rng,
+                                       spaces=spaces, sources=sources, return_tuple=return_tuple)
+        if mode not in (None, 'sequential'):
+            raise ValueError('WhaleReduxPatches samples random patches for training (random_uniform) and '
+                             'iterates over grid patches sequentially, iteration mode ' + str(mode) +
+                             ' is not supported')
+        batches = (self.get_num_examples() + batch_size - 1) // batch_size
+        if num_batches is None or num_batches > batches:
+            num_batches = batches
+        return GridPatchIterator(self._images(), self.y, self.patch_shape, self.patch_offsets, batch_size,
+                                 num_batches, spaces=spaces, sources=sources, return_tuple=return_tuple)
+
+
+def get_dataset(which_data, tot=False, patch_shape=None, patch_stride=None):
+    train_path = os.path.join(DATA_DIR,'train_'+which_data+'.npy')
+    test_path = os.path.join(DATA_DIR,'test_'+which_data+'.npy')
+    cache_dir = os.path.join(DATA_DIR,'prepcache')
+    
+    if which_data == 'melspectrum':
+        # global standardization followed by ZCA = zero-phase component analysis
+        # very similar to PCA, but preserves the look of the original image better
+        #ExtractGridPatchesWithY(patch_shape=(16,16),patch_stride=(8,8))
+        pipeline = {'global_std': True, 'zca': True}
     else:
-        
-        print 'loading raw data...'
-        trainset = WhaleRedux(which_set='train', which_data=which_data, start=0, stop=40000)
-        validset = WhaleRedux(which_set='train', which_data=which_data, start=40000, stop=47841)
-        tottrainset = WhaleRedux(which_set='train', which_data=which_data)
-        testset = WhaleRedux(which_set='test', which_data=which_data)
-        
-        print 'preprocessing data...'
-        pipeline = preprocessing.Pipeline()
-        
-        if which_data == 'melspectrum':
-            #pipeline.items.append(ExtractGridPatchesWithY(patch_shape=(16,16),patch_stride=(8,8)))
-            pipeline.items.append(preprocessing.Standardize(global_mean=True, global_std=True))
-            #pipeline.items.append(preprocessing.GlobalContrastNormalization(sqrt_bias=10., use_std=True))
-            # ZCA = zero-phase component analysis
-            # very similar to PCA, but preserves the look of the original image better
-            pipeline.items.append(preprocessing.ZCA())
-        else:
-            #pipeline.items.append(ExtractGridPatchesWithY(patch_shape=(16,1),patch_stride=(8,1)))
-            # global_mean/std=False voor per-feature standardization
-            pipeline.items.append(preprocessing.Standardize(global_mean=False, global_std=False))
-        
-        trainset.apply_preprocessor(preprocessor=pipeline, can_fit=True)
-        # this uses numpy format for storage instead of pickle, for memory reasons
-        trainset.use_design_loc(DATA_DIR+'train_'+which_data+'_design.npy')
-        # note the can_fit=False: no sharing between train and valid data
-        validset.apply_preprocessor(preprocessor=pipeline, can_fit=False)
-        validset.use_design_loc(DATA_DIR+'valid_'+which_data+'_design.npy')
-        tottrainset.apply_preprocessor(preprocessor=pipeline, can_fit=True)
-        tottrainset.use_design_loc(DATA_DIR+'tottrain_'+which_data+'_design.npy')
-        # note the can_fit=False: no sharing between train and test data
-        testset.apply_preprocessor(preprocessor=pipeline, can_fit=False)
-        testset.use_design_loc(DATA_DIR+'test_'+which_data+'_design.npy')
-        
-        # this path can be used for visualizing weights after training is done
-        trainset.yaml_src = '!pkl: "%s"' % train_path
-        validset.yaml_src = '!pkl: "%s"' % valid_path
-        tottrainset.yaml_src = '!pkl: "%s"' % tottrain_path
-        testset.yaml_src = '!pkl: "%s"' % test_path
-        
-        print 'saving preprocessed data...'
-        serial.save(DATA_DIR+'train_'+which_data+'_preprocessed.pkl', trainset)
-        serial.save(DATA_DIR+'valid_'+which_data+'_preprocessed.pkl', validset)
-        serial.save(DATA_DIR+'tottrain_'+which_data+'_preprocessed.pkl', tottrainset)
-        serial.save(DATA_DIR+'test_'+which_data+'_preprocessed.pkl', testset)
-        
+        #ExtractGridPatchesWithY(patch_shape=(16,1),patch_stride=(8,1))
+        # per-feature standardization
+        pipeline = {'global_std': False, 'zca': False}
+    
+    # with a patch_shape, all sets are WhaleReduxPatches: training samples random patches
+    # on the fly, evaluation goes over a grid of patches of every clip
+    if patch_shape is None:
+        dataclass, kwargs = WhaleRedux, {}
+    else:
+        dataclass, kwargs = WhaleReduxPatches, {'patch_shape': patch_shape, 'patch_stride': patch_stride}
+    
+    # fitted parameters are cached by data hash and split; tottrain = train + valid,
+    # so its statistics are the sum of those of both segments and are not recomputed.
+    # Transformed arrays are written once and memory-mapped afterwards
+    segments = [(0, 40000), (40000, 47841)]
+    print 'preprocessing data...'
+    train_design, tot_design, test_design = streamprep.cached_splits(train_path, test_path, segments, cache_dir,
+                                                                     which_data, tot=tot, **pipeline)
+    trainset = dataclass(which_set='train', which_data=which_data, start=0, stop=40000, design_path=train_design,
+                         **kwargs)
+    validset = dataclass(which_set='train', which_data=which_data, start=40000, stop=47841,
+                         design_path=train_design, **kwargs)
+    if tot:
+        tottrainset = dataclass(which_set='train', which_data=which_data, design_path=tot_design, **kwargs)
+    testset = dataclass(which_set='test', which_data=which_data, design_path=test_design, **kwargs)
+    
     if tot:
         return tottrainset, validset, testset
     else:
@@ -3,9 +3,11 @@
 import os
 import aifc
 import numpy as np
-import yaafelib as yl
 import re
 
+from utils import streamprep
+from WhaleRedux import clipcache
+
 datdir   = '/home/nico/datasets/Kaggle/WhaleRedux'
 traindir = os.path.join(datdir,'train2')
 testdir  = os.path.join(datdir,'test2')
@@ -15,11 +17,30 @@ EXTRA_DATA = False
 SAMPLE_RATE = 2000
 SAMPLE_LENGTH = 2
 
-def read_samples(dir):
-    allSigs = np.zeros( (len(os.listdir(dir)),SAMPLE_LENGTH*SAMPLE_RATE) )
+WINDOW = 'Hanning'
+# using 80 / 40 here produces NaNs in mel spectrum, for some reason
+BLOCK = 120
+STEP = 60
+FEATURE_PLAN = [
+    'CDOD: ComplexDomainOnsetDetection FFTWindow=%s blockSize=%d stepSize=%d' % (WINDOW, BLOCK, STEP),
+    'LPC: LPC LPCNbCoeffs=4 blockSize=%d stepSize=%d' % (BLOCK, STEP),
+    'MelSpec: MelSpectrum FFTWindow=%s MelMaxFreq=600 MelMinFreq=30 MelNbFilters=40 blockSize=%d stepSize=%d' % (WINDOW, BLOCK, STEP),
+    'MFCC: MFCC CepsIgnoreFirstCoeff=1 CepsNbCoeffs=12 FFTWindow=%s MelMaxFreq=600 MelMinFreq=30 MelNbFilters=40 blockSize=%d stepSize=%d' % (WINDOW, BLOCK, STEP),
+    'SF: SpectralFlux FFTWindow=%s FluxSupport=Increase blockSize=%d stepSize=%d' % (WINDOW, BLOCK, STEP),
+    'SpecStats: SpectralShapeStatistics FFTWindow=%s blockSize=%d stepSize=%d' % (WINDOW, BLOCK, STEP),
+    'SpecSlope: SpectralSlope FFTWindow=%s blockSize=%d stepSize=%d' % (WINDOW, BLOCK, STEP),
+    'SpecVar: SpectralVariation FFTWindow=%s blockSize=%d stepSize=%d' % (WINDOW, BLOCK, STEP),
+    ]
+
+def read_samples(dir, filenames=None):
+    '''Reads all clips in dir, or only the given filenames
+    '''
+    listing = os.listdir(dir) if filenames is None else filenames
+    # raw PCM stays int16
+    allSigs = np.zeros( (len(listing),SAMPLE_LENGTH*SAMPLE_RATE), dtype='int16' )
     filenames = []
     targets = []
-    for cnt, filename in enumerate(os.listdir(dir)):
+    for cnt, filename in enumerate(listing):
         if os.path.isfile(os.path.join(dir, filename)):
             filenames.append(filename)
             if dir == traindir:
@@ -35,7 +56,7 @@ def read_samples(dir):
             elif nframes < 4000:
                 # appending is OK instead of symmetrical prepending and appending,
                 # since we're going to sample patches anyway
-                sig = np.append(sig,np.zeros(4000-nframes))
+                sig = np.append(sig,np.zeros(4000-nframes,dtype=sig.dtype))
             allSigs[cnt,:] = sig
             sample.close()
     
@@ -46,20 +67,12 @@ def read_samples(dir):
 def extract_audio_features(sigdata):
     '''Extracts a bunch of audio features using YAAFE
     '''
-    window = 'Hanning'
-    # using 80 / 40 here produces NaNs in mel spectrum, for some reason
-    block = 120
-    step = 60
+    # imported here, so reading clips works without YAAFE
+    import yaafelib as yl
     
     fp = yl.FeaturePlan(sample_rate=SAMPLE_RATE)
-    fp.addFeature('CDOD: ComplexDomainOnsetDetection FFTWindow=%s blockSize=%d stepSize=%d' % (window, block, step))
-    fp.addFeature('LPC: LPC LPCNbCoeffs=4 blockSize=%d stepSize=%d' % (block, step))
-    fp.addFeature('MelSpec: MelSpectrum FFTWindow=%s MelMaxFreq=600 MelMinFreq=30 MelNbFilters=40 blockSize=%d stepSize=%d' % (window, block, step))
-    fp.addFeature('MFCC: MFCC CepsIgnoreFirstCoeff=1 CepsNbCoeffs=12 FFTWindow=%s MelMaxFreq=600 MelMinFreq=30 MelNbFilters=40 blockSize=%d stepSize=%d' % (window, block, step))
-    fp.addFeature('SF: SpectralFlux FFTWindow=%s FluxSupport=Increase blockSize=%d stepSize=%d' % (window, block, step))
-    fp.addFeature('SpecStats: SpectralShapeStatistics FFTWindow=%s blockSize=%d stepSize=%d' % (window, block, step))
-    fp.addFeature('SpecSlope: SpectralSlope FFTWindow=%s blockSize=%d stepSize=%d' % (window, block, step))
-    fp.addFeature('SpecVar: SpectralVariation FFTWindow=%s blockSize=%d stepSize=%d' % (window, block, step))
+    for feature in FEATURE_PLAN:
+        fp.addFeature(feature)
     df = fp.getDataFlow()
     # df.display()
     
@@ -68,39 +81,42 @@ def extract_audio_features(sigdata):
     
     feats = []
     for cnt in range(sigdata.shape[0]):
-        signal = np.reshape(sigdata[cnt,:],[1,-1])
-        feats.append(engine.processAudio(signal))
+        signal = np.reshape(sigdata[cnt,:],[1,-1]).astype('float64')
+        # keep features as float32, float64 copies of all of them do not fit in memory
+        feats.append(dict((k, v.astype('float32')) for k, v in engine.processAudio(signal).items()))
     
     return feats
 
 if __name__ == '__main__':
     
     for curstr in ('train','test'):
-        # read samples and store file numbers
-        names, targs, sigs = read_samples(eval(curstr+'dir'))
-        
-        #sort everything properly
-        names = np.array(names)
+        curdir = eval(curstr+'dir')
+        names = np.array(sorted(fn for fn in os.listdir(curdir) if os.path.isfile(os.path.join(curdir, fn))))
         if curstr == 'train':
-            targets = targs[names.argsort()]
-        sigs = sigs[names.argsort()]
-        names.sort()
+            targets = np.array([int(re.search('(ms_TRAIN[0-9]*\_([0-9]*))',fn).group(2)) for fn in names])
         
         # save names for submissions
         if curstr == 'test':
             np.save(os.path.join(datdir,'filenames'), names)
         
-        # standardize all signals
-        sigs = sigs - np.mean(sigs, axis=1, keepdims=True)
-        sigs = sigs / np.std(sigs, axis=1, keepdims=True)
+        # features are cached per clip, keyed by clip content and feature plan,
+        # so only new or changed clips are read and processed
+        cache = clipcache.ClipCache(os.path.join(datdir,'clipcache'), 'features', plan=FEATURE_PLAN, \
+                    sample_rate=SAMPLE_RATE, sample_length=SAMPLE_LENGTH, standardized=True, dtype='float32')
+        hashes = [clipcache.file_hash(os.path.join(curdir, fn)) for fn in names]
         
-        # now we can extract features
-        feats = extract_audio_features(sigs)
+        def compute(indices):
+            # standardize all signals
+            sigs = streamprep.standardize_rows(read_samples(curdir, list(names[indices]))[2])
+            # now we can extract features
+            feats = extract_audio_features(sigs)
+            # split into 2 data sets with 2D and 1D data, respectively
+            return [{'melspectrum': x['MelSpec'], 'specfeat': np.concatenate((x['MFCC'],x['CDOD'],x['LPC'],x['SF'], \
+                    x['SpecStats'],x['SpecSlope'],x['SpecVar']),axis=1)} for x in feats]
         
-        # split into 2 data sets with 2D and 1D data, respectively
-        melspectrum = np.array([x['MelSpec'] for x in feats])
-        specfeat = np.array([np.concatenate((x['MFCC'],x['CDOD'],x['LPC'],x['SF'], \
-                    x['SpecStats'],x['SpecSlope'],x['SpecVar']),axis=1) for x in feats])
+        feats = cache.fetch(hashes, compute)
+        melspectrum = np.array([x['melspectrum'] for x in feats], dtype='float32')
+        specfeat = np.array([x['specfeat'] for x in feats], dtype='float32')
         
         if EXTRA_DATA:
             if curstr == 'train':
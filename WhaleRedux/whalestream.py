@@ -0,0 +1,161 @@
+#!/usr/bin/python
+
+'''
+Streaming whale call detector for continuous 2 kHz audio
+
+Incoming samples of all channels are processed together. Every hop of STEP
+samples completes one spectrogram frame, whose FFT is computed once and kept
+in a ring buffer of the last NFRAMES frames, so sliding windows share their
+frames. Every score_step samples, the window of the last NFRAMES frames
+of every channel is turned into a mel spectrum like the training clips
+were, i.e. after standardizing the last CLIP_SAMPLES samples (2 s, the
+length of a training clip), and scored by the trained model.
+
+Standardization does not need new FFTs: subtracting the window mean from the
+samples subtracts mean * FFT(window function) from every frame's spectrum,
+and dividing by the std scales the magnitudes.
+
+The mel spectrum follows YAAFE's MelSpectrum (Hanning window, magnitude
+spectrum, triangular mel filters) with the parameters in whalefeatures; the
+first frame of a window sees real samples instead of YAAFE's clip padding.
+'''
+
+import numpy as np
+
+from utils import inference, streamprep
+
+SAMPLE_RATE = 2000
+# frame parameters and mel filter bank, same as in whalefeatures
+BLOCK = 120
+STEP = 60
+MEL_FILTERS = 40
+MEL_MIN = 30.
+MEL_MAX = 600.
+# frames per window, as in the training data
+NFRAMES = 67
+# samples covered by the frames of a window
+FRAME_SPAN = (NFRAMES - 1) * STEP + BLOCK
+# samples a window is standardized over, the length of a training clip
+CLIP_SAMPLES = 2 * SAMPLE_RATE
+
+
+def mel_filterbank(nfilters=MEL_FILTERS, fmin=MEL_MIN, fmax=MEL_MAX, nfft=BLOCK, sample_rate=SAMPLE_RATE):
+    '''Triangular filters, equally spaced on the mel scale, as an
+    (nfft // 2 + 1, nfilters) matrix applied to magnitude spectra
+    '''
+    mel = lambda f: 2595. * np.log10(1. + f / 700.)
+    edges = 700. * (10 ** (np.linspace(mel(fmin), mel(fmax), nfilters + 2) / 2595.) - 1.)
+    freqs = np.arange(nfft // 2 + 1) * float(sample_rate) / nfft
+    lower, center, upper = edges[:-2], edges[1:-1], edges[2:]
+    rising = (freqs[:, None] - lower) / (center - lower)
+    falling = (upper - freqs[:, None]) / (upper - center)
+    return np.maximum(0., np.minimum(rising, falling)).astype('float32')
+
+
+class StreamingDetector(object):
+    '''Scores sliding windows of continuous multi-channel audio.
+
+    score is a function mapping a (windows, NFRAMES * MEL_FILTERS) array of
+    mel spectra to one score per window, e.g. from model_scorer. A window
+    ending at the current sample is scored every score_step samples, once
+    the first full window has been seen; score_step is a multiple of STEP.
+    '''
+    def __init__(self, score, num_channels=1, score_step=10 * STEP):
+        assert score_step % STEP == 0, 'score_step needs to be a multiple of STEP'
+        self.score = score
+        self.num_channels = num_channels
+        self.score_step = score_step
+
+        self._window = np.hanning(BLOCK).astype('float32')
+        self._window_fft = np.fft.rfft(self._window)
+        self._filters = mel_filterbank()
+
+        # sample ring holds exactly the samples the current window is standardized over
+        self._samples = np.zeros((num_channels, CLIP_SAMPLES), dtype='float32')
+        self._spectra = np.zeros((num_channels, NFRAMES, BLOCK // 2 + 1), dtype='complex64')
+        # samples of the frame in progress
+        self._tail = np.zeros((num_channels, 0), dtype='float32')
+        self._nsamples = 0
+        self._nframes = 0
+
+    def _push(self, chunk):
+        # ring buffer of samples, chunks longer than the ring only leave their end
+        n = chunk.shape[1]
+        keep = min(n, CLIP_SAMPLES)
+        slots = (self._nsamples + np.arange(n - keep, n)) % CLIP_SAMPLES
+        self._samples[:, slots] = chunk[:, n-keep:]
+        self._nsamples += n
+
+        # frames completed by this chunk, all channels in one FFT
+        buf = np.concatenate((self._tail, chunk), axis=1)
+        nnew = (buf.shape[1] - BLOCK) // STEP + 1 if buf.shape[1] >= BLOCK else 0
+        if nnew > 0:
+            frames = np.lib.stride_tricks.as_strided(buf, shape=(self.num_channels, nnew, BLOCK),
+                        strides=(buf.strides[0], STEP * buf.strides[1], buf.strides[1]))
+            spectra = np.fft.rfft(frames * self._window, axis=2)
+            slots = (self._nframes + np.arange(nnew)) % NFRAMES
+            self._spectra[:, slots] = spectra
+            self._nframes += nnew
+        self._tail = buf[:, nnew * STEP:].copy()
+
+    def _windows(self):
+        # frames in temporal order, oldest first
+        order = (self._nframes + np.arange(NFRAMES)) % NFRAMES
+        spectra = self._spectra[:, order]
+        mean = self._samples.mean(axis=1)
+        std = self._samples.std(axis=1)
+        std[std == 0] = 1.
+        spectra = spectra - mean[:, None, None] * self._window_fft
+        mel = np.dot(np.abs(spectra), self._filters) / std[:, None, None]
+        return np.reshape(mel, (self.num_channels, -1)).astype('float32')
+
+    def process(self, samples):
+        '''Feeds a (num_channels, n) block of samples (any dtype, e.g. raw int16)
+        and returns the windows scored in it, as an array with the stream
+        position (in samples) of each window's end and a (windows, num_channels)
+        array of scores.
+        '''
+        samples = np.asarray(samples, dtype='float32')
+        if samples.ndim == 1:
+            samples = samples[None, :]
+        assert samples.shape[0] == self.num_channels
+
+        positions = []
+        scores = []
+        start = 0
+        while start < samples.shape[1]:
+            # cut the block at scoring positions, the sample ring then holds the window
+            stop = min(samples.shape[1], start + self.score_step - self._nsamples % self.score_step)
+            self._push(samples[:, start:stop])
+            start = stop
+            if self._nsamples % self.score_step == 0 and self._nsamples >= FRAME_SPAN:
+                positions.append(self._nsamples)
+                scores.append(self.score(self._windows()))
+
+        return np.array(positions, dtype='int64'), np.reshape(scores, (len(scores), self.num_channels))
+
+
+def model_scorer(model, params):
+    '''Score function for StreamingDetector: applies preprocessing parameters
+    fitted on the training mel spectra (see utils.streamprep.cached_fit) and
+    returns the model's whale probability per window
+    '''
+    propagate = inference.get_propagator(model)
+    space = model.get_input_space()
+    batch_size = model.batch_size
+    shape = (NFRAMES, MEL_FILTERS, 1)
+    axes = ('b', 0, 1, 'c')
+
+    def score(windows):
+        X = streamprep.apply_params(windows, params, np.empty(windows.shape, dtype='float32'))
+        rval = np.empty(X.shape[0])
+        # the compiled conv ops need full batches
+        batch = np.zeros((batch_size,) + shape, dtype='float32')
+        for start in xrange(0, X.shape[0], batch_size):
+            stop = min(start + batch_size, X.shape[0])
+            batch[:stop-start] = np.reshape(X[start:stop], (-1,) + shape)
+            topo = batch.transpose([axes.index(axis) for axis in space.axes])
+            rval[start:stop] = propagate(topo)[0][:stop-start, 0]
+        return rval
+
+    return score
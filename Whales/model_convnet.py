@@ -1,8 +1,8 @@
 #!/usr/bin/python
 
 import numpy as np
-from theano import function
 import Whales.whaledata
+from utils import inference
 
 from pylearn2.train import Train
 from pylearn2.models.mlp import MLP, ConvRectifiedLinear, Softmax, Linear, Sigmoid, RectifiedLinear
@@ -69,34 +69,6 @@ def get_trainer(model, trainset, validset, epochs=50):
     return Train(model=model, algorithm=train_algo, dataset=trainset, save_freq=0, save_path='epoch', \
             extensions=[MomentumAdjustor(final_momentum=0.95, start=0, saturate=int(epochs*0.8)), ])
 
-def get_output(model, tdata, layerindex, batch_size=200):
-    # get output submodel classifiers
-    Xb = model.get_input_space().make_theano_batch()
-    Yb = model.fprop(Xb, apply_dropout=False, return_all=True)
-    
-    data = tdata.get_topological_view()
-    # fill up with zeroes for dividible by batch number
-    extralength = batch_size - data.shape[0]%batch_size
-    
-    if extralength < batch_size:
-        data = np.append(data,np.zeros([extralength, data.shape[1],data.shape[2],data.shape[3]]), axis=0)
-        data = data.astype('float32')
-    
-    propagate = function([Xb], Yb)
-    
-    output = []
-    for ii in xrange(int(data.shape[0]/batch_size)):
-        seldata = data[ii*batch_size:(ii+1)*batch_size,:]
-        output.append(propagate(seldata)[layerindex])
-    
-    output = np.reshape(output,[data.shape[0],-1])
-    
-    if extralength < batch_size:
-        # remove the filler
-        output = output[:-extralength]
-    
-    return output
-
 
 if __name__ == '__main__':
     
@@ -113,21 +85,17 @@ if __name__ == '__main__':
     
     # validate model
     if not submission:
-        output = get_output(model,validset)
+        output = inference.get_output(model,validset)
         # calculate AUC using sklearn
         AUC = auc_score(validset.get_targets()[:,0],output[:,0])
         print AUC
     else:
-        outtestset = get_output(model,testset,-1)
+        # one pass per data set gives both the output and the data sets with model output
+        outtestset, _ = inference.export_activations(model, testset, DATA_DIR+'conv2alt', 'test', 200)
         # save test output as submission
         np.savetxt(DATA_DIR+'model_conv2net.csv', outtestset[:,0], delimiter=",")
         
-        # construct data sets with model output
-        outtrainset = get_output(model,trainset,-2)
-        outtestset = get_output(model,testset,-2)
-        
-        np.save(DATA_DIR+'conv2altout_train', outtrainset)
-        np.save(DATA_DIR+'conv2altout_test', outtestset)
+        inference.export_activations(model, trainset, DATA_DIR+'conv2alt', 'train', 200)
     
     
     #########################
@@ -141,18 +109,15 @@ if __name__ == '__main__':
     
     # validate model
     if not submission:
-        output = get_output(model2,validset2)
+        output = inference.get_output(model2,validset2)
         # calculate AUC using sklearn
         AUC = auc_score(validset2.get_targets()[:,0],output[:,0])
         print AUC
     else:
-        outtestset = get_output(model2,testset2,-1)
+        # one pass per data set gives both the output and the data sets with model output
+        outtestset, _ = inference.export_activations(model2, testset2, DATA_DIR+'conv1alt', 'test', 200)
         # save test output as submission
         np.savetxt(DATA_DIR+'model_conv1net.csv', outtestset[:,0], delimiter=",")
         
-        outtrainset = get_output(model2,trainset2,-2)
-        outtestset = get_output(model2,testset2,-2)
-        
-        np.save(DATA_DIR+'conv1altout_train', outtrainset)
-        np.save(DATA_DIR+'conv1altout_test', outtestset)
+        inference.export_activations(model2, trainset2, DATA_DIR+'conv1alt', 'train', 200)
     
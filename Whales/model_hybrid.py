@@ -1,9 +1,10 @@
 #!/usr/bin/python
 
 import numpy as np
-import scipy
 from sklearn import cross_validation, ensemble, metrics, linear_model
 
+from utils import crossval, moments
+
 DATA_DIR = '/home/nico/datasets/Kaggle/Whales/'
 
 def load_data():
@@ -12,23 +13,17 @@ def load_data():
     c1train = np.load(DATA_DIR+'conv1out_train.npy')
     c1test = np.load(DATA_DIR+'conv1out_test.npy')
     
-    spectrain = np.load(DATA_DIR+'trainspecfeat.npy')
-    spectrain = np.concatenate((np.mean(spectrain, axis=1),
-                                np.std(spectrain, axis=1),
-                                scipy.stats.skew(spectrain, axis=1),
-                                np.mean(np.diff(spectrain, axis=1), axis=1)), axis=1)
-    spectest = np.load(DATA_DIR+'testspecfeat.npy')
-    spectest = np.concatenate((np.mean(spectest, axis=1),
-                               np.std(spectest, axis=1),
-                                scipy.stats.skew(spectest, axis=1),
-                                np.mean(np.diff(spectest, axis=1), axis=1)), axis=1)
+    # mean, std, skew and mean difference over time, in one pass over the memmapped data
+    stats = ('mean', 'std', 'skew', 'meandiff')
+    spectrain = moments.summary_stats(DATA_DIR+'trainspecfeat.npy', stats, n_jobs=-1)
+    spectest = moments.summary_stats(DATA_DIR+'testspecfeat.npy', stats, n_jobs=-1)
     
     traindata = np.concatenate((c2train, c1train), axis=1)
     testdata = np.concatenate((c2test, c1test), axis=1)
     
     return traindata, testdata
 
-def train_model(traindata, targets):
+def train_model(traindata, targets, testdata=None):
     
     models = [
                 ensemble.GradientBoostingClassifier(n_estimators=500, learning_rate=0.05, \
@@ -41,17 +36,16 @@ def train_model(traindata, targets):
     # use StratifiedKFold, because survived 0/1 is not evenly distributed
     cv = cross_validation.StratifiedKFold(targets, n_folds=5)
     
-    scores = [0]*len(models)
+    results = [0]*len(models)
     for i in range(len(models)):
-        # get scores
-        scores[i] = cross_validation.cross_val_score(models[i], traindata, targets, \
-                    cv=cv, n_jobs=-1, score_func=metrics.auc_score)
+        # fold models are trained in parallel, their average is the final model
+        results[i] = crossval.cross_val_ensemble(models[i], traindata, targets, cv, \
+                    testdata=testdata, score_func=metrics.auc_score, n_jobs=-1)
+        scores = results[i]['scores']
         print "Cross-validation accuracy on the training set for model %d:" % i
-        print "%0.3f (+/-%0.03f)" % (scores[i].mean(), scores[i].std() / 2)
-        
-        models[i].fit(traindata, targets)
+        print "%0.3f (+/-%0.03f)" % (scores.mean(), scores.std() / 2)
     
-    return models
+    return results
 
 if __name__ == '__main__':
     
@@ -59,8 +53,9 @@ if __name__ == '__main__':
     
     traindata, testdata = load_data()
     
-    models = train_model(traindata, targets)
+    results = train_model(traindata, targets, testdata)
     
-    output = models[0].predict_proba(testdata)
+    np.save(DATA_DIR+'model_hybrid_oof.npy', results[0]['oof'])
+    output = results[0]['test']
     np.savetxt(DATA_DIR+'model_hybrid.csv', output[:,0], delimiter=",")
     
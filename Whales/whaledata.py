@@ -8,33 +8,38 @@ import os
 import numpy as np
 
 from pylearn2.datasets.dense_design_matrix import DenseDesignMatrix, DefaultViewConverter
-from pylearn2.datasets import preprocessing
-import pylearn2.utils.serial as serial
+
+from utils import streamprep
 
 DATA_DIR = '/home/nico/datasets/Kaggle/Whales/'
 
 
 class Whales(DenseDesignMatrix):
     
-    def __init__(self, which_set, which_data, start=None, stop=None, preprocessor=None):
+    def __init__(self, which_set, which_data, start=None, stop=None, preprocessor=None, design_path=None):
         assert which_set in ['train','test']
         assert which_data in ['melspectrum','specfeat']
         
-        X = np.load(os.path.join(DATA_DIR,which_set+which_data+'.npy'))
-        X = np.cast['float32'](X)
-        # X needs to be 1D, shape info is stored in view_converter
+        if design_path is None:
+            design_path = os.path.join(DATA_DIR,which_set+which_data+'.npy')
+        
+        # memory-mapped float32 array, so building several splits costs no RAM;
+        # designs are checked for NaNs when they are written (see utils.streamprep)
+        X = streamprep.load_float32(design_path)
+        # X needs to be 1D, shape info is stored in view_converter (reshape is a view)
         X = np.reshape(X,(X.shape[0], np.prod(X.shape[1:])))
         
         if which_set == 'test':
             # dummy targets
             y = np.zeros((X.shape[0],2))
         else:
-            y = np.load(os.path.join(DATA_DIR,'targets.npy'))
+            y = np.load(os.path.join(DATA_DIR,'targets.npy'), mmap_mode='r')
         
         if start is not None:
             assert start >= 0
             assert stop > start
             assert stop <= X.shape[0]
+            # slicing a memmap gives a zero-copy view
             X = X[start:stop, :]
             y = y[start:stop]
             assert X.shape[0] == y.shape[0]
@@ -48,70 +53,36 @@ class Whales(DenseDesignMatrix):
             
         super(Whales,self).__init__(X=X, y=y, view_converter=view_converter)
         
-        assert not np.any(np.isnan(self.X))
-        
         if preprocessor:
             preprocessor.apply(self)
 
 
 def get_dataset(which_data, tot=False):
-    train_path = DATA_DIR+'train'+which_data+'_preprocessed.pkl'
-    valid_path = DATA_DIR+'valid'+which_data+'_preprocessed.pkl'
-    tottrain_path = DATA_DIR+'tottrain'+which_data+'_preprocessed.pkl'
-    test_path = DATA_DIR+'test'+which_data+'_preprocessed.pkl'
+    train_path = os.path.join(DATA_DIR,'train'+which_data+'.npy')
+    test_path = os.path.join(DATA_DIR,'test'+which_data+'.npy')
+    cache_dir = os.path.join(DATA_DIR,'prepcache')
     
-    if os.path.exists(train_path) and os.path.exists(valid_path) and os.path.exists(test_path):
-        
-        print 'loading preprocessed data'
-        trainset = serial.load(train_path)
-        validset = serial.load(valid_path)
-        if tot:
-            tottrainset = serial.load(tottrain_path)
-        testset = serial.load(test_path)
+    if which_data == 'melspectrum':
+        # global standardization followed by ZCA = zero-phase component analysis
+        # very similar to PCA, but preserves the look of the original image better
+        pipeline = {'global_std': True, 'zca': True}
     else:
-        
-        print 'loading raw data...'
-        trainset = Whales(which_set="train", which_data=which_data, start=0, stop=56671)
-        validset = Whales(which_set="train", which_data=which_data, start=56671, stop=66671)
-        tottrainset = Whales(which_set="train", which_data=which_data)
-        testset = Whales(which_set="test", which_data=which_data)
-        
-        print 'preprocessing data...'
-        pipeline = preprocessing.Pipeline()
-        
-        if which_data == 'melspectrum':
-            pipeline.items.append(preprocessing.Standardize(global_mean=True, global_std=True))
-            # ZCA = zero-phase component analysis
-            # very similar to PCA, but preserves the look of the original image better
-            pipeline.items.append(preprocessing.ZCA())
-        else:
-            # global_mean/std=False voor per-feature standardization
-            pipeline.items.append(preprocessing.Standardize(global_mean=False, global_std=False))
-        
-        trainset.apply_preprocessor(preprocessor=pipeline, can_fit=True)
-        # this uses numpy format for storage instead of pickle, for memory reasons
-        trainset.use_design_loc(DATA_DIR+'train_'+which_data+'_design.npy')
-        # note the can_fit=False: no sharing between train and test data
-        validset.apply_preprocessor(preprocessor=pipeline, can_fit=False)
-        validset.use_design_loc(DATA_DIR+'valid_'+which_data+'_design.npy')
-        tottrainset.apply_preprocessor(preprocessor=pipeline, can_fit=True)
-        tottrainset.use_design_loc(DATA_DIR+'tottrain_'+which_data+'_design.npy')
-        # note the can_fit=False: no sharing between train and test data
-        testset.apply_preprocessor(preprocessor=pipeline, can_fit=False)
-        testset.use_design_loc(DATA_DIR+'test_'+which_data+'_design.npy')
-        
-        # this path can be used for visualizing weights after training is done
-        trainset.yaml_src = '!pkl: "%s"' % train_path
-        validset.yaml_src = '!pkl: "%s"' % valid_path
-        tottrainset.yaml_src = '!pkl: "%s"' % tottrain_path
-        testset.yaml_src = '!pkl: "%s"' % test_path
-        
-        print 'saving preprocessed data...'
-        serial.save(DATA_DIR+'train'+which_data+'_preprocessed.pkl', trainset)
-        serial.save(DATA_DIR+'valid'+which_data+'_preprocessed.pkl', validset)
-        serial.save(DATA_DIR+'tottrain'+which_data+'_preprocessed.pkl', tottrainset)
-        serial.save(DATA_DIR+'test'+which_data+'_preprocessed.pkl', testset)
-        
+        # per-feature standardization
+        pipeline = {'global_std': False, 'zca': False}
+    
+    # fitted parameters are cached by data hash and split; tottrain = train + valid,
+    # so its statistics are the sum of those of both segments and are not recomputed.
+    # Transformed arrays are written once and memory-mapped afterwards
+    segments = [(0, 56671), (56671, 66671)]
+    print 'preprocessing data...'
+    train_design, tot_design, test_design = streamprep.cached_splits(train_path, test_path, segments, cache_dir,
+                                                                     which_data, tot=tot, **pipeline)
+    trainset = Whales(which_set='train', which_data=which_data, start=0, stop=56671, design_path=train_design)
+    validset = Whales(which_set='train', which_data=which_data, start=56671, stop=66671, design_path=train_design)
+    if tot:
+        tottrainset = Whales(which_set='train', which_data=which_data, design_path=tot_design)
+    testset = Whales(which_set='test', which_data=which_data, design_path=test_design)
+    
     if tot:
         return tottrainset, validset, testset
     else:
@@ -3,10 +3,11 @@
 import os
 import aifc
 import numpy as np
-import yaafelib as yl
 import re
 import pandas as pd
 
+from utils import streamprep
+
 traindir ='/home/nico/datasets/Kaggle/Whales/train'
 testdir  ='/home/nico/datasets/Kaggle/Whales/test'
 datdir   ='/home/nico/datasets/Kaggle/Whales'
@@ -18,7 +19,8 @@ SAMPLE_LENGTH = 2
 DCLDE_DATA = True
 
 def read_samples(dir):
-    allSigs = np.zeros( (len(os.listdir(dir)),SAMPLE_LENGTH*SAMPLE_RATE) )
+    # raw PCM stays int16
+    allSigs = np.zeros( (len(os.listdir(dir)),SAMPLE_LENGTH*SAMPLE_RATE), dtype='int16' )
     filenumbers = []
     for cnt, filename in enumerate(os.listdir(dir)):
         if os.path.isfile(os.path.join(dir, filename)):
@@ -42,6 +44,9 @@ def read_targets():
 def extract_audio_features(sigdata):
     '''Extracts a bunch of audio features using YAAFE
     '''
+    # imported here, so reading clips works without YAAFE
+    import yaafelib as yl
+    
     window = 'Hanning'
     block = 120
     step = 60
@@ -64,8 +69,9 @@ def extract_audio_features(sigdata):
     
     feats = []
     for cnt in range(sigdata.shape[0]):
-        signal = np.reshape(sigdata[cnt,:],[1,-1])
-        feats.append(engine.processAudio(signal))
+        signal = np.reshape(sigdata[cnt,:],[1,-1]).astype('float64')
+        # keep features as float32, float64 copies of all of them do not fit in memory
+        feats.append(dict((k, v.astype('float32')) for k, v in engine.processAudio(signal).items()))
     
     return feats
 
@@ -82,11 +88,10 @@ if __name__ == '__main__':
     
     for curstr in ('train','test'):
         # read samples and store file numbers
-        numbers, sigs = read_samples(eval(curstr+'dir'))
-        
-        # original data is pretty clean, but still remove mean
-        sigs = sigs - np.mean(sigs, axis=1, keepdims=True)
+        numbers, pcm = read_samples(eval(curstr+'dir'))
         
+        # (signals, remove mean?); original data is pretty clean, but still remove mean
+        sources = [(pcm, True)]
         if DCLDE_DATA and curstr == 'train':
             # add DCLDE 2013 Workshop Dataset data
             numbers = [x+36671 for x in numbers]
@@ -98,24 +103,31 @@ if __name__ == '__main__':
             # remove by subtracting simple moving average
             whales = _remove_bias(whales, window=50)
             nowhales = _remove_bias(nowhales, window=50)
-            sigs = np.concatenate((sigs,whales,nowhales))
-            assert len(numbers)==len(sigs)
+            sources.extend([(whales, False), (nowhales, False)])
+            del whales, nowhales
         
         # make sure the data is sorted according to file number
         # (necessary, since sorting is alphanumeric: 1, 10, 100, 2, etc.)
         numbers = np.array(numbers)
-        sigs = sigs[numbers.argsort()]
+        assert len(numbers) == sum(len(data) for data, center in sources)
+        position = np.empty(len(numbers), dtype='int64')
+        position[numbers.argsort()] = np.arange(len(numbers))
         
-        # standardize all signals
-        sigs = sigs / np.std(sigs, axis=1, keepdims=True)
+        # standardize all signals, straight into their sorted positions
+        sigs = np.empty((len(numbers), SAMPLE_LENGTH*SAMPLE_RATE), dtype='float32')
+        start = 0
+        for data, center in sources:
+            streamprep.standardize_rows(data, out=sigs, rows=position[start:start+len(data)], center=center)
+            start += len(data)
+        del sources, pcm
         
         # now we can extract features
         feats = extract_audio_features(sigs)
         
         # split into 2 data sets with 2D and 1D data, respectively
-        melspectrum = np.array([x['MelSpec'] for x in feats])
+        melspectrum = np.array([x['MelSpec'] for x in feats], dtype='float32')
         specfeat = np.array([np.concatenate((x['MFCC'],x['CDOD'],x['LPC'],x['SF'], \
-                    x['SpecStats'],x['SpecSlope'],x['SpecVar']),axis=1) for x in feats])
+                    x['SpecStats'],x['SpecSlope'],x['SpecVar']),axis=1) for x in feats], dtype='float32')
         
         np.save(os.path.join(datdir,curstr+'melspectrum'), melspectrum)
         np.save(os.path.join(datdir,curstr+'specfeat'), specfeat)
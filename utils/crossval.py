@@ -0,0 +1,45 @@
+#!/usr/bin/python
+
+'''
+Cross-validation that keeps what it computes: the fold models are trained
+in parallel, and their out-of-fold predictions and test set predictions are
+returned. The average of the fold models' test predictions serves as the
+submission, so one pass gives both the CV estimate and the submission
+without refitting on all data.
+'''
+
+import numpy as np
+from sklearn.base import clone
+from sklearn.externals.joblib import Parallel, delayed
+
+
+def _fit_fold(model, traindata, targets, train, valid, testdata):
+    model = clone(model)
+    model.fit(traindata[train], targets[train])
+    oof = model.predict_proba(traindata[valid])
+    test = model.predict_proba(testdata) if testdata is not None else None
+    return model, oof, test
+
+def cross_val_ensemble(model, traindata, targets, cv, testdata=None, score_func=None, n_jobs=-1, verbose=0):
+    '''Fits a clone of model on every training fold of cv, in parallel.
+
+    Returns a dict with:
+        'models': the fitted fold models
+        'oof': out-of-fold predict_proba output for all of traindata
+        'test': predict_proba output on testdata, averaged over the fold models
+        'scores': per-fold score_func(targets, positive class probability), if given
+    '''
+    folds = list(cv)
+    results = Parallel(n_jobs=n_jobs, verbose=verbose)(
+        delayed(_fit_fold)(model, traindata, targets, train, valid, testdata) for train, valid in folds)
+
+    oof = np.zeros((len(targets), results[0][1].shape[1]))
+    for (train, valid), (_, foldoof, _) in zip(folds, results):
+        oof[valid] = foldoof
+
+    rval = {'models': [res[0] for res in results], 'oof': oof}
+    if testdata is not None:
+        rval['test'] = np.mean([res[2] for res in results], axis=0)
+    if score_func is not None:
+        rval['scores'] = np.array([score_func(targets[valid], oof[valid, -1]) for train, valid in folds])
+    return rval
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+
+'''
+Batched forward passes through pylearn2 MLPs
+
+The propagation function is compiled once per (model, batch size, layers),
+since conv ops are compiled for the model's batch size, and outputs
+are written into preallocated arrays (in memory or memory-mapped), so no
+list of batch outputs is built up and reshaped afterwards. Batches are cut
+from the design matrix (or by data sets whose examples are patches of its
+rows) and converted to the model's input space one at a time; only the
+ragged final batch is zero-padded, in a batch-sized buffer.
+'''
+
+import copy
+import weakref
+import numpy as np
+from theano import function
+
+# model -> {(batch size, layers): compiled function}
+_propagators = weakref.WeakKeyDictionary()
+
+
+def get_propagator(model, layers=(-1,)):
+    '''Compiled function mapping an input batch to the outputs of the given
+    layers (indices into model.layers), computed in one forward pass. It is
+    recompiled after model.set_batch_size.
+    '''
+    key = (getattr(model, 'batch_size', None), tuple(layers))
+    cache = _propagators.setdefault(model, {})
+    if key not in cache:
+        Xb = model.get_input_space().make_theano_batch()
+        Yb = model.fprop(Xb, return_all=True)
+        cache[key] = function([Xb], [Yb[ii] for ii in layers], allow_input_downcast=True)
+    return cache[key]
+
+def _batch_axis(space):
+    return space.axes.index('b') if hasattr(space, 'axes') else 0
+
+def _get_batch(dataset, space, start, stop):
+    # converts examples start:stop to the model's input space; they are rows of the design
+    # matrix, unless the data set cuts them out itself (get_topological_batch, e.g. patches)
+    if hasattr(dataset, 'get_topological_batch'):
+        topo = dataset.get_topological_batch(start, stop)
+        if not hasattr(space, 'axes'):
+            return np.reshape(topo, (stop - start, -1))
+        dataset_axes = ('b', 0, 1, 'c')
+    else:
+        X = dataset.X[start:stop]
+        if not hasattr(space, 'axes'):
+            return X
+        topo = dataset.get_topological_view(X)
+        dataset_axes = tuple(getattr(dataset.view_converter, 'axes', ('b', 0, 1, 'c')))
+    if dataset_axes != tuple(space.axes):
+        topo = topo.transpose([dataset_axes.index(axis) for axis in space.axes])
+    return topo
+
+def _allocate(target, shape):
+    if target is None:
+        return np.empty(shape, dtype='float32')
+    elif isinstance(target, basestring):
+        return np.lib.format.open_memmap(target, mode='w+', dtype='float32', shape=shape)
+    assert tuple(target.shape) == tuple(shape)
+    return target
+
+def get_outputs(model, dataset, layers=(-1,), batch_size=None, out=None):
+    '''Runs the whole data set through the model once and returns the outputs
+    of all requested layers, each flattened to (examples, features).
+
+    out optionally gives, per layer, a preallocated array or the path of a
+    .npy file to write the output to as a memmap (None: array in memory).
+    batch_size defaults to the model's (fixed) batch size.
+    '''
+    layers = tuple(layers)
+    if out is None:
+        out = [None] * len(layers)
+    if batch_size is None:
+        batch_size = getattr(model, 'batch_size', None) or 100
+    space = model.get_input_space()
+    axis = _batch_axis(space)
+    propagate = get_propagator(model, layers)
+    # batch axis of every output, conv layers may have it last
+    out_axes = [_batch_axis(model.layers[ii].get_output_space()) for ii in layers]
+
+    nexamples = dataset.get_num_examples()
+    buf = None
+    outputs = None
+    for start in xrange(0, nexamples, batch_size):
+        stop = min(start + batch_size, nexamples)
+        batch = _get_batch(dataset, space, start, stop)
+        if stop - start < batch_size:
+            # fill up with zeros, conv ops need a fixed batch size
+            if buf is None:
+                shape = list(batch.shape)
+                shape[axis] = batch_size
+                buf = np.zeros(shape, dtype='float32')
+            index = [slice(None)] * buf.ndim
+            index[axis] = slice(0, stop - start)
+            buf[tuple(index)] = batch
+            index[axis] = slice(stop - start, None)
+            buf[tuple(index)] = 0
+            batch = buf
+
+        results = [np.rollaxis(res, out_axis) for res, out_axis in zip(propagate(batch), out_axes)]
+        if outputs is None:
+            outputs = [_allocate(target, (nexamples, int(np.prod(res.shape)) // batch_size))
+                       for target, res in zip(out, results)]
+        for output, res in zip(outputs, results):
+            output[start:stop] = np.reshape(res, (batch_size, -1))[:stop - start]
+
+    if outputs is None:
+        # empty data set
+        outputs = [_allocate(target, (0, model.layers[ii].get_output_space().get_total_dimension()))
+                   for target, ii in zip(out, layers)]
+    return outputs
+
+def get_output(model, dataset, layerindex=-1, batch_size=None, out=None):
+    '''Output of a single layer, see get_outputs
+    '''
+    return get_outputs(model, dataset, (layerindex,), batch_size, None if out is None else [out])[0]
+
+def per_example(output, dataset):
+    '''Averages outputs over the patches of every example, for data sets of
+    patches (with patches_per_example, e.g. WhaleReduxPatches); other outputs
+    are returned as they are
+    '''
+    patches_per_example = getattr(dataset, 'patches_per_example', 1)
+    if patches_per_example == 1:
+        return output
+    output = np.asarray(output)
+    return np.reshape(output, (-1, patches_per_example) + output.shape[1:]).mean(axis=1)
+
+def _subset(dataset, rows):
+    # the same data set over some rows of X only, held in memory
+    subset = copy.copy(dataset)
+    subset.X = np.asarray(dataset.X[rows])
+    return subset
+
+def export_activations(model, dataset, prefix, which_set, batch_size=None, cache=None, key=None, block_size=5000):
+    '''Runs the data set through the network once and writes the final-layer
+    predictions and the penultimate-layer features at the same time, to
+    memory-mapped files <prefix>pred_<which_set>.npy and
+    <prefix>out_<which_set>.npy. Returns both (flushed) memmaps.
+
+    With a cache (e.g. a WhaleRedux ClipCache, which has fetch(keys, compute)),
+    outputs are cached per example under key(row), and only examples that
+    are not in the cache are run through the network, block_size at a time.
+    For data sets of patches, the outputs are averaged per example (see
+    per_example), so there is one row per row of X.
+    '''
+    paths = [prefix + 'pred_' + which_set + '.npy', prefix + 'out_' + which_set + '.npy']
+    if cache is None and getattr(dataset, 'patches_per_example', 1) == 1:
+        outputs = get_outputs(model, dataset, (-1, -2), batch_size, out=paths)
+    else:
+        def compute(indices):
+            entries = []
+            for ii in range(0, len(indices), block_size):
+                subset = _subset(dataset, indices[ii:ii + block_size])
+                pred, out = [per_example(output, dataset)
+                             for output in get_outputs(model, subset, (-1, -2), batch_size)]
+                entries.extend({'pred': p, 'out': o} for p, o in zip(pred, out))
+            return entries
+
+        if cache is None:
+            entries = compute(np.arange(dataset.X.shape[0]))
+        else:
+            entries = cache.fetch([key(row) for row in dataset.X], compute)
+        outputs = []
+        for path, field in zip(paths, ('pred', 'out')):
+            dim = entries[0][field].shape[0] if entries else \
+                model.layers[-1 if field == 'pred' else -2].get_output_space().get_total_dimension()
+            output = np.lib.format.open_memmap(path, mode='w+', dtype='float32', shape=(len(entries), dim))
+            for ii, entry in enumerate(entries):
+                output[ii] = entry[field]
+            outputs.append(output)
+    for output in outputs:
+        output.flush()
+    return outputs
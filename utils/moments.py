@@ -0,0 +1,84 @@
+#!/usr/bin/python
+
+'''
+Summary statistics over the time axis of (examples, time, features) arrays,
+such as the spectral feature arrays, computed in a single sweep over the
+(memory-mapped) data.
+
+Each block of examples is read once and all statistics are derived from
+its central moments. The mean of the first differences is (x[-1] - x[0]) / (T - 1),
+so no differenced copy is needed for it. Blocks can be spread over
+processes, which reopen the memmap themselves.
+'''
+
+import multiprocessing
+import numpy as np
+
+STATS = ('mean', 'std', 'var', 'skew', 'kurtosis', 'meandiff', 'stddiff')
+
+
+def _block_stats(X, stats):
+    X = np.asarray(X, dtype='float64')
+    ntime = X.shape[1]
+    mean = X.mean(axis=1)
+    rval = {'mean': mean}
+    if set(stats) & set(('std', 'var', 'skew', 'kurtosis')):
+        dev = X - mean[:, None, :]
+        dev2 = dev ** 2
+        m2 = dev2.mean(axis=1)
+        zero = m2 == 0
+        # same conventions as np.std and scipy.stats.skew/kurtosis (biased, Fisher)
+        rval['var'] = m2
+        rval['std'] = np.sqrt(m2)
+        if 'skew' in stats:
+            m3 = (dev2 * dev).mean(axis=1)
+            rval['skew'] = np.where(zero, 0., m3 / np.where(zero, 1., m2) ** 1.5)
+        if 'kurtosis' in stats:
+            m4 = (dev2 ** 2).mean(axis=1)
+            rval['kurtosis'] = np.where(zero, -3., m4 / np.where(zero, 1., m2) ** 2 - 3.)
+    if 'meandiff' in stats:
+        rval['meandiff'] = (X[:, -1] - X[:, 0]) / (ntime - 1)
+    if 'stddiff' in stats:
+        rval['stddiff'] = np.diff(X, axis=1).std(axis=1)
+    return np.concatenate([rval[stat] for stat in stats], axis=1)
+
+def _block_worker(args):
+    path, start, stop, stats = args
+    return start, _block_stats(np.load(path, mmap_mode='r')[start:stop], stats)
+
+def summary_stats(X, stats=('mean', 'std', 'skew', 'meandiff'), block_size=2000, n_jobs=1):
+    '''Statistics over axis 1 of X, concatenated along the feature axis in the
+    order given by stats (any of STATS). Returns an (examples, len(stats) * features)
+    float64 array.
+
+    X is an array, memmap or the path of a .npy file. With n_jobs > 1, blocks
+    are processed by a multiprocessing pool; X then needs to be a .npy path.
+    '''
+    for stat in stats:
+        assert stat in STATS
+    if isinstance(X, basestring):
+        path = X
+        X = np.load(path, mmap_mode='r')
+    else:
+        path = None
+    assert X.ndim == 3
+
+    nexamples = X.shape[0]
+    out = np.empty((nexamples, len(stats) * X.shape[2]))
+    if n_jobs == 1:
+        for start in xrange(0, nexamples, block_size):
+            out[start:start + block_size] = _block_stats(X[start:start + block_size], stats)
+    else:
+        assert path is not None, 'parallel processing needs a .npy file'
+        if n_jobs < 0:
+            n_jobs = multiprocessing.cpu_count()
+        chunks = [(path, start, min(start + block_size, nexamples), stats)
+                  for start in xrange(0, nexamples, block_size)]
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            for start, block in pool.imap_unordered(_block_worker, chunks):
+                out[start:start + block.shape[0]] = block
+        finally:
+            pool.close()
+            pool.join()
+    return out
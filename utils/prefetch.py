@@ -0,0 +1,124 @@
+#!/usr/bin/python
+
+'''
+Background prefetching for minibatch generators, and a base class for
+pylearn2 iterators whose minibatches are prepared this way
+'''
+
+import sys
+import threading
+import Queue
+
+
+class BackgroundIterator(object):
+    '''Runs a generator in background threads and yields its items through a
+    bounded queue, so that the next minibatches are being prepared (read from
+    disk, cropped, augmented) while the current one is used for training.
+
+    With num_threads > 1 every thread runs its own generator from
+    make_generator(thread_index); items are yielded in arrival order.
+    Exceptions raised in a worker are re-raised in the consuming thread.
+    '''
+    _done = object()
+
+    def __init__(self, make_generator, max_prefetch=2, num_threads=1):
+        self._queue = Queue.Queue(maxsize=max_prefetch)
+        self._running = num_threads
+        self._threads = []
+        for ii in range(num_threads):
+            thread = threading.Thread(target=self._work, args=(make_generator, ii))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self, make_generator, index):
+        try:
+            for item in make_generator(index):
+                self._queue.put((None, item))
+        except Exception:
+            self._queue.put((sys.exc_info(), None))
+        self._queue.put((None, self._done))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while self._running > 0:
+            exc_info, item = self._queue.get()
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if item is self._done:
+                self._running -= 1
+            else:
+                return item
+        raise StopIteration
+
+
+def check_random_mode(mode):
+    '''Randomly sampled minibatches only support pylearn2's random_uniform
+    iteration mode (or none)
+    '''
+    if mode not in (None, 'random_uniform'):
+        raise ValueError('minibatches are sampled randomly with replacement, iteration mode ' + str(mode) +
+                         ' is not supported (use random_uniform)')
+
+def iterator_specs(data_specs, topo=None, targets=None, flat_space=None):
+    '''Spaces and sources requested from a pylearn2 dataset iterator. Without
+    data_specs, features (and targets, with targets) are requested, as
+    topological batches with topo, else in flat_space.
+    '''
+    if data_specs is None:
+        spaces, sources = (None if topo else flat_space, None), ('features', 'targets')
+        if not targets:
+            spaces, sources = spaces[:1], sources[:1]
+    elif isinstance(data_specs[1], tuple):
+        spaces, sources = data_specs[0].components, data_specs[1]
+    else:
+        spaces, sources = (data_specs[0],), (data_specs[1],)
+    return spaces, sources
+
+
+class PrefetchIterator(object):
+    '''Base class of pylearn2 iterators whose minibatches are prepared in the
+    background. Subclasses set up their state and then call this __init__,
+    which starts _sample(thread_index) in a BackgroundIterator; it generates
+    (features, targets) pairs, with features in space. next() converts them
+    to the requested spaces (None: as generated) and sources.
+
+    Minibatches are sampled randomly by default (stochastic, all of
+    batch_size); deterministic subclasses override stochastic and uneven
+    and pass num_examples.
+    '''
+    stochastic = True
+    uneven = False
+
+    def __init__(self, batch_size, num_batches, space, spaces=None, sources=('features', 'targets'),
+                 return_tuple=False, max_prefetch=2, num_threads=1, num_examples=None):
+        self.batch_size = batch_size
+        self.num_batches = num_batches
+        self.num_examples = num_examples if num_examples is not None else batch_size * num_batches
+        self._space = space
+        self._spaces = spaces if spaces is not None else (None,) * len(sources)
+        self._sources = sources
+        self._return_tuple = return_tuple
+        self._batches = BackgroundIterator(self._sample, max_prefetch=max_prefetch, num_threads=num_threads)
+
+    def _sample(self, thread):
+        raise NotImplementedError()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        X, y = self._batches.next()
+        rval = []
+        for space, source in zip(self._spaces, self._sources):
+            if source == 'features':
+                rval.append(X if space is None else self._space.np_format_as(X, space))
+            elif source == 'targets':
+                rval.append(y)
+            else:
+                raise ValueError('Unknown source: ' + str(source))
+        if len(rval) == 1 and not self._return_tuple:
+            return rval[0]
+        return tuple(rval)
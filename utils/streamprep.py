@@ -0,0 +1,362 @@
+#!/usr/bin/python
+
+'''
+Blockwise versions of the pylearn2 GlobalContrastNormalization, Standardize
+and ZCA preprocessors for memory-mapped design matrices, plus an on-disk
+cache of fitted parameters.
+
+Fitting only needs sufficient statistics (count, sums, sums of squares and
+the Gram matrix), which are additive over disjoint row segments. They are
+cached per segment, so a fit on a superset of rows (e.g. tottrain = train +
+valid) reuses the statistics that were already computed for the subsets.
+GCN works per example, so it is applied to every block as it is read.
+Standardization followed by ZCA is a single affine map, so applying the
+fitted pipeline is one (X - shift) * W product per block. For large inputs
+the ZCA can be computed from the leading eigenvectors only (randomized
+eigendecomposition), which keeps W low-rank.
+'''
+
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+from scipy import linalg
+
+BLOCK_SIZE = 5000
+
+
+def data_hash(path, chunk_size=2**24):
+    '''MD5 of a file's content. The result is remembered in a small sidecar
+    file that is invalidated when the size or mtime of the file changes.
+    '''
+    stat = os.stat(path)
+    sidecar = path + '.md5'
+    if os.path.exists(sidecar):
+        with open(sidecar) as f:
+            info = json.load(f)
+        if info['size'] == stat.st_size and info['mtime'] == stat.st_mtime:
+            return info['md5']
+
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    with _atomic(sidecar) as tmp:
+        with open(tmp, 'w') as f:
+            json.dump({'size': stat.st_size, 'mtime': stat.st_mtime, 'md5': md5.hexdigest()}, f)
+    return md5.hexdigest()
+
+class _atomic(object):
+    '''Context manager giving a temporary path next to path, which is renamed
+    to path on success and removed on failure, so that an interrupted write
+    never leaves a partial file under the final name.
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        fd, self.tmp = tempfile.mkstemp(suffix=os.path.splitext(self.path)[1],
+                                        dir=os.path.dirname(os.path.abspath(self.path)))
+        os.close(fd)
+        return self.tmp
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            os.rename(self.tmp, self.path)
+        elif os.path.exists(self.tmp):
+            os.remove(self.tmp)
+        return False
+
+def _as_design(X):
+    # 2D view of an (n, ...) array
+    return np.reshape(X, (X.shape[0], -1))
+
+def assert_no_nan(X, block_size=BLOCK_SIZE):
+    '''Checks a (memory-mapped) array for NaNs, one block of rows at a time
+    '''
+    for ii in range(0, X.shape[0], block_size):
+        assert not np.any(np.isnan(X[ii:ii + block_size])), 'NaN in rows %d:%d' % (ii, ii + block_size)
+
+def load_float32(path, block_size=BLOCK_SIZE):
+    '''Memory-maps a .npy array as float32. If the array on disk has another
+    dtype, a float32 copy is written next to it once (blockwise) and mapped
+    instead. The copy is checked for NaNs when it is written.
+    '''
+    X = np.load(path, mmap_mode='r')
+    if X.dtype == np.float32:
+        return X
+
+    f32path = os.path.splitext(path)[0] + '_float32.npy'
+    if not os.path.exists(f32path) or os.path.getmtime(f32path) < os.path.getmtime(path):
+        with _atomic(f32path) as tmp:
+            out = np.lib.format.open_memmap(tmp, mode='w+', dtype='float32', shape=X.shape)
+            for ii in range(0, X.shape[0], block_size):
+                out[ii:ii + block_size] = X[ii:ii + block_size]
+            assert_no_nan(out, block_size)
+            out.flush()
+            del out
+
+    return np.load(f32path, mmap_mode='r')
+
+def global_contrast_normalize(X, scale=1., sqrt_bias=0., use_std=False, min_divisor=1e-8):
+    '''Per-example contrast normalization of a 2D block, same as pylearn2's
+    GlobalContrastNormalization (with subtract_mean). Returns a new array.
+    '''
+    X = X - X.mean(axis=1)[:, None]
+    if use_std:
+        normalizers = np.sqrt(sqrt_bias + X.var(axis=1, ddof=1)) / scale
+    else:
+        normalizers = np.sqrt(sqrt_bias + (X ** 2).sum(axis=1)) / scale
+    normalizers[normalizers < min_divisor] = 1.
+    X /= normalizers[:, None]
+    return X
+
+def standardize_rows(X, out=None, rows=None, center=True, block_size=BLOCK_SIZE):
+    '''Standardizes every row of X to zero mean (if center) and unit standard
+    deviation, in float32 and block by block. Results are written to rows
+    `rows` of out (default: a new float32 array, in the same order).
+    '''
+    if out is None:
+        out = np.empty(X.shape, dtype='float32')
+    if rows is None:
+        rows = np.arange(X.shape[0])
+    for ii in range(0, X.shape[0], block_size):
+        block = np.array(X[ii:ii + block_size], dtype='float32')
+        if center:
+            block -= np.mean(block, axis=1, keepdims=True)
+        block /= np.std(block, axis=1, keepdims=True)
+        out[rows[ii:ii + block_size]] = block
+    return out
+
+def block_moments(X, start=0, stop=None, gram=False, gcn=None, block_size=BLOCK_SIZE):
+    '''Sufficient statistics of rows start:stop of X, accumulated in float64.
+    With gcn (a dict of global_contrast_normalize arguments), they are those
+    of the contrast-normalized rows.
+    '''
+    X = _as_design(X)
+    if stop is None:
+        stop = X.shape[0]
+    dim = X.shape[1]
+    moments = {'n': np.array(stop - start),
+               'sum': np.zeros(dim),
+               'sumsq': np.zeros(dim)}
+    if gram:
+        moments['gram'] = np.zeros((dim, dim))
+
+    for ii in range(start, stop, block_size):
+        block = np.asarray(X[ii:min(ii + block_size, stop)], dtype='float64')
+        assert not np.any(np.isnan(block))
+        if gcn is not None:
+            block = global_contrast_normalize(block, **gcn)
+        moments['sum'] += block.sum(axis=0)
+        moments['sumsq'] += (block ** 2).sum(axis=0)
+        if gram:
+            moments['gram'] += np.dot(block.T, block)
+
+    return moments
+
+def add_moments(moments):
+    '''Combines the statistics of disjoint row segments
+    '''
+    total = dict((k, v.copy()) for k, v in moments[0].items())
+    for m in moments[1:]:
+        for k in total:
+            total[k] += m[k]
+    return total
+
+def _randomized_eigh(A, k, oversample=10, n_iter=4, seed=0):
+    # k largest eigenpairs of a symmetric PSD matrix, from a randomized range finder
+    Q = np.random.RandomState(seed).normal(size=(A.shape[0], k + oversample))
+    for _ in range(n_iter):
+        Q = linalg.qr(np.dot(A, Q), mode='economic')[0]
+    eigs, U = linalg.eigh(np.dot(Q.T, np.dot(A, Q)))
+    top = np.argsort(eigs)[::-1][:k]
+    return eigs[top], np.dot(Q, U[:, top])
+
+def fit_params(moments, global_std=False, zca=False, std_eps=1e-4, filter_bias=1., standardize=True,
+               gcn=None, zca_components=None):
+    '''Fits Standardize (and optionally ZCA) from sufficient statistics.
+    Returns the affine map as shift and W, so that the preprocessed data is
+    (X - shift) * W, where W is a vector (per-feature scaling) or a matrix.
+
+    Matches pylearn2: Standardize(global_mean=global_std, global_std=global_std,
+    std_eps) followed by ZCA(filter_bias). Without standardize, it is ZCA
+    alone (or nothing). gcn are the global_contrast_normalize arguments the
+    moments were computed with; they are stored with the parameters, so
+    that apply_params normalizes first as well.
+
+    With zca_components (fewer than the dimensions), only that many leading
+    eigenvectors V of the covariance are computed, and the remaining eigenvalues are replaced by
+    their mean, which keeps the trace. The whitening matrix is then
+    c * I + V * D * V^T, which is returned as V, D and c (W is the scaling).
+    '''
+    n = float(moments['n'])
+    mean = moments['sum'] / n
+    if not standardize:
+        # identity; ZCA subtracts the mean itself
+        m = 0.
+        scale = np.ones_like(mean)
+    else:
+        if global_std:
+            m = mean.mean()
+            std = np.sqrt(max(moments['sumsq'].sum() / (n * len(mean)) - m ** 2, 0.))
+        else:
+            m = mean
+            std = np.sqrt(np.maximum(moments['sumsq'] / n - mean ** 2, 0.))
+        scale = np.ones_like(mean) / (std_eps + std)
+    params = {}
+    if gcn is not None:
+        params['gcn'] = np.array([gcn.get('scale', 1.), gcn.get('sqrt_bias', 0.), gcn.get('use_std', False),
+                                  gcn.get('min_divisor', 1e-8)], dtype='float64')
+
+    if not zca:
+        params.update({'shift': np.ones_like(mean) * m, 'W': scale})
+        return params
+
+    # covariance of the standardized data follows from that of the raw data
+    cov = moments['gram'] / n - np.outer(mean, mean)
+    cov *= np.outer(scale, scale)
+    cov[np.diag_indices_from(cov)] += filter_bias
+    # the ZCA mean is subtracted as well, so the shift is the raw mean
+    params['shift'] = mean
+    if zca_components is not None:
+        # at least one eigenvalue is left for the mean of the rest
+        if not 0 < zca_components < len(cov):
+            raise ValueError('zca_components must be between 1 and %d for %d dimensions, got %s'
+                             % (len(cov) - 1, len(cov), zca_components))
+        eigs, eigv = _randomized_eigh(cov, zca_components)
+        assert eigs.min() > 0
+        rest = (np.trace(cov) - eigs.sum()) / (len(cov) - len(eigs))
+        c = np.sqrt(1.0 / rest)
+        params.update({'W': scale, 'V': eigv, 'D': np.sqrt(1.0 / eigs) - c, 'c': np.array(c)})
+        return params
+    eigs, eigv = linalg.eigh(cov)
+    assert eigs.min() > 0
+    P = np.dot(eigv * np.sqrt(1.0 / eigs), eigv.T)
+    params['W'] = scale[:, None] * P
+    return params
+
+def apply_params(X, params, out=None, block_size=BLOCK_SIZE):
+    '''Writes (X - shift) * W to out in row blocks, using float32 arithmetic.
+    Without out, X is overwritten (in place, block by block).
+    '''
+    if out is None:
+        out = X
+    rval = out
+    X = _as_design(X)
+    out = _as_design(out)
+    if 'gcn' in params:
+        scale, sqrt_bias, use_std, min_divisor = params['gcn']
+        gcn = {'scale': scale, 'sqrt_bias': sqrt_bias, 'use_std': bool(use_std), 'min_divisor': min_divisor}
+    shift = params['shift'].astype('float32')
+    W = params['W'].astype('float32')
+    if 'V' in params:
+        V = params['V'].astype('float32')
+        D = params['D'].astype('float32')
+        c = np.float32(params['c'])
+    for ii in range(0, X.shape[0], block_size):
+        block = np.asarray(X[ii:ii + block_size], dtype='float32')
+        if 'gcn' in params:
+            block = global_contrast_normalize(block, **gcn)
+        block = block - shift
+        if W.ndim == 1:
+            block *= W
+            if 'V' in params:
+                # low-rank ZCA
+                block = c * block + np.dot(np.dot(block, V) * D, V.T)
+            out[ii:ii + block_size] = block
+        else:
+            out[ii:ii + block_size] = np.dot(block, W)
+    return rval
+
+
+def _key(*args):
+    return hashlib.md5(json.dumps(args, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def cached_moments(X, path, start, stop, cache_dir, gram=False, gcn=None, tag=None):
+    '''block_moments for rows start:stop of the array stored at path,
+    cached by data hash and segment
+    '''
+    fn = os.path.join(cache_dir, 'moments_%s.npz' % _key(data_hash(path), start, stop, gram, gcn, tag))
+    if os.path.exists(fn):
+        return dict(np.load(fn))
+    moments = block_moments(X, start, stop, gram=gram, gcn=gcn)
+    with _atomic(fn) as tmp:
+        np.savez(tmp, **moments)
+    return moments
+
+def cached_fit(X, path, segments, cache_dir, tag=None, **pipeline):
+    '''Fits the pipeline on the union of the row segments [(start, stop), ...]
+    of the array stored at path. Returns a key identifying the fit and the
+    parameters. Each segment's statistics are cached separately.
+
+    X may be derived from the file at path (e.g. a view of an image store);
+    different arrays derived from the same file need different tags.
+    '''
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    key = _key(data_hash(path), segments, pipeline, tag)
+    fn = os.path.join(cache_dir, 'params_%s.npz' % key)
+    if os.path.exists(fn):
+        return key, dict(np.load(fn))
+
+    moments = add_moments([cached_moments(X, path, start, stop, cache_dir, gram=pipeline.get('zca', False),
+                                          gcn=pipeline.get('gcn'), tag=tag)
+                           for start, stop in segments])
+    params = fit_params(moments, **pipeline)
+    with _atomic(fn) as tmp:
+        np.savez(tmp, **params)
+    return key, params
+
+def cached_transform(X, path, fit_key, params, cache_dir, name):
+    '''Applies fitted parameters to all rows of the array stored at path and
+    writes the result to a float32 .npy file with a small JSON metadata file
+    next to it. Returns the path of the transformed array.
+
+    Both files are written under temporary names and renamed when complete;
+    the metadata file comes last and marks the array as complete. The result
+    is checked for NaNs once, when it is written, so data sets that map it
+    need not check it again.
+    '''
+    key = _key(data_hash(path), fit_key)
+    out_path = os.path.join(cache_dir, '%s_%s.npy' % (name, key))
+    meta_path = os.path.join(cache_dir, '%s_%s.json' % (name, key))
+    if os.path.exists(out_path) and os.path.exists(meta_path):
+        return out_path
+
+    X = _as_design(X)
+    with _atomic(out_path) as tmp:
+        out = np.lib.format.open_memmap(tmp, mode='w+', dtype='float32', shape=X.shape)
+        apply_params(X, params, out)
+        assert_no_nan(out)
+        out.flush()
+        del out
+
+    with _atomic(meta_path) as tmp:
+        with open(tmp, 'w') as f:
+            json.dump({'source': path, 'data_hash': data_hash(path), 'fit': fit_key,
+                       'shape': list(X.shape), 'dtype': 'float32'}, f, indent=1)
+    return out_path
+
+def cached_splits(train_path, test_path, segments, cache_dir, name, tot=False, **pipeline):
+    '''Preprocessed train and test designs of a data set, as paths of cached
+    float32 arrays (see cached_transform). segments are the (start, stop)
+    rows of the training array: the first is the training set, and the
+    pipeline fitted on all of them (tottrain) is used for the test set, so no
+    statistics are shared between training and validation or test data.
+
+    Returns the paths of the train design (fitted on the first segment), the
+    tottrain design (only with tot, else None) and the test design.
+    '''
+    X = load_float32(train_path)
+    train_key, train_params = cached_fit(X, train_path, segments[:1], cache_dir, **pipeline)
+    tot_key, tot_params = cached_fit(X, train_path, segments, cache_dir, **pipeline)
+
+    train_design = cached_transform(X, train_path, train_key, train_params, cache_dir, 'train' + name)
+    tot_design = None
+    if tot:
+        tot_design = cached_transform(X, train_path, tot_key, tot_params, cache_dir, 'tottrain' + name)
+    test_design = cached_transform(load_float32(test_path), test_path, tot_key, tot_params, cache_dir,
+                                   'test' + name)
+    return train_design, tot_design, test_design